@@ -53,6 +53,14 @@ timeout = int(timeout_str)
 keepalive = int(keepalive_str)
 
 
+def child_exit(server, worker):
+    # drop the live gauges of dead workers from /metrics
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
 # For debugging and testing
 log_data = {
     "loglevel": loglevel,
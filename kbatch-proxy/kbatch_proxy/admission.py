@@ -0,0 +1,176 @@
+"""
+Admission control and load shedding.
+
+Two mechanisms protect the proxy and the Kubernetes API server:
+
+* A limit on the number of requests in flight per route class ("submit",
+  "list", "logs"). Requests over the limit are rejected with a
+  ``503 Service Unavailable`` before doing any work, including auth.
+* Per-user token buckets, per route class. Users over their rate are
+  rejected with ``429 Too Many Requests``.
+
+Both responses carry a ``Retry-After`` header, and an ``X-Kbatch-Unprocessed``
+header telling clients the request was rejected before doing anything, so even
+a submission is safe to retry. Limits are per process, so with several gunicorn
+workers the effective limits are multiplied by the number of workers.
+"""
+
+import json
+import math
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from . import cache, metrics
+
+ROUTE_CLASSES = ("submit", "list", "logs")
+UNPROCESSED_HEADER = "X-Kbatch-Unprocessed"
+
+_route_classes = [
+    ("logs", "GET", re.compile(r"^/(jobs|pods)/logs/[^/]+/?$")),
+    ("submit", "POST", re.compile(r"^/(jobs|cronjobs)/$")),
+    ("list", "GET", re.compile(r"^/(jobs|cronjobs|pods)/(summary(/all)?)?$")),
+]
+
+
+def route_class(method: str, path: str, prefix: str = "") -> Optional[str]:
+    """The route class of a request, or None if it isn't limited."""
+    if prefix and path.startswith(prefix):
+        path = path[len(prefix) :]
+    for name, route_method, xpr in _route_classes:
+        if method == route_method and xpr.match(path):
+            return name
+    return None
+
+
+class TooManyRequests(Exception):
+    """A user exceeded their rate limit."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rate limit exceeded. Retry after {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allow `rate` events per second on average, with bursts of up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Take a token.
+
+        Returns 0 on success, otherwise the number of seconds until a token is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Per-user token buckets, for each route class in `rates`.
+
+    Parameters
+    ----------
+    rates : the sustained requests per second allowed for each route class.
+        Route classes not present are unlimited.
+    burst : the number of requests a user can make in a burst.
+    """
+
+    def __init__(self, rates: Dict[str, float], burst: int, maxsize: int = 10_000):
+        self.rates = rates
+        self.burst = burst
+        # an idle bucket refills completely within this time, so can be forgotten
+        ttl = max((burst / rate for rate in rates.values()), default=0)
+        self.buckets = cache.TTLCache(ttl=ttl, maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def check(self, username: str, route_class: Optional[str]) -> None:
+        """Raise `TooManyRequests` if `username` is over their limit."""
+        if route_class not in self.rates:
+            return
+        key: Tuple[str, str] = (username, route_class)
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rates[route_class], self.burst)
+            # refresh the TTL, so active buckets aren't reset
+            self.buckets.set(key, bucket)
+        wait = bucket.take()
+        if wait:
+            metrics.REJECTED_REQUESTS.labels(route_class, "rate_limit").inc()
+            raise TooManyRequests(math.ceil(wait))
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware shedding load once too many requests are in flight.
+
+    Parameters
+    ----------
+    limits : the maximum number of requests in flight for each route class.
+        Route classes not present are unlimited.
+    retry_after : the value of the ``Retry-After`` header on rejected requests.
+    prefix : the prefix the proxy's routes are served under.
+    """
+
+    def __init__(self, app, limits: Dict[str, int], retry_after: int, prefix: str = ""):
+        self.app = app
+        self.limits = limits
+        self.retry_after = retry_after
+        self.prefix = prefix
+        self.in_flight = {name: 0 for name in ROUTE_CLASSES}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.limits:
+            await self.app(scope, receive, send)
+            return
+
+        name = route_class(scope["method"], scope["path"], self.prefix)
+        limit = self.limits.get(name) if name else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        if self.in_flight[name] >= limit:
+            metrics.REJECTED_REQUESTS.labels(name, "overloaded").inc()
+            detail = (
+                f"kbatch-proxy is overloaded. Retry after {self.retry_after} seconds."
+            )
+            body = json.dumps({"detail": detail}).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(self.retry_after).encode()),
+                        (UNPROCESSED_HEADER.lower().encode(), b"true"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        self.in_flight[name] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight[name] -= 1
@@ -0,0 +1,115 @@
+"""
+Small in-process caches for Kubernetes state.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded cache whose entries expire after `ttl` seconds.
+
+    Least-recently-set entries are evicted first once `maxsize` is reached.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """Get the cached value for `key`, calling `func` to compute it if needed."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self, key: Optional[Hashable] = None) -> None:
+        """Clear `key`, or the whole cache if no key is given."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+
+_missing = object()
+
+
+class SingleFlight:
+    """
+    Share one call among concurrent callers with the same key.
+
+    Callers arriving while a call for their key is in flight await its result,
+    or its exception, instead of making their own. With a `ttl`, results are
+    also reused for `ttl` seconds after the call returns.
+
+    Calls run in a thread, off the event loop. The call isn't cancelled if the
+    caller that started it is, so the others still get its result.
+    """
+
+    def __init__(self, ttl: float = 0, maxsize: int = 1024):
+        self._results = TTLCache(ttl, maxsize) if ttl > 0 else None
+        self._in_flight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight) + len(self._results or ())
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a call for `key` is in flight, or its result cached."""
+        if key in self._in_flight:
+            return True
+        return (
+            self._results is not None
+            and self._results.get(key, _missing) is not _missing
+        )
+
+    async def run(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """The result of `func`, shared with concurrent callers for `key`."""
+        if self._results is not None:
+            value = self._results.get(key, _missing)
+            if value is not _missing:
+                return value
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(func))
+            self._in_flight[key] = future
+            future.add_done_callback(partial(self._done, key))
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: "asyncio.Future[Any]") -> None:
+        del self._in_flight[key]
+        # retrieving the exception keeps asyncio from logging it as unhandled
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self._results is not None:
+            self._results.set(key, future.result())
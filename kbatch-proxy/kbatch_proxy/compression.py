@@ -0,0 +1,123 @@
+"""
+Compressed request and response bodies.
+
+Submissions may be compressed with gzip, or zstd if the ``zstandard`` package
+is installed, as given by their ``Content-Encoding``. Decompressed bodies are
+limited in size, so a small compressed body can't exhaust memory.
+
+Responses are compressed with gzip when the client accepts it, and advertise
+the encodings accepted for requests in an ``Accept-Encoding`` header
+(RFC 7694), and the formats accepted for submissions in an ``Accept-Post``
+header. Clients only send compressed or multipart submissions to a
+kbatch-proxy advertising them, since older versions would fail to parse them.
+"""
+
+import io
+import json
+import zlib
+from typing import Any, Callable, Dict, Tuple, Type
+
+from fastapi import HTTPException, Request, status
+from starlette.datastructures import MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _gunzip(body: bytes, max_size: int) -> bytes:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.decompress(body, max_size + 1)
+    if not decompressor.eof and len(data) <= max_size:
+        raise ValueError("truncated gzip data")
+    return data
+
+
+def _unzstd(body: bytes, max_size: int) -> bytes:
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+        return reader.read(max_size + 1)
+
+
+decoders: Dict[str, Callable[[bytes, int], bytes]] = {"gzip": _gunzip}
+_errors: Tuple[Type[Exception], ...] = (ValueError, zlib.error)
+if zstandard is not None:
+    decoders["zstd"] = _unzstd
+    _errors += (zstandard.ZstdError,)
+
+ACCEPT_ENCODING = ", ".join(decoders)
+ACCEPT_POST = "application/json, multipart/form-data"
+
+
+def decode(body: bytes, content_encoding: str, max_size: int) -> bytes:
+    """
+    Decompress a request `body` with `content_encoding`.
+
+    Raises HTTPException with 415 for unsupported encodings, 413 for bodies
+    larger than `max_size` when decompressed, and 400 for invalid data.
+    """
+    encoding = content_encoding.strip().lower()
+    if encoding in ("", "identity"):
+        return body
+    if encoding not in decoders:
+        raise HTTPException(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported Content-Encoding {content_encoding!r}",
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+        )
+    try:
+        data = decoders[encoding](body, max_size)
+    except _errors as e:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, detail=f"Invalid {encoding} data: {e}"
+        )
+    if len(data) > max_size:
+        raise HTTPException(
+            413,  # renamed across starlette versions
+            detail=f"Request body is larger than {max_size} bytes",
+        )
+    return data
+
+
+async def read_json(request: Request, max_size: int) -> Any:
+    """
+    The JSON body of `request`, decompressed according to its Content-Encoding.
+
+    Raises HTTPException as `decode` does, and with 400 for invalid JSON.
+    """
+    body = await request.body()
+    content_encoding = request.headers.get("content-encoding", "")
+    data = decode(body, content_encoding, max_size)
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON: {e}")
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses of at least `minimum_size` bytes with
+    gzip for clients accepting it, and advertising the request encodings and
+    formats.
+    """
+
+    def __init__(self, app, minimum_size: int = 1000, compresslevel: int = 6):
+        # starlette's default level of 9 is much slower for little gain
+        self.app = GZipMiddleware(
+            app, minimum_size=minimum_size, compresslevel=compresslevel
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["Accept-Encoding"] = ACCEPT_ENCODING
+                headers["Accept-Post"] = ACCEPT_POST
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,187 @@
+"""
+Logging configuration for kbatch-proxy.
+
+Two formats are supported:
+
+* ``rich``: human-friendly, colored output, for development.
+* ``json``: one JSON object per line, for log ingestion. Each record
+  carries the request ID, user and route of the request it was emitted in,
+  and an access log record with the duration is emitted for every request.
+
+In both cases records are handed to a background thread through a queue,
+so formatting and I/O stay off the request path.
+"""
+
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Optional
+
+from . import tracing
+
+user_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "kbatch_user", default=None
+)
+route_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "kbatch_route", default=None
+)
+
+# attributes of every LogRecord, so anything else was passed via `extra`
+_record_attrs = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+access_logger = logging.getLogger("kbatch_proxy.access")
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attach the current request's ID, user and route to records.
+
+    This must run in the thread that emitted the record, before it is queued.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = tracing.request_id_var.get()
+        record.user = user_var.get()
+        if not hasattr(record, "route"):
+            record.route = route_var.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keep only a `rate` fraction of DEBUG (and lower) records."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, tz=datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _record_attrs and value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_info"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like QueueHandler.prepare, merge the args and render the traceback
+        # before queuing, but keep the traceback out of the message
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class AccessLogMiddleware:
+    """ASGI middleware logging the route, status and duration of each request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None)
+            access_logger.info(
+                "%s %s %s",
+                scope["method"],
+                scope["path"],
+                status_code,
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route,
+                    "status": status_code,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                },
+            )
+
+
+def setup_logging(
+    logger: logging.Logger,
+    log_format: str = "rich",
+    level: str = "INFO",
+    debug_sample_rate: float = 1.0,
+) -> logging.handlers.QueueListener:
+    """
+    Send records from `logger` through a queue to a handler for `log_format`.
+
+    Returns the started listener, which is stopped at exit.
+    """
+    handler: logging.Handler
+    if log_format == "json":
+        handler = logging.StreamHandler()
+        handler.setFormatter(JSONFormatter())
+    elif log_format == "rich":
+        import rich.logging
+        import rich.traceback
+
+        rich.traceback.install()
+        handler = rich.logging.RichHandler()
+        handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s:%(levelname)s:%(name)s:%(lineno)s:%(message)s"
+            )
+        )
+    else:
+        raise ValueError(f"Unknown log format {log_format!r}. Expected rich or json.")
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSamplingFilter(debug_sample_rate))
+    queue_handler.addFilter(ContextFilter())
+
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
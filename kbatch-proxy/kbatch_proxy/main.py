@@ -1,30 +1,48 @@
+import asyncio
+import base64
+import concurrent.futures
+import datetime
 import json
 import logging
 import os
+import re
+from contextlib import asynccontextmanager
 from functools import partial
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Hashable, List, Literal, Optional, Tuple, Union
 
 import jupyterhub.services.auth
 import kubernetes.client
 import kubernetes.config
 import kubernetes.watch
-import rich.traceback
-import yaml
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, status
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, status
 from fastapi.responses import Response, StreamingResponse
 from kubernetes.client.models import (
     V1ConfigMap,
     V1CronJob,
     V1Job,
     V1JobTemplateSpec,
+    V1ObjectMeta,
     V1Secret,
 )
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from . import patch, utils
-
-rich.traceback.install()
+from . import (
+    admission,
+    cache,
+    compression,
+    logs,
+    metrics,
+    patch,
+    profiles,
+    profiling,
+    reconcile,
+    retry,
+    scheduler,
+    serialize,
+    tracing,
+    utils,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +58,11 @@ class Settings(BaseSettings):
     jupyterhub_api_token: str = "super-secret"
     jupyterhub_service_prefix: str = "/"
     kbatch_init_logging: bool = True
+    # "rich" for human-readable logs, "json" for structured logs to ingest
+    kbatch_log_format: Literal["rich", "json"] = "rich"
+    kbatch_log_level: str = "INFO"
+    # Fraction of DEBUG log records to keep, for high-volume debugging
+    kbatch_log_debug_sample_rate: float = 1.0
     # lazy prefix handling. Will want to put nginx in front of this.
     kbatch_prefix: str = ""
 
@@ -48,6 +71,9 @@ class Settings(BaseSettings):
 
     # A path to a YAML file defining the profiles
     kbatch_profile_file: Optional[str] = None
+    # Seconds between checks for changes to the profile and job template files.
+    # 0 disables reloading.
+    kbatch_profile_reload_interval_seconds: float = 10
 
     # Jobs are cleaned up by Kubernetes after this many seconds.
     kbatch_job_ttl_seconds_after_finished: Optional[int] = 3600
@@ -57,6 +83,82 @@ class Settings(BaseSettings):
     # Whether to automatically create new namespaces for a users
     kbatch_create_user_namespace: bool = True
 
+    # Seconds between sweeps for orphaned Secrets and ConfigMaps. 0 disables.
+    kbatch_reconcile_interval_seconds: int = 300
+    # Orphans younger than this may belong to a submission in flight.
+    kbatch_reconcile_grace_period_seconds: int = 600
+    # Number of objects to list per request when reconciling
+    kbatch_reconcile_batch_size: int = 100
+
+    # Maximum number of concurrent deletes issued by a bulk delete
+    kbatch_delete_concurrency: int = 10
+
+    # Seconds to cache the job listings used by /jobs/summary
+    kbatch_summary_cache_seconds: float = 10
+    # Concurrent identical requests listing jobs, cronjobs or pods share one
+    # call to Kubernetes. Reuse its response for this many seconds after, too.
+    kbatch_list_cache_seconds: float = 0
+    # JupyterHub groups whose members are kbatch admins, in addition to hub admins
+    kbatch_admin_groups: List[str] = []
+
+    # A path to append request traces to, as JSON lines. Tracing is off if unset.
+    kbatch_tracing_file: Optional[str] = None
+
+    # Profile this fraction of submit, list and log requests. 0 disables.
+    kbatch_profiling_sample_rate: float = 0.0
+    # A directory to write profiles to
+    kbatch_profiling_dir: Optional[str] = None
+    # Seconds between stack samples while profiling
+    kbatch_profiling_interval_seconds: float = 0.005
+    # Minimum seconds between randomly sampled profiles
+    kbatch_profiling_min_interval_seconds: float = 60
+    # Stop sampling a request after this many seconds
+    kbatch_profiling_max_duration_seconds: float = 30
+
+    # Retries of Kubernetes API calls failing with transient errors
+    kbatch_kubernetes_max_retries: int = 3
+    # Base and maximum delays for exponential backoff between retries
+    kbatch_kubernetes_retry_base_seconds: float = 0.1
+    kbatch_kubernetes_retry_max_seconds: float = 2
+    # Fail fast after this many consecutive transient errors...
+    kbatch_kubernetes_circuit_failure_threshold: int = 5
+    # ...for this many seconds
+    kbatch_kubernetes_circuit_reset_seconds: float = 30
+
+    # Maximum requests in flight per route class ("submit", "list", "logs"),
+    # e.g. {"submit": 20}. Classes not listed are unlimited.
+    kbatch_max_in_flight: Dict[str, int] = {}
+    # Retry-After seconds returned when rejecting requests over kbatch_max_in_flight
+    kbatch_retry_after_seconds: int = 1
+    # Sustained requests per second per user for each route class,
+    # e.g. {"submit": 1}. Classes not listed are unlimited.
+    kbatch_user_rate_limit: Dict[str, float] = {}
+    # How many requests per route class a user can make in a burst
+    kbatch_user_rate_burst: int = 20
+    # Responses at least this many bytes are gzipped for clients accepting it
+    kbatch_compress_minimum_size: int = 1000
+    # Largest submission body, once decompressed
+    kbatch_max_request_bytes: int = 32 * 1024 * 1024
+
+    # Hold submitted Jobs in a queue, releasing them under the limits below
+    kbatch_queue_enabled: bool = False
+    # Seconds between releases of queued Jobs
+    kbatch_queue_interval_seconds: float = 10
+    # Maximum running Jobs per user. Unlimited if unset.
+    kbatch_queue_max_running_per_user: Optional[int] = None
+    # Maximum running Jobs per user for each profile, e.g. {"gpu": 2}
+    kbatch_queue_max_running_per_profile: Dict[str, int] = {}
+    # Maximum running Jobs across all users. Unlimited if unset.
+    kbatch_queue_max_running_total: Optional[int] = None
+    # Fair-share weight per user, default 1, e.g. {"alice": 2}
+    kbatch_queue_user_weights: Dict[str, float] = {}
+    # Ranks of the PriorityClasses profiles may use, e.g. {"interactive": 100}.
+    # Higher ranked Jobs are released from the queue first. If set, Jobs may
+    # only use the PriorityClass of their profile.
+    kbatch_priority_classes: Dict[str, int] = {}
+    # A lock file, so only one worker process per pod releases Jobs
+    kbatch_queue_lock_file: str = "/tmp/kbatch-proxy-queue.lock"
+
     model_config = SettingsConfigDict(
         env_file=os.environ.get("KBATCH_SETTINGS_PATH", ".env"),
         env_file_encoding="utf-8",
@@ -67,12 +169,18 @@ class User(BaseModel):
     name: str
     groups: List[str]
     api_token: Optional[str] = None
+    admin: bool = False
 
     @property
     def namespace(self) -> str:
         """The Kubernetes namespace for a user."""
         return patch.namespace_for_username(self.name)
 
+    @property
+    def is_admin(self) -> bool:
+        """Whether the user is a JupyterHub admin or in `kbatch_admin_groups`."""
+        return self.admin or bool(set(self.groups) & set(settings.kbatch_admin_groups))
+
 
 class UserOut(BaseModel):
     name: str
@@ -80,41 +188,95 @@ class UserOut(BaseModel):
 
 
 settings = Settings()
+tracing.configure(settings.kbatch_tracing_file)
+profiling.configure(
+    sample_rate=settings.kbatch_profiling_sample_rate,
+    directory=settings.kbatch_profiling_dir,
+    interval_seconds=settings.kbatch_profiling_interval_seconds,
+    min_interval_seconds=settings.kbatch_profiling_min_interval_seconds,
+    max_duration_seconds=settings.kbatch_profiling_max_duration_seconds,
+)
+retry.configure(
+    max_retries=settings.kbatch_kubernetes_max_retries,
+    base_delay_seconds=settings.kbatch_kubernetes_retry_base_seconds,
+    max_delay_seconds=settings.kbatch_kubernetes_retry_max_seconds,
+    failure_threshold=settings.kbatch_kubernetes_circuit_failure_threshold,
+    reset_seconds=settings.kbatch_kubernetes_circuit_reset_seconds,
+)
 if settings.kbatch_init_logging:
-    import rich.logging
-
-    handler = rich.logging.RichHandler()
-    logger.setLevel(logging.INFO)
-    handler.setLevel(logging.INFO)
-    handler.setFormatter(
-        logging.Formatter("%(asctime)s:%(levelname)s:%(name)s:%(lineno)s:%(message)s")
+    logs.setup_logging(
+        logging.getLogger("kbatch_proxy"),
+        settings.kbatch_log_format,
+        level=settings.kbatch_log_level,
+        debug_sample_rate=settings.kbatch_log_debug_sample_rate,
     )
-    logger.addHandler(handler)
-
-if settings.kbatch_job_template_file:
-    logger.info("loading job template from %s", settings.kbatch_job_template_file)
-    with open(settings.kbatch_job_template_file) as f:
-        job_template = yaml.safe_load(f)
 
-    # parse with Kubernetes to normalize keys with job_data
-    job_template = utils.parse(job_template, model=V1Job).to_dict()
-    utils.remove_nulls(job_template)
+profiles.configure(
+    profile_file=settings.kbatch_profile_file,
+    job_template_file=settings.kbatch_job_template_file,
+)
 
-else:
-    job_template = None
+queue_policy = scheduler.QueuePolicy(
+    max_running_per_user=settings.kbatch_queue_max_running_per_user,
+    max_running_per_profile=settings.kbatch_queue_max_running_per_profile,
+    max_running_total=settings.kbatch_queue_max_running_total,
+    user_weights=settings.kbatch_queue_user_weights,
+    priorities=settings.kbatch_priority_classes,
+)
 
 
-if settings.kbatch_profile_file:
-    # TODO: we need some kind of validation on the keys / values here. Catch typos...
-    logger.info("loading profiles from %s", settings.kbatch_profile_file)
-    with open(settings.kbatch_profile_file) as f:
-        profile_data = yaml.safe_load(f)
-else:
-    profile_data = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = []
+    if settings.kbatch_reconcile_interval_seconds:
+        tasks.append(
+            asyncio.create_task(
+                reconcile.reconcile_forever(
+                    lambda: get_k8s_api()[0],
+                    settings.kbatch_reconcile_interval_seconds,
+                    grace_period_seconds=settings.kbatch_reconcile_grace_period_seconds,
+                    batch_size=settings.kbatch_reconcile_batch_size,
+                )
+            )
+        )
+    if settings.kbatch_profile_reload_interval_seconds:
+        tasks.append(
+            asyncio.create_task(
+                profiles.reload_forever(settings.kbatch_profile_reload_interval_seconds)
+            )
+        )
+    if settings.kbatch_queue_enabled:
+        tasks.append(
+            asyncio.create_task(
+                scheduler.release_forever(
+                    lambda: get_k8s_api()[1],
+                    settings.kbatch_queue_interval_seconds,
+                    queue_policy,
+                    settings.kbatch_queue_lock_file,
+                )
+            )
+        )
+    yield
+    for task in tasks:
+        task.cancel()
 
 
-app = FastAPI()
-router = APIRouter(prefix=settings.kbatch_prefix)
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    compression.CompressionMiddleware,
+    minimum_size=settings.kbatch_compress_minimum_size,
+)
+app.add_middleware(
+    admission.AdmissionMiddleware,
+    limits=settings.kbatch_max_in_flight,
+    retry_after=settings.kbatch_retry_after_seconds,
+    prefix=settings.kbatch_prefix,
+)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
+if settings.kbatch_init_logging and settings.kbatch_log_format == "json":
+    app.add_middleware(logs.AccessLogMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
 
 
 # ----------------------------------------------------------------------------
@@ -126,39 +288,89 @@ auth = jupyterhub.services.auth.HubAuth(
     cache_max_age=60,
 )
 
+rate_limiter = admission.RateLimiter(
+    settings.kbatch_user_rate_limit, burst=settings.kbatch_user_rate_burst
+)
+
 
 async def get_current_user(request: Request) -> User:
-    if not auth.access_scopes:
-        raise RuntimeError(
-            "JupyterHub OAuth scopes for access to kbatch not defined. "
-            "Set $JUPYTERHUB_OAUTH_ACCESS_SCOPES and/or $JUPYTERHUB_SERVICE_NAME."
-        )
-    user = None
-    auth_header = request.headers.get(auth.auth_header_name)
-    if auth_header:
-        scheme, *rest = auth_header.split(None, 1)
-        token = ""
-        if scheme.lower() in {"bearer", "token"} and rest:
-            token = rest[0]
-        user = auth.user_for_token(token)
-        if user and not auth.check_scopes(auth.access_scopes, user):
-            msg = (
-                "Not allowing request with scopes:"
-                f" {user['scopes']}. Needs scope(s): {auth.access_scopes}"
+    with tracing.span("get_current_user"):
+        if not auth.access_scopes:
+            raise RuntimeError(
+                "JupyterHub OAuth scopes for access to kbatch not defined. "
+                "Set $JUPYTERHUB_OAUTH_ACCESS_SCOPES and/or $JUPYTERHUB_SERVICE_NAME."
             )
-            logger.warning(f"{msg} (user={user['name']})")
+        user = None
+        auth_header = request.headers.get(auth.auth_header_name)
+        if auth_header:
+            scheme, *rest = auth_header.split(None, 1)
+            token = ""
+            if scheme.lower() in {"bearer", "token"} and rest:
+                token = rest[0]
+            user = auth.user_for_token(token)
+            if user and not auth.check_scopes(auth.access_scopes, user):
+                msg = (
+                    "Not allowing request with scopes:"
+                    f" {user['scopes']}. Needs scope(s): {auth.access_scopes}"
+                )
+                logger.warning(f"{msg} (user={user['name']})")
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail=msg,
+                )
+
+        if not user:
             raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=msg,
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect token",
             )
+        current_user = User(**user, api_token=token)
+        logs.user_var.set(current_user.name)
+        logs.route_var.set(getattr(request.scope.get("route"), "path", None))
 
-    if user:
-        return User(**user, api_token=token)
-    else:
+        try:
+            rate_limiter.check(
+                current_user.name,
+                admission.route_class(
+                    request.method, request.url.path, settings.kbatch_prefix
+                ),
+            )
+        except admission.TooManyRequests as e:
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=str(e),
+                headers={
+                    "Retry-After": str(e.retry_after),
+                    admission.UNPROCESSED_HEADER: "true",
+                },
+            )
+
+        return current_user
+
+
+def request_profiling(
+    kbatch_profile: Optional[str] = Query(None, include_in_schema=False),
+    user: User = Depends(get_current_user),
+) -> None:
+    """Profile the request if an admin asked for it with ``kbatch_profile``."""
+    if not kbatch_profile:
+        return
+    if not user.is_admin:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect token",
+            status.HTTP_403_FORBIDDEN,
+            detail="Only admins may profile requests.",
         )
+    try:
+        profiling.request_profile(kbatch_profile)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+# authenticated routes, which admins may profile
+router = APIRouter(
+    prefix=settings.kbatch_prefix, dependencies=[Depends(request_profiling)]
+)
+public_router = APIRouter(prefix=settings.kbatch_prefix)
 
 
 # ----------------------------------------------------------------------------
@@ -168,7 +380,10 @@ async def get_current_user(request: Request) -> User:
 def get_k8s_api() -> Tuple[kubernetes.client.CoreV1Api, kubernetes.client.BatchV1Api]:
     kubernetes.config.load_config()
 
-    return kubernetes.client.CoreV1Api(), kubernetes.client.BatchV1Api()
+    return (
+        retry.RetryingApi(metrics.InstrumentedApi(kubernetes.client.CoreV1Api())),
+        retry.RetryingApi(metrics.InstrumentedApi(kubernetes.client.BatchV1Api())),
+    )
 
 
 # ----------------------------------------------------------------------------
@@ -182,101 +397,211 @@ async def kubernetes_exception_handler(
     """Relay kubernetes errors to users"""
     try:
         detail = json.loads(exc.body)["message"]
-    except (ValueError, KeyError):
-        detail = exc.body
+    except (TypeError, ValueError, KeyError):
+        detail = exc.body or exc.reason
+
+    headers = None
+    retry_after = (exc.headers or {}).get("Retry-After")
+    if retry_after:
+        headers = {"Retry-After": retry_after}
 
     raise HTTPException(
         status_code=exc.status,
         detail=detail,
+        headers=headers,
     )
 
 
 # cronjobs #
 @router.get("/cronjobs/{job_name}")
-async def read_cronjob(job_name: str, user: User = Depends(get_current_user)):
-    return _perform_action(job_name, user.namespace, "read", V1CronJob)
+def read_cronjob(
+    request: Request, job_name: str, user: User = Depends(get_current_user)
+):
+    cronjob = _perform_action(job_name, user.namespace, "read", V1CronJob)
+    return _conditional(request, serialize.dumps(cronjob), utils.resource_etag(cronjob))
 
 
 @router.get("/cronjobs/")
-async def read_cronjobs(user: User = Depends(get_current_user)):
-    return _perform_action(None, user.namespace, "list", V1CronJob)
+async def read_cronjobs(request: Request, user: User = Depends(get_current_user)):
+    def list_cronjobs() -> Tuple[bytes, str]:
+        with profiling.profile("list_cronjobs"):
+            cronjobs = _perform_action(None, user.namespace, "list", V1CronJob)
+            return serialize.dumps(cronjobs), utils.resource_etag(cronjobs)
+
+    return await _shared_list(request, "cronjobs", user.namespace, list_cronjobs)
 
 
 @router.delete("/cronjobs/{job_name}")
-async def delete_cronjob(job_name: str, user: User = Depends(get_current_user)):
-    return _perform_action(job_name, user.namespace, "delete", V1CronJob)
+def delete_cronjob(job_name: str, user: User = Depends(get_current_user)):
+    return serialize.json_response(
+        _perform_action(job_name, user.namespace, "delete", V1CronJob)
+    )
 
 
 @router.post("/cronjobs/")
 async def create_cronjob(request: Request, user: User = Depends(get_current_user)):
-    data = await request.json()
-    return _create_job(data, V1CronJob, user)
+    data = await _read_submission(request)
+
+    def create_cronjob() -> dict:
+        with profiling.profile("create_cronjob"):
+            return _create_job(data, V1CronJob, user)
+
+    with metrics.count_submission("cronjob", _profile_label(data)):
+        return serialize.json_response(await asyncio.to_thread(create_cronjob))
 
 
 # jobs #
+@router.get("/jobs/summary")
+def read_jobs_summary(user: User = Depends(get_current_user)):
+    jobs = _list_jobs_cached(user.namespace)
+    return utils.summarize_jobs(jobs)
+
+
+@router.get("/jobs/summary/all")
+def read_jobs_summary_all(user: User = Depends(get_current_user)):
+    if not user.is_admin:
+        raise HTTPException(
+            status.HTTP_403_FORBIDDEN, detail="Only admins may summarize all jobs."
+        )
+    jobs = _list_jobs_cached(None)
+    summary = utils.summarize_jobs(jobs)
+    by_namespace: Dict[str, List[V1Job]] = {}
+    for job in jobs:
+        by_namespace.setdefault(job.metadata.namespace, []).append(job)
+    summary["namespaces"] = {
+        namespace: utils.summarize_jobs(namespace_jobs, max_recent_failures=0)["counts"]
+        for namespace, namespace_jobs in sorted(by_namespace.items())
+    }
+    return summary
+
+
 @router.get("/jobs/{job_name}")
-async def read_job(job_name: str, user: User = Depends(get_current_user)):
-    return _perform_action(job_name, user.namespace, "read", V1Job)
+def read_job(request: Request, job_name: str, user: User = Depends(get_current_user)):
+    job = _perform_action(job_name, user.namespace, "read", V1Job)
+    return _conditional(request, serialize.dumps(job), utils.resource_etag(job))
 
 
 @router.get("/jobs/")
-async def read_jobs(user: User = Depends(get_current_user)):
-    return _perform_action(None, user.namespace, "list", V1Job)
+async def read_jobs(request: Request, user: User = Depends(get_current_user)):
+    def list_jobs() -> Tuple[bytes, str]:
+        with profiling.profile("list_jobs"):
+            jobs = _perform_action(None, user.namespace, "list", V1Job)
+            if settings.kbatch_queue_enabled:
+                _add_queue_positions(jobs)
+            return serialize.dumps(jobs), utils.resource_etag(jobs)
+
+    return await _shared_list(request, "jobs", user.namespace, list_jobs)
 
 
 @router.delete("/jobs/{job_name}")
-async def delete_job(job_name: str, user: User = Depends(get_current_user)):
-    return _perform_action(job_name, user.namespace, "delete", V1Job)
+def delete_job(job_name: str, user: User = Depends(get_current_user)):
+    return serialize.json_response(
+        _perform_action(job_name, user.namespace, "delete", V1Job)
+    )
+
+
+@router.delete("/jobs/")
+def delete_jobs(
+    user: User = Depends(get_current_user),
+    selector: Optional[str] = None,
+    job_status: Optional[str] = Query(None, alias="status"),
+    older_than: Optional[str] = None,
+    delete_all: bool = Query(False, alias="all"),
+):
+    if not (delete_all or selector or job_status or older_than):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            detail="Specify 'all', 'selector', 'status' or 'older_than'.",
+        )
+    if job_status is not None and job_status not in utils.JOB_STATUSES:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown status {job_status!r}. Expected one of {utils.JOB_STATUSES}.",
+        )
+    older_than_seconds = None
+    if older_than is not None:
+        try:
+            older_than_seconds = utils.parse_duration(older_than)
+        except ValueError as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    deleted = _delete_jobs(
+        user.namespace,
+        label_selector=selector,
+        job_status=job_status,
+        older_than_seconds=older_than_seconds,
+    )
+    return {"deleted": deleted}
 
 
 @router.post("/jobs/")
 async def create_job(request: Request, user: User = Depends(get_current_user)):
-    data = await request.json()
-    return _create_job(data, V1Job, user)
+    data = await _read_submission(request)
+
+    def create_job() -> dict:
+        with profiling.profile("create_job"):
+            return _create_job(data, V1Job, user)
+
+    with metrics.count_submission("job", _profile_label(data)):
+        return serialize.json_response(await asyncio.to_thread(create_job))
 
 
 @router.get("/jobs/logs/{job_name}/", response_class=Response)
-async def job_logs(
+def job_logs(
     job_name: str,
     user: User = Depends(get_current_user),
     stream: Optional[bool] = False,
 ):
     core_api, _ = get_k8s_api()
-    pods = core_api.list_namespaced_pod(
-        namespace=user.namespace,
-        label_selector=f"batch.kubernetes.io/job-name={job_name}",
-    )
+    with profiling.profile("job_logs"):
+        pods = core_api.list_namespaced_pod(
+            namespace=user.namespace,
+            label_selector=f"batch.kubernetes.io/job-name={job_name}",
+        )
     if not pods.items:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, detail=f"No pods found for job {job_name}"
         )
     pod_name = pods.items[0].metadata.name
-    return await pod_logs(pod_name, user=user, stream=stream)
+    return pod_logs(pod_name, user=user, stream=stream)
 
 
 # pods #
 @router.get("/pods/{pod_name}")
-async def read_pod(pod_name: str, user: User = Depends(get_current_user)):
+def read_pod(request: Request, pod_name: str, user: User = Depends(get_current_user)):
     core_api, _ = get_k8s_api()
-    result = core_api.read_namespaced_pod(pod_name, namespace=user.namespace)
-    return result.to_dict()
+    result = core_api.read_namespaced_pod(
+        pod_name, namespace=user.namespace, _preload_content=False
+    )
+    pod = serialize.from_response(result, "V1Pod")
+    return _conditional(request, serialize.dumps(pod), utils.resource_etag(pod))
 
 
 @router.get("/pods/")
 async def read_pods(
-    user: User = Depends(get_current_user), job_name: Optional[str] = None
+    request: Request,
+    user: User = Depends(get_current_user),
+    job_name: Optional[str] = None,
 ):
     core_api, _ = get_k8s_api()
     kwargs = {}
 
     if job_name:
         kwargs["label_selector"] = f"job-name={job_name}"
-    result = core_api.list_namespaced_pod(user.namespace, **kwargs)
-    return result.to_dict()
+
+    def list_pods() -> Tuple[bytes, str]:
+        with profiling.profile("list_pods"):
+            result = core_api.list_namespaced_pod(
+                user.namespace, _preload_content=False, **kwargs
+            )
+            pods = serialize.from_response(result, "V1PodList")
+            return serialize.dumps(pods), utils.resource_etag(pods)
+
+    return await _shared_list(request, "pods", (user.namespace, job_name), list_pods)
 
 
 @router.get("/pods/logs/{pod_name}/", response_class=Response)
-async def pod_logs(
+def pod_logs(
     pod_name: str,
     user: User = Depends(get_current_user),
     stream: Optional[bool] = False,
@@ -291,18 +616,28 @@ async def pod_logs(
                 namespace=user.namespace,
             )
         )
-        return StreamingResponse(source)
+        return StreamingResponse(metrics.count_open_stream(source))
     else:
-        logs = core_api.read_namespaced_pod_log(name=pod_name, namespace=user.namespace)
+        with profiling.profile("pod_logs"):
+            logs = core_api.read_namespaced_pod_log(
+                name=pod_name, namespace=user.namespace
+            )
         return logs
 
 
-@router.get("/profiles/")
-async def profiles():
-    return profile_data
+@public_router.get("/profiles/")
+async def get_profiles(request: Request):
+    config = profiles.current
+    return _conditional(request, config.profiles_body, config.profiles_etag)
+
 
+@public_router.get("/metrics", response_class=Response)
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
 
-@router.get("/")
+
+@public_router.get("/")
 def get_root():
     logger.info("get-router")
     return {"message": "kbatch"}
@@ -314,6 +649,7 @@ def authorized(user: User = Depends(get_current_user)) -> UserOut:
 
 
 app.include_router(router)
+app.include_router(public_router)
 
 
 if settings.kbatch_prefix:
@@ -351,6 +687,186 @@ def ensure_namespace(api: kubernetes.client.CoreV1Api, namespace: str):
         return True
 
 
+async def _read_submission(request: Request) -> dict:
+    """The body of a submission, with a valid ``profile`` if any."""
+    data = await _read_submission_body(request)
+    if not isinstance(data, dict):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, detail="The submission must be an object."
+        )
+    profile = data.get("profile")
+    if profile is not None and not isinstance(profile, str):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, detail="'profile' must be a string."
+        )
+    return data
+
+
+async def _read_submission_body(request: Request) -> Any:
+    """
+    The body of a submission.
+
+    Either JSON, with the zipped code base64 encoded in its ConfigMap, or
+    multipart, with that JSON in a "data" part, less the ConfigMap's
+    ``binary_data``, and the zipped code as is in a binary "code" part.
+    """
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        return await compression.read_json(request, settings.kbatch_max_request_bytes)
+
+    max_size = settings.kbatch_max_request_bytes
+    async with request.form(max_files=1, max_fields=1, max_part_size=max_size) as form:
+        data = form.get("data")
+        upload = form.get("code")
+        if not isinstance(data, str):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, detail="Missing the 'data' part"
+            )
+        try:
+            data = json.loads(data)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail="The 'data' part must be a JSON object",
+            )
+        if upload is None or isinstance(upload, str):
+            return data
+        if not isinstance(data.get("code"), dict):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail="A 'code' part requires a code ConfigMap in 'data'",
+            )
+        if upload.size is not None and upload.size > max_size:
+            raise HTTPException(
+                413, detail=f"Request body is larger than {max_size} bytes"
+            )
+        code = await upload.read()
+    # the Kubernetes API takes binary data base64 encoded
+    data["code"]["binary_data"] = {"code": base64.b64encode(code).decode("ascii")}
+    return data
+
+
+def _profile_label(data: dict) -> str:
+    """The name of the profile a submission used, for labelling metrics."""
+    profile = data.get("profile")
+    if not profile:
+        return "none"
+    # only known names, to bound the cardinality of the label
+    return profile if profile in profiles.current.profiles else "unknown"
+
+
+def _pod_spec(job_data: dict, model: Union[V1CronJob, V1Job]) -> dict:
+    """The pod spec of submitted Job or CronJob data."""
+    spec = utils.get_field(job_data, "spec")
+    if issubclass(model, V1CronJob):
+        spec = utils.get_field(utils.get_field(spec, "job_template"), "spec")
+    return utils.get_field(utils.get_field(spec, "template"), "spec") or {}
+
+
+def _verified_profile(
+    data: dict, pod_spec: dict, config: profiles.Config
+) -> Optional[str]:
+    """
+    The profile of a submission, checked against its pod spec.
+
+    The profile's name is only as trustworthy as the client sending it, so a
+    submission naming a profile must match it (see `profiles.matches`), or it
+    is rejected. A submission not naming one gets the first profile it
+    matches, e.g. one submitted with the profile as a dict.
+    """
+    name = data.get("profile")
+    if name in config.profiles:
+        if not profiles.matches(config.profiles[name], pod_spec):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail=(
+                    f"The job doesn't match the profile {name!r}. Its containers "
+                    "must have the profile's resources, and the pod its "
+                    "tolerations, node affinity and PriorityClass."
+                ),
+            )
+        return name
+    return config.match(pod_spec)
+
+
+def _priority_class_name(
+    profile_name: Optional[str],
+    job: Union[V1Job, V1JobTemplateSpec],
+    config: profiles.Config,
+) -> Optional[str]:
+    """
+    The PriorityClass for a submission.
+
+    This is the ``priority_class_name`` of its profile, as checked by
+    `_verified_profile`, so a claimed profile doesn't grant its priority to
+    other resources. When ``kbatch_priority_classes`` is set, a Job
+    requesting any other PriorityClass is rejected.
+    """
+    profile = config.profiles.get(profile_name) if profile_name else None
+    priority_class_name = profile.priority_class_name if profile else None
+    requested = job.spec.template.spec.priority_class_name
+    if (
+        settings.kbatch_priority_classes
+        and requested
+        and requested != priority_class_name
+    ):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            detail=(
+                f"PriorityClass {requested!r} is not allowed. "
+                "PriorityClasses are set by profiles."
+            ),
+        )
+    return priority_class_name
+
+
+_code_digest_xpr = re.compile(r"^[0-9a-f]{40}$")
+
+
+def _code_digest(data: dict) -> Optional[str]:
+    """The digest of the code a submission uploads or reuses, if any."""
+    digest = data.get("code_digest")
+    if digest is not None and not (
+        isinstance(digest, str) and _code_digest_xpr.match(digest)
+    ):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            detail="'code_digest' must be 40 hexadecimal characters.",
+        )
+    return digest
+
+
+def _reuse_code(
+    api: kubernetes.client.CoreV1Api, namespace: str, digest: str
+) -> V1ConfigMap:
+    """
+    A new code ConfigMap with the code of an earlier submission.
+
+    The code is found by the digest labelling its ConfigMap. If there's none,
+    e.g. because the earlier Jobs were deleted, a 409 asks the client to upload
+    the code instead.
+    """
+    config_maps = api.list_namespaced_config_map(
+        namespace=namespace,
+        label_selector=f"{patch.CODE_DIGEST_LABEL}={digest}",
+        limit=1,
+    )
+    if not config_maps.items:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT,
+            detail=f"No code with digest {digest}. Upload the code.",
+        )
+    existing = config_maps.items[0]
+    return V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        binary_data=existing.binary_data,
+        metadata=V1ObjectMeta(generate_name=existing.metadata.generate_name),
+    )
+
+
 def _create_job(
     data: dict,
     model: Union[V1CronJob, V1Job],
@@ -371,44 +887,72 @@ def _create_job(
     user : a `User` object which holds specific configuration settings.
     """
     api, batch_api = get_k8s_api()
+    # read once, in case the profiles are reloaded meanwhile
+    config = profiles.current
 
     job_data = data["job"]
-
-    # does it handle cronjob job specs appropriately?
-    if job_template:
-        job_data = utils.merge_json_objects(job_data, job_template)
-
-    # can be either job or cronjob
-    job = utils.parse(job_data, model=model)
-    job_to_patch = job
-
-    if issubclass(model, V1CronJob):
-        j = job_data.get("spec", {}).get("job_template", {})
-        job_to_patch = utils.parse(j, V1JobTemplateSpec)
-
-    code_data = data.get("code", None)
-    if code_data:
-        # The contents were base64encoded prior to being JSON serialized
-        # we have to decode it *after* submitting things to the API server...
-        # This is not great.
-        # code_data["binary_data"]["code"] = base64.b64decode(code_data["binary_data"]["code"])
-        config_map: Optional[V1ConfigMap] = utils.parse(code_data, model=V1ConfigMap)
-    else:
-        config_map = None
+    code_digest = _code_digest(data)
+    # as submitted, before the job template adds to it
+    profile = _verified_profile(data, _pod_spec(job_data, model), config)
+
+    with tracing.span("parse"):
+        # does it handle cronjob job specs appropriately?
+        if config.job_template:
+            job_data = utils.merge_json_objects(job_data, config.job_template)
+
+        # can be either job or cronjob
+        job = utils.parse(job_data, model=model)
+        job_to_patch = job
+
+        if issubclass(model, V1CronJob):
+            j = job_data.get("spec", {}).get("job_template", {})
+            job_to_patch = utils.parse(j, V1JobTemplateSpec)
+
+        code_data = data.get("code", None)
+        if code_data:
+            # The contents were base64encoded prior to being JSON serialized
+            # we have to decode it *after* submitting things to the API server...
+            # This is not great.
+            # code_data["binary_data"]["code"] = base64.b64decode(code_data["binary_data"]["code"])
+            config_map: Optional[V1ConfigMap] = utils.parse(
+                code_data, model=V1ConfigMap
+            )
+        elif code_digest:
+            config_map = _reuse_code(api, user.namespace, code_digest)
+        else:
+            config_map = None
 
     env_secret = V1Secret()
 
-    patch.patch(
-        job_to_patch,
-        config_map=config_map,
-        annotations={},
-        labels={},
-        username=user.name,
-        ttl_seconds_after_finished=settings.kbatch_job_ttl_seconds_after_finished,
-        extra_env=settings.kbatch_job_extra_env,
-        api_token=user.api_token,
-    )
-    env_secret = patch.extract_env_secret(job_to_patch)
+    labels = {}
+    # profile names predate the label, so aren't required to be label values
+    if profile is not None and utils.is_label_value(profile):
+        labels[patch.PROFILE_LABEL] = profile
+    priority_class_name = _priority_class_name(profile, job_to_patch, config)
+
+    annotations = {}
+    if config_map and code_digest:
+        # tells the client the code was kept for reuse
+        annotations[patch.CODE_DIGEST_LABEL] = code_digest
+
+    with tracing.span("patch"):
+        patch.patch(
+            job_to_patch,
+            config_map=config_map,
+            annotations=annotations,
+            labels=labels,
+            username=user.name,
+            ttl_seconds_after_finished=settings.kbatch_job_ttl_seconds_after_finished,
+            extra_env=settings.kbatch_job_extra_env,
+            api_token=user.api_token,
+        )
+        env_secret = patch.extract_env_secret(job_to_patch)
+        if config_map and code_digest:
+            patch.add_code_digest(config_map, code_digest)
+        if priority_class_name:
+            patch.add_priority_class(job_to_patch, priority_class_name)
+        if settings.kbatch_queue_enabled:
+            patch.add_queued(job_to_patch)
 
     # What needs to happen when? We have a few requirements
     # 1. The code ConfigMap must exist before adding it as a volume (we need a name,
@@ -462,34 +1006,195 @@ def _create_job(
             namespace=user.namespace, name=env_secret.metadata.name
         )
         if config_map:
-            api.delete_namespaced_config(
+            api.delete_namespaced_config_map(
                 namespace=user.namespace, name=config_map.metadata.name
             )
         raise
 
-    logger.info(
-        "patching secret %s with owner %s",
-        env_secret.metadata.name,
-        resp.metadata.name,
-    )
-    patch.patch_owner(resp, env_secret)
-    api.patch_namespaced_secret(
-        name=env_secret.metadata.name, namespace=user.namespace, body=env_secret
-    )
-
-    if config_map:
+    try:
         logger.info(
-            "patching configmap %s with owner %s",
-            config_map.metadata.name,
+            "patching secret %s with owner %s",
+            env_secret.metadata.name,
             resp.metadata.name,
         )
-        patch.patch_owner(resp, config_map)
-        api.patch_namespaced_config_map(
-            name=config_map.metadata.name, namespace=user.namespace, body=config_map
+        patch.patch_owner(resp, env_secret)
+        api.patch_namespaced_secret(
+            name=env_secret.metadata.name, namespace=user.namespace, body=env_secret
+        )
+
+        if config_map:
+            logger.info(
+                "patching configmap %s with owner %s",
+                config_map.metadata.name,
+                resp.metadata.name,
+            )
+            patch.patch_owner(resp, config_map)
+            api.patch_namespaced_config_map(
+                name=config_map.metadata.name,
+                namespace=user.namespace,
+                body=config_map,
+            )
+    except Exception:
+        # The job exists, so report it rather than an error the client could
+        # retry, creating it twice. The secret and configmap outlive it.
+        logger.exception(
+            "Failed to set %s as the owner of secret %s and configmap %s",
+            resp.metadata.name,
+            env_secret.metadata.name,
+            config_map.metadata.name if config_map else None,
         )
 
     # TODO: set Job as the owner of the code.
-    return resp.to_dict()
+    return serialize.to_jsonable(resp)
+
+
+list_flight = cache.SingleFlight(ttl=settings.kbatch_list_cache_seconds)
+metrics.register_cache("list_responses", list_flight)
+
+
+def _conditional(request: Request, body: bytes, etag: str) -> Response:
+    """
+    Respond with the JSON `body`, or with 304 if the client has it already.
+    """
+    # "no-cache" lets clients store the response, but they must revalidate it
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if utils.etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def _shared_list(
+    request: Request,
+    endpoint: str,
+    key: Hashable,
+    list_func: Callable[[], Tuple[bytes, str]],
+) -> Response:
+    """
+    Respond with the JSON and ETag from `list_func`, shared by identical requests.
+
+    `key` identifies identical requests to `endpoint`: the user's namespace and
+    the query. The rendered body is shared, so it can't be changed by anyone.
+    """
+    flight_key = (endpoint, key)
+    if flight_key in list_flight:
+        metrics.COALESCED_REQUESTS.labels(endpoint).inc()
+    body, etag = await list_flight.run(flight_key, list_func)
+    return _conditional(request, body, etag)
+
+
+job_list_cache = cache.TTLCache(ttl=settings.kbatch_summary_cache_seconds)
+metrics.register_cache("job_list", job_list_cache)
+
+
+def _list_jobs_cached(namespace: Optional[str]) -> List[V1Job]:
+    """
+    List the Jobs in `namespace`, or in all kbatch namespaces if None.
+
+    Results are cached for ``kbatch_summary_cache_seconds``.
+    """
+
+    def list_jobs():
+        _, batch_api = get_k8s_api()
+        if namespace is not None:
+            return batch_api.list_namespaced_job(namespace).items
+        items = batch_api.list_job_for_all_namespaces(
+            label_selector=patch.USERNAME_LABEL
+        ).items
+        return [job for job in items if job.metadata.namespace.startswith("kbatch-")]
+
+    return job_list_cache.get_or_set(namespace, list_jobs)
+
+
+def _add_queue_positions(jobs: dict) -> None:
+    """Annotate the queued jobs in a job list with their position in the queue."""
+    queued = [
+        item
+        for item in jobs["items"]
+        if (item.get("spec") or {}).get("suspend")
+        and (item["metadata"].get("labels") or {}).get(scheduler.QUEUED_LABEL) == "true"
+    ]
+    if not queued:
+        # spare listing every namespace, which the positions are relative to
+        return
+    positions = scheduler.queue_positions(_list_jobs_cached(None), queue_policy)
+    for item in queued:
+        metadata = item["metadata"]
+        position = positions.get((metadata["namespace"], metadata["name"]))
+        if position is not None:
+            metadata["annotations"] = {
+                **(metadata.get("annotations") or {}),
+                scheduler.QUEUE_POSITION_ANNOTATION: str(position),
+            }
+
+
+def _delete_jobs(
+    namespace: str,
+    label_selector: Optional[str] = None,
+    job_status: Optional[str] = None,
+    older_than_seconds: Optional[int] = None,
+) -> List[str]:
+    """
+    Delete all the Jobs in `namespace` matching the filters.
+
+    Without `job_status` or `older_than_seconds` this is a single
+    ``delete_collection`` request, reporting the Jobs it deleted. Otherwise
+    the matching Jobs are deleted individually, at most
+    ``kbatch_delete_concurrency`` at a time.
+
+    Parameters
+    ----------
+    namespace : Kubernetes namespace to delete from.
+    label_selector : Kubernetes label selector the jobs must match.
+    job_status : only delete Jobs with this status (see `utils.job_status`).
+    older_than_seconds : only delete Jobs created more than this many seconds ago.
+
+    Returns
+    -------
+    The names of the deleted Jobs.
+    """
+    _, batch_api = get_k8s_api()
+    kwargs = {}
+    if label_selector:
+        kwargs["label_selector"] = label_selector
+
+    if job_status is None and older_than_seconds is None:
+        # the API server responds with the list of Jobs it deleted
+        result = batch_api.delete_collection_namespaced_job(
+            namespace, propagation_policy="Foreground", _preload_content=False, **kwargs
+        )
+        deleted = serialize.from_response(result, "V1JobList")
+        return [job["metadata"]["name"] for job in deleted["items"] or []]
+
+    jobs = batch_api.list_namespaced_job(namespace, **kwargs).items
+
+    if job_status is not None:
+        jobs = [job for job in jobs if utils.job_status(job) == job_status]
+    if older_than_seconds is not None:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        jobs = [
+            job
+            for job in jobs
+            if (now - job.metadata.creation_timestamp).total_seconds()
+            > older_than_seconds
+        ]
+
+    def delete(name: str) -> Optional[str]:
+        try:
+            batch_api.delete_namespaced_job(
+                name, namespace, propagation_policy="Foreground"
+            )
+        except kubernetes.client.ApiException as e:
+            if e.status == 404:
+                # already gone
+                return None
+            raise
+        return name
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.kbatch_delete_concurrency
+    ) as pool:
+        names = pool.map(delete, [job.metadata.name for job in jobs])
+        return [name for name in names if name is not None]
 
 
 def _perform_action(
@@ -497,7 +1202,7 @@ def _perform_action(
     namespace: str,
     action: str,
     model: Union[V1Job, V1CronJob],
-) -> str:
+) -> dict:
     """
     Perform an action on `job_name`.
 
@@ -517,15 +1222,21 @@ def _perform_action(
         )
 
     if issubclass(model, V1Job):
+        model_name = "V1Job"
         model = "job"
     elif issubclass(model, V1CronJob):
+        model_name = "V1CronJob"
         model = "cron_job"
 
     _, batch_api = get_k8s_api()
     f = getattr(batch_api, f"{action}_namespaced_{model}")
-    if action != "list":
+    if action == "list":
+        model_name += "List"
+    else:
         f = partial(f, job_name)
     if action == "delete":
         f = partial(f, propagation_policy="Foreground")
+        model_name = "V1Status"
 
-    return f(namespace).to_dict()
+    # skip building the models, which is slow for long lists
+    return serialize.from_response(f(namespace, _preload_content=False), model_name)
@@ -0,0 +1,180 @@
+"""
+Prometheus metrics for kbatch-proxy.
+
+Metrics are served at ``/metrics``. When running several gunicorn workers,
+set ``$PROMETHEUS_MULTIPROC_DIR`` to an empty directory shared by the workers
+so that ``/metrics`` reports values aggregated across all of them.
+"""
+
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Sized, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from . import tracing
+
+REQUEST_DURATION = Histogram(
+    "kbatch_proxy_request_duration_seconds",
+    "Time spent handling requests to kbatch-proxy.",
+    ["method", "route", "status"],
+)
+KUBERNETES_REQUEST_DURATION = Histogram(
+    "kbatch_proxy_kubernetes_request_duration_seconds",
+    "Time spent in calls to the Kubernetes API.",
+    ["call"],
+)
+KUBERNETES_RETRIES = Counter(
+    "kbatch_proxy_kubernetes_retries_total",
+    "Calls to the Kubernetes API retried after a transient error.",
+    ["call", "reason"],
+)
+KUBERNETES_CIRCUIT_OPEN = Gauge(
+    "kbatch_proxy_kubernetes_circuit_open",
+    "Whether calls to the Kubernetes API are failing fast.",
+    multiprocess_mode="livemax",
+)
+KUBERNETES_CIRCUIT_REJECTIONS = Counter(
+    "kbatch_proxy_kubernetes_circuit_rejections_total",
+    "Calls to the Kubernetes API rejected because the circuit was open.",
+)
+SUBMISSIONS = Counter(
+    "kbatch_proxy_submissions_total",
+    "Job and CronJob submissions.",
+    ["kind", "profile", "outcome"],
+)
+COALESCED_REQUESTS = Counter(
+    "kbatch_proxy_coalesced_requests_total",
+    "List requests served by an identical request's call to the Kubernetes API.",
+    ["endpoint"],
+)
+REJECTED_REQUESTS = Counter(
+    "kbatch_proxy_rejected_requests_total",
+    "Requests rejected by admission control.",
+    ["route_class", "reason"],
+)
+OPEN_LOG_STREAMS = Gauge(
+    "kbatch_proxy_open_log_streams",
+    "Number of log streams currently open.",
+    multiprocess_mode="livesum",
+)
+CACHE_ENTRIES = Gauge(
+    "kbatch_proxy_cache_entries",
+    "Number of entries in kbatch-proxy's in-memory caches.",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+
+_caches: Dict[str, Sized] = {}
+
+
+def register_cache(name: str, cache: Sized) -> None:
+    """Report the size of `cache` in ``kbatch_proxy_cache_entries``."""
+    _caches[name] = cache
+
+
+def update_cache_entries() -> None:
+    for name, cache in _caches.items():
+        CACHE_ENTRIES.labels(name).set(len(cache))
+
+
+class InstrumentedApi:
+    """
+    Wrap a Kubernetes API object, timing every API call.
+
+    Calls are recorded in ``kbatch_proxy_kubernetes_request_duration_seconds``,
+    labelled by method name (e.g. ``create_namespaced_job``), and traced as
+    ``kubernetes.<method name>`` spans.
+    """
+
+    def __init__(self, api: Any):
+        self._api = api
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._api, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        histogram = KUBERNETES_REQUEST_DURATION.labels(name)
+        span_name = f"kubernetes.{name}"
+
+        # wraps preserves the docstring, which kubernetes.watch inspects
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            with histogram.time(), tracing.span(span_name):
+                return attr(*args, **kwargs)
+
+        return timed
+
+
+@contextmanager
+def count_submission(kind: str, profile: str) -> Iterator[None]:
+    """Count a submission in ``kbatch_proxy_submissions_total`` by its outcome."""
+    try:
+        yield
+    except Exception:
+        SUBMISSIONS.labels(kind, profile, "error").inc()
+        raise
+    else:
+        SUBMISSIONS.labels(kind, profile, "success").inc()
+
+
+def count_open_stream(source: Iterator) -> Iterator:
+    """Track `source` in ``kbatch_proxy_open_log_streams`` while it is consumed."""
+    OPEN_LOG_STREAMS.inc()
+    try:
+        yield from source
+    finally:
+        OPEN_LOG_STREAMS.dec()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording ``kbatch_proxy_request_duration_seconds``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # use the route template rather than the path, to bound cardinality
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_DURATION.labels(scope["method"], route, status_code).observe(
+                time.perf_counter() - start
+            )
+            update_cache_entries()
+
+
+def render() -> Tuple[bytes, str]:
+    """Render the metrics in the Prometheus text format, with its content type."""
+    update_cache_entries()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -28,13 +28,24 @@ from kubernetes.client.models import (
 )
 
 SAFE_CHARS = set(string.ascii_lowercase + string.digits)
+# Label applied to every object kbatch creates on behalf of a user
+USERNAME_LABEL = "kbatch.jupyter.org/username"
+# Label on Jobs waiting in the submission queue (see scheduler.py)
+QUEUED_LABEL = "kbatch.jupyter.org/queued"
+# Label with the name of the profile a Job was submitted with
+PROFILE_LABEL = "kbatch.jupyter.org/profile"
+# Label with the name of the PriorityClass of a Job's pods
+PRIORITY_LABEL = "kbatch.jupyter.org/priority-class"
+# Label on code ConfigMaps, and annotation on their Jobs, with the digest of the
+# code, so later submissions of the same code needn't upload it again
+CODE_DIGEST_LABEL = "kbatch.jupyter.org/code-digest"
 
 
 def add_annotations(
     job: Union[V1Job, V1JobTemplateSpec], annotations, username: str
 ) -> None:
     annotations = dict(annotations)
-    annotations["kbatch.jupyter.org/username"] = username
+    annotations[USERNAME_LABEL] = username
 
     job.metadata.annotations.update(annotations)  # update or replace?
     job.spec.template.metadata.annotations.update(annotations)  # update or replace?
@@ -42,9 +53,7 @@ def add_annotations(
 
 def add_labels(job: Union[V1Job, V1JobTemplateSpec], labels, username: str) -> None:
     labels = dict(labels)
-    labels["kbatch.jupyter.org/username"] = escapism.escape(
-        username, safe=SAFE_CHARS, escape_char="-"
-    )
+    labels[USERNAME_LABEL] = escapism.escape(username, safe=SAFE_CHARS, escape_char="-")
 
     job.metadata.labels.update(labels)  # update or replace?
     job.spec.template.metadata.labels.update(labels)  # update or replace?
@@ -59,6 +68,16 @@ def add_namespace_configmap(config_map: V1ConfigMap, namespace: str) -> None:
     config_map.metadata.namespace = namespace
 
 
+def add_labels_configmap(config_map: V1ConfigMap, labels, username: str) -> None:
+    labels = dict(labels)
+    labels[USERNAME_LABEL] = escapism.escape(username, safe=SAFE_CHARS, escape_char="-")
+
+    if config_map.metadata.labels is None:
+        config_map.metadata.labels = labels
+    else:
+        config_map.metadata.labels.update(labels)
+
+
 def add_code_configmap(job: Union[V1Job, V1JobTemplateSpec]) -> None:
     pass
 
@@ -232,6 +251,7 @@ def patch(
     * Adds `annotations` to the job
     * Adds `labels` to the job
     * Sets the namespace of the job (and all containers) and ConfigMap to `namespace`
+    * Adds `labels` to the ConfigMap, so orphans can be found by the reconciler
     * Adds the ConfigMap as a volume for the Job's container
     """
     annotations = annotations or {}
@@ -246,9 +266,42 @@ def patch(
 
     if config_map:
         add_namespace_configmap(config_map, namespace_for_username(username))
+        add_labels_configmap(config_map, labels, username)
         add_unzip_init_container(job)
 
 
+def add_priority_class(
+    job: Union[V1Job, V1JobTemplateSpec], priority_class_name: str
+) -> None:
+    """Run the Job's pods with a Kubernetes PriorityClass."""
+    job.spec.template.spec.priority_class_name = priority_class_name
+    # a new dict, since the env Secret may share the Job's labels
+    job.metadata.labels = {
+        **(job.metadata.labels or {}),
+        PRIORITY_LABEL: priority_class_name,
+    }
+
+
+def add_queued(job: Union[V1Job, V1JobTemplateSpec]) -> None:
+    """
+    Create the Job suspended and labelled as queued.
+
+    Kubernetes won't create its pods until the scheduler releases it. For a
+    CronJob's job template, each Job the CronJob creates is queued.
+    """
+    job.spec.suspend = True
+    # a new dict, since the env Secret may share the Job's labels
+    job.metadata.labels = {**(job.metadata.labels or {}), QUEUED_LABEL: "true"}
+
+
+def add_code_digest(config_map: V1ConfigMap, digest: str) -> None:
+    """Label the code ConfigMap with the `digest` of its code, to find it later."""
+    config_map.metadata.labels = {
+        **(config_map.metadata.labels or {}),
+        CODE_DIGEST_LABEL: digest,
+    }
+
+
 def add_submitted_configmap_name(
     job: Union[V1Job, V1JobTemplateSpec], config_map: V1ConfigMap
 ):
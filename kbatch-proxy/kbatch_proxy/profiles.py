@@ -0,0 +1,325 @@
+"""
+Profiles and the job template, validated when loaded and reloaded when they change.
+
+Both are loaded into an immutable `Config`. `current` is replaced as a whole
+when the files change, so a request reading ``profiles.current`` once sees a
+consistent set of profiles and template, even if a reload happens meanwhile.
+
+Invalid files are rejected when kbatch-proxy starts. A reload with invalid
+files is logged and ignored, keeping the previous configuration, so a typo in
+an updated ConfigMap can't take kbatch-proxy down.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+import kubernetes.utils
+import yaml
+from kubernetes.client.models import V1Job
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class _Model(BaseModel):
+    # reject unknown keys, to catch typos
+    model_config = ConfigDict(extra="forbid", populate_by_name=True)
+
+
+class Resources(_Model):
+    requests: Dict[str, Union[str, int, float]] = {}
+    limits: Dict[str, Union[str, int, float]] = {}
+
+    @field_validator("requests", "limits")
+    @classmethod
+    def _check_quantities(cls, value):
+        for resource, quantity in value.items():
+            try:
+                kubernetes.utils.parse_quantity(quantity)
+            except ValueError:
+                raise ValueError(f"invalid quantity {quantity!r} for {resource!r}")
+        return value
+
+
+class Toleration(_Model):
+    key: Optional[str] = None
+    operator: Optional[Literal["Equal", "Exists"]] = None
+    value: Optional[str] = None
+    effect: Optional[Literal["NoSchedule", "PreferNoSchedule", "NoExecute"]] = None
+    toleration_seconds: Optional[int] = None
+
+
+class NodeSelectorRequirement(_Model):
+    key: str
+    operator: Literal["In", "NotIn", "Exists", "DoesNotExist", "Gt", "Lt"]
+    values: List[str] = []
+
+
+class NodeSelectorTerm(_Model):
+    match_expressions: List[NodeSelectorRequirement] = Field(
+        [], alias="matchExpressions"
+    )
+    match_fields: List[NodeSelectorRequirement] = Field([], alias="matchFields")
+
+
+class Profile(_Model):
+    """
+    A profile, as applied to Jobs by the kbatch client.
+    """
+
+    image: Optional[str] = None
+    resources: Resources = Resources()
+    tolerations: List[Toleration] = []
+    node_affinity_required: List[NodeSelectorTerm] = []
+    priority_class_name: Optional[str] = None
+
+    @field_validator("priority_class_name")
+    @classmethod
+    def _check_priority_class_name(cls, value):
+        # Jobs are labelled with it, for the submission queue
+        if value is not None and not utils.is_label_value(value):
+            raise ValueError(
+                f"priority_class_name {value!r} must be a valid label value, "
+                "of at most 63 characters"
+            )
+        return value
+
+
+def validate_profiles(profile_data: Any) -> Dict[str, Profile]:
+    """
+    Validate profile data, raising ValueError naming any invalid profile.
+    """
+    if not isinstance(profile_data, dict):
+        raise ValueError("Profiles must be a mapping of profile names to profiles")
+    profiles = {}
+    for name, profile in profile_data.items():
+        try:
+            profiles[name] = Profile.model_validate(profile)
+        except ValueError as e:
+            raise ValueError(f"Invalid profile {name!r}: {e}") from e
+        if not utils.is_label_value(name):
+            logger.warning(
+                "Jobs with the profile %r aren't labelled with it, since it isn't a "
+                "valid label value. Per-profile queue limits don't apply to them.",
+                name,
+            )
+    return profiles
+
+
+def _quantities(quantities: Any) -> Dict[str, Any]:
+    return {
+        resource: kubernetes.utils.parse_quantity(quantity)
+        for resource, quantity in (quantities or {}).items()
+    }
+
+
+def _requirement(requirement: Any) -> Dict[str, Any]:
+    result = {
+        "key": utils.get_field(requirement, "key"),
+        "operator": utils.get_field(requirement, "operator"),
+    }
+    if utils.get_field(requirement, "values"):
+        result["values"] = utils.get_field(requirement, "values")
+    return result
+
+
+def _canonical(items: List[Dict[str, Any]]) -> List[str]:
+    """`items` in a canonical order, to compare them ignoring their order."""
+    return sorted(json.dumps(item, sort_keys=True, default=str) for item in items)
+
+
+def matches(profile: Profile, pod_spec: dict) -> bool:
+    """
+    Whether the submitted `pod_spec` is what the client makes of `profile`.
+
+    Every container has the profile's resources, and the pod has its
+    tolerations, required node affinity and PriorityClass. The image isn't
+    compared, since users may choose their own.
+    """
+    expected = (
+        _quantities(profile.resources.requests),
+        _quantities(profile.resources.limits),
+    )
+    containers = (utils.get_field(pod_spec, "containers") or []) + (
+        utils.get_field(pod_spec, "init_containers") or []
+    )
+    try:
+        for container in containers:
+            resources = utils.get_field(container, "resources")
+            requests = _quantities(utils.get_field(resources, "requests"))
+            limits = _quantities(utils.get_field(resources, "limits"))
+            if (requests, limits) != expected:
+                return False
+    except (AttributeError, TypeError, ValueError):
+        # e.g. an invalid quantity
+        return False
+
+    tolerations = [
+        {
+            name: utils.get_field(toleration, name)
+            for name in Toleration.model_fields
+            if utils.get_field(toleration, name) is not None
+        }
+        for toleration in utils.get_field(pod_spec, "tolerations") or []
+    ]
+    expected_tolerations = [
+        toleration.model_dump(exclude_none=True) for toleration in profile.tolerations
+    ]
+    if _canonical(tolerations) != _canonical(expected_tolerations):
+        return False
+
+    # the client combines the profile's terms into one
+    node_affinity = utils.get_field(
+        utils.get_field(pod_spec, "affinity"), "node_affinity"
+    )
+    required = utils.get_field(
+        node_affinity, "required_during_scheduling_ignored_during_execution"
+    )
+    requirements = []
+    for term in utils.get_field(required, "node_selector_terms") or []:
+        for field_name in ("match_expressions", "match_fields"):
+            requirements += [
+                {"field": field_name, **_requirement(requirement)}
+                for requirement in utils.get_field(term, field_name) or []
+            ]
+    expected_requirements = []
+    for term in profile.node_affinity_required:
+        for field_name in ("match_expressions", "match_fields"):
+            expected_requirements += [
+                {"field": field_name, **_requirement(requirement.model_dump())}
+                for requirement in getattr(term, field_name)
+            ]
+    if _canonical(requirements) != _canonical(expected_requirements):
+        return False
+
+    priority_class_name = utils.get_field(pod_spec, "priority_class_name")
+    return priority_class_name == profile.priority_class_name
+
+
+@dataclass(frozen=True)
+class Config:
+    """
+    A consistent snapshot of the profiles and the job template.
+
+    Parameters
+    ----------
+    profile_data : the profiles, served to clients from /profiles/.
+        Raises ValueError if they're invalid.
+    job_template : the job template, normalized with the Kubernetes models.
+    """
+
+    profile_data: Dict[str, Any] = field(default_factory=dict)
+    job_template: Optional[dict] = None
+    # computed once per load rather than per request
+    profiles: Dict[str, Profile] = field(init=False)
+    profiles_body: bytes = field(init=False)
+    profiles_etag: str = field(init=False)
+
+    def __post_init__(self):
+        profiles = validate_profiles(self.profile_data)
+        body = json.dumps(self.profile_data).encode()
+        object.__setattr__(self, "profiles", profiles)
+        object.__setattr__(self, "profiles_body", body)
+        object.__setattr__(self, "profiles_etag", utils.etag(self.profile_data))
+
+    def match(self, pod_spec: dict) -> Optional[str]:
+        """The name of the first profile `pod_spec` `matches`, if any."""
+        for name, profile in self.profiles.items():
+            if matches(profile, pod_spec):
+                return name
+        return None
+
+
+def load_job_template(path: str) -> dict:
+    """Load the job template in the YAML file `path`."""
+    with open(path) as f:
+        job_template = yaml.safe_load(f)
+
+    # parse with Kubernetes to normalize keys with job_data
+    job_template = utils.parse(job_template, model=V1Job).to_dict()
+    utils.remove_nulls(job_template)
+    return job_template
+
+
+def load(
+    profile_file: Optional[str] = None, job_template_file: Optional[str] = None
+) -> Config:
+    """Load the profiles and job template files into a `Config`."""
+    profile_data: Dict[str, Any] = {}
+    job_template = None
+    if profile_file:
+        logger.info("loading profiles from %s", profile_file)
+        with open(profile_file) as f:
+            profile_data = yaml.safe_load(f) or {}
+    if job_template_file:
+        logger.info("loading job template from %s", job_template_file)
+        job_template = load_job_template(job_template_file)
+    try:
+        return Config(profile_data, job_template)
+    except ValueError as e:
+        raise ValueError(f"{profile_file}: {e}") from e
+
+
+def _signature(path: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    """Changes when the file at `path` does, including a ConfigMap's symlink swap."""
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+current = Config()
+_files: Tuple[Optional[str], Optional[str]] = (None, None)
+_signatures: Tuple[Any, ...] = (None, None)
+
+
+def configure(
+    profile_file: Optional[str] = None, job_template_file: Optional[str] = None
+) -> None:
+    """Load the profiles and the job template, raising if they're invalid."""
+    global current, _files, _signatures
+    _files = (profile_file, job_template_file)
+    _signatures = tuple(_signature(path) for path in _files)
+    current = load(profile_file, job_template_file)
+
+
+def reload() -> bool:
+    """
+    Reload the profiles and the job template if their files changed.
+
+    Returns whether they were reloaded.
+    """
+    global current, _signatures
+    signatures = tuple(_signature(path) for path in _files)
+    if signatures == _signatures:
+        return False
+    try:
+        config = load(*_files)
+    except Exception:
+        logger.exception("Not reloading invalid profiles or job template")
+        # don't retry until they change again
+        _signatures = signatures
+        return False
+    _signatures = signatures
+    current = config
+    logger.info("Reloaded profiles and job template")
+    return True
+
+
+async def reload_forever(interval_seconds: float) -> None:
+    """Run `reload` every `interval_seconds`, until cancelled."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(reload)
+        except Exception:
+            logger.exception("Error reloading profiles")
@@ -0,0 +1,251 @@
+"""
+Opt-in, low-overhead profiling of individual requests.
+
+The expensive parts of the submit, list and log endpoints are wrapped in
+`profile`. When a request is selected for profiling, a background thread
+samples the stack of the thread doing the work every
+``kbatch_profiling_interval_seconds`` and the result is rendered in the
+"folded stacks" format understood by flamegraph tools (``flamegraph.pl``,
+speedscope, ...).
+
+Requests are selected either
+
+* at random, for a ``kbatch_profiling_sample_rate`` fraction of requests,
+  at most once every ``kbatch_profiling_min_interval_seconds``. Profiles are
+  written to ``kbatch_profiling_dir``.
+* by an admin, with the ``kbatch_profile`` query parameter. With
+  ``kbatch_profile=file`` the profile is written to ``kbatch_profiling_dir``
+  and its file name returned in the ``X-Kbatch-Profile`` header. With
+  ``kbatch_profile=inline`` the response body is replaced by the profile.
+
+At most one request is profiled at a time and sampling stops after
+``kbatch_profiling_max_duration_seconds``, which bounds the overhead.
+"""
+
+import contextvars
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Kbatch-Profile"
+PROFILE_MODES = ("file", "inline")
+
+
+@dataclass
+class ProfilingConfig:
+    sample_rate: float = 0.0
+    directory: Optional[str] = None
+    interval_seconds: float = 0.005
+    min_interval_seconds: float = 60
+    max_duration_seconds: float = 30
+
+
+@dataclass
+class _ProfileRequest:
+    # "file" or "inline" if an admin asked for a profile
+    mode: Optional[str] = None
+    reports: List[str] = field(default_factory=list)
+    files: List[str] = field(default_factory=list)
+
+
+config = ProfilingConfig()
+_request_var: contextvars.ContextVar[Optional[_ProfileRequest]] = (
+    contextvars.ContextVar("kbatch_profile_request", default=None)
+)
+# only one profile at a time, to bound the overhead
+_lock = threading.Lock()
+_last_sampled = float("-inf")
+
+
+def configure(**kwargs) -> None:
+    """Update the module's `ProfilingConfig`."""
+    global config
+    config = ProfilingConfig(**kwargs)
+
+
+def request_profile(mode: str) -> None:
+    """Profile the current request, rendering the result as `mode`."""
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}. Expected {PROFILE_MODES}.")
+    if mode == "file" and not config.directory:
+        raise ValueError("kbatch_profiling_dir must be set to write profiles to file.")
+    profile_request = _request_var.get()
+    if profile_request is not None:
+        profile_request.mode = mode
+
+
+class StackSampler:
+    """
+    Periodically sample the stack of a thread from a background thread.
+
+    Parameters
+    ----------
+    thread_id : the ident of the thread to sample.
+    interval : seconds between samples.
+    max_duration : stop sampling after this many seconds.
+    """
+
+    def __init__(self, thread_id: int, interval: float, max_duration: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_duration = max_duration
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="kbatch-profiler", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        deadline = time.monotonic() + self.max_duration
+        while not self._stop.wait(self.interval):
+            if time.monotonic() > deadline:
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.counts[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """The samples in the folded stacks format."""
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.counts.most_common()
+        )
+
+
+def _should_sample() -> bool:
+    global _last_sampled
+    if not (config.sample_rate and config.directory):
+        return False
+    now = time.monotonic()
+    if now - _last_sampled < config.min_interval_seconds:
+        return False
+    if random.random() >= config.sample_rate:
+        return False
+    _last_sampled = now
+    return True
+
+
+def _write(name: str, report: str) -> str:
+    assert config.directory
+    request_id = tracing.request_id_var.get() or "unknown"
+    filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{name}-{request_id}.folded"
+    with open(os.path.join(config.directory, filename), "w") as f:
+        f.write(report)
+    return filename
+
+
+@contextmanager
+def profile(name: str) -> Iterator[None]:
+    """Profile the enclosed block, if the current request was selected."""
+    profile_request = _request_var.get()
+    mode = profile_request.mode if profile_request else None
+    if mode is None and _should_sample():
+        mode = "file"
+    if mode is None or not _lock.acquire(blocking=False):
+        yield
+        return
+
+    sampler = StackSampler(
+        threading.get_ident(), config.interval_seconds, config.max_duration_seconds
+    )
+    try:
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+    finally:
+        _lock.release()
+
+    report = sampler.folded()
+    if mode == "inline" and profile_request is not None:
+        profile_request.reports.append(report)
+        return
+    try:
+        filename = _write(name, report)
+    except OSError:
+        logger.exception("Failed to write profile for %s", name)
+        return
+    logger.info("Wrote profile %s", filename)
+    if profile_request is not None:
+        profile_request.files.append(filename)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware reporting the profiles taken during a request.
+
+    Adds the ``X-Kbatch-Profile`` header for profiles written to file,
+    and replaces the response body with inline profiles.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile_request = _ProfileRequest()
+        token = _request_var.set(profile_request)
+        inline = False
+
+        async def send_wrapper(message):
+            nonlocal inline
+            if message["type"] == "http.response.start":
+                if profile_request.reports:
+                    inline = True
+                    body = "".join(profile_request.reports).encode("utf-8")
+                    await send(
+                        {
+                            "type": "http.response.start",
+                            "status": message["status"],
+                            "headers": [
+                                (b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode()),
+                            ],
+                        }
+                    )
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                if profile_request.files:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (
+                            PROFILE_HEADER.lower().encode("latin-1"),
+                            ",".join(profile_request.files).encode("latin-1"),
+                        )
+                    ]
+            elif message["type"] == "http.response.body" and inline:
+                # the profile has already been sent in place of the body
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_var.reset(token)
@@ -0,0 +1,117 @@
+"""
+Clean up Secrets and ConfigMaps orphaned by partially-failed submissions.
+
+`_create_job` submits the env Secret and code ConfigMap *before* the Job,
+and only sets the Job as their owner afterwards. If the proxy dies in between,
+nothing will ever garbage-collect them. The reconciler periodically lists
+kbatch-labelled objects without owners and deletes the ones that are older
+than a grace period (younger ones may belong to a submission in flight).
+"""
+
+import asyncio
+import datetime
+import logging
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import kubernetes.client
+
+from .patch import USERNAME_LABEL
+
+logger = logging.getLogger(__name__)
+
+# the kinds of objects created ahead of their owner in `_create_job`
+ORPHAN_KINDS = ("secret", "config_map")
+
+
+def is_orphan(obj, now: datetime.datetime, grace_period_seconds: int) -> bool:
+    """Whether `obj` has no owner and is older than the grace period."""
+    if obj.metadata.owner_references:
+        return False
+    created = obj.metadata.creation_timestamp
+    if created is None:
+        return False
+    return (now - created).total_seconds() > grace_period_seconds
+
+
+def _iter_pages(list_func: Callable, batch_size: int) -> Iterable[list]:
+    """Page through a list call, `batch_size` objects at a time."""
+    continue_token = None
+    while True:
+        kwargs = {"label_selector": USERNAME_LABEL, "limit": batch_size}
+        if continue_token:
+            kwargs["_continue"] = continue_token
+        result = list_func(**kwargs)
+        yield result.items
+        continue_token = result.metadata._continue
+        if not continue_token:
+            break
+
+
+def reconcile(
+    api: kubernetes.client.CoreV1Api,
+    kind: str,
+    *,
+    grace_period_seconds: int = 600,
+    batch_size: int = 100,
+    now: Optional[datetime.datetime] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Delete orphaned objects of `kind` in all kbatch namespaces.
+
+    Parameters
+    ----------
+    api : the CoreV1Api to use.
+    kind : the object kind, "secret" or "config_map".
+    grace_period_seconds : objects younger than this are never deleted.
+    batch_size : how many objects to list per request.
+    now : the current time, for testing.
+
+    Returns
+    -------
+    The ``(namespace, name)`` of each deleted object.
+    """
+    if kind not in ORPHAN_KINDS:
+        raise ValueError(f"Unknown `kind` specified: {kind}. Expected {ORPHAN_KINDS}.")
+
+    now = now or datetime.datetime.now(tz=datetime.timezone.utc)
+    list_func = getattr(api, f"list_{kind}_for_all_namespaces")
+    delete_func = getattr(api, f"delete_namespaced_{kind}")
+
+    deleted = []
+    for items in _iter_pages(list_func, batch_size):
+        for obj in items:
+            if not is_orphan(obj, now, grace_period_seconds):
+                continue
+            name, namespace = obj.metadata.name, obj.metadata.namespace
+            try:
+                delete_func(name=name, namespace=namespace)
+            except kubernetes.client.ApiException as e:
+                if e.status == 404:
+                    # deleted by someone else, e.g. another worker
+                    continue
+                raise
+            logger.info("Deleted orphaned %s %s/%s", kind, namespace, name)
+            deleted.append((namespace, name))
+    return deleted
+
+
+def reconcile_all(api: kubernetes.client.CoreV1Api, **kwargs) -> List[Tuple[str, str]]:
+    """Reconcile every kind in `ORPHAN_KINDS`."""
+    deleted = []
+    for kind in ORPHAN_KINDS:
+        deleted.extend(reconcile(api, kind, **kwargs))
+    return deleted
+
+
+async def reconcile_forever(
+    get_api: Callable[[], kubernetes.client.CoreV1Api],
+    interval_seconds: int,
+    **kwargs,
+) -> None:
+    """Run `reconcile_all` every `interval_seconds`, until cancelled."""
+    while True:
+        try:
+            await asyncio.to_thread(reconcile_all, get_api(), **kwargs)
+        except Exception:
+            logger.exception("Error reconciling orphaned Secrets and ConfigMaps")
+        await asyncio.sleep(interval_seconds)
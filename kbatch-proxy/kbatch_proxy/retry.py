@@ -0,0 +1,210 @@
+"""
+Retries and a circuit breaker for calls to the Kubernetes API.
+
+Calls failing with a transient error are retried with jittered exponential
+backoff, honoring the ``Retry-After`` header the API server sends when
+shedding load with API Priority and Fairness:
+
+* ``429 Too Many Requests`` is retried for any call, since the API server
+  rejected the request without processing it.
+* ``5xx`` responses and connection errors are only retried for idempotent
+  calls (``read_*``, ``list_*``, ``patch_*``, ...). A ``create_*`` call may
+  have succeeded before the error, and retrying it would create a duplicate.
+
+After ``failure_threshold`` consecutive calls failed with a transient error,
+even after retrying, the circuit opens and calls fail immediately with a
+``503`` for ``reset_seconds``. Then a single trial call is let through, closing
+the circuit again if it succeeds. A ``429`` isn't a failure: the API server is
+answering, just shedding load, and opening the circuit would only shed more.
+"""
+
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import kubernetes.client
+import urllib3.exceptions
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_PREFIXES = ("read_", "list_", "get_", "patch_", "replace_", "delete_")
+
+
+@dataclass
+class RetryConfig:
+    max_retries: int = 3
+    base_delay_seconds: float = 0.1
+    max_delay_seconds: float = 2
+    failure_threshold: int = 5
+    reset_seconds: float = 30
+
+
+class CircuitOpenError(kubernetes.client.ApiException):
+    """The Kubernetes API is unhealthy, so the call wasn't attempted."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(status=503, reason="Service Unavailable")
+        self.retry_after = max(1, round(retry_after))
+        self.body = json.dumps(
+            {"message": "The Kubernetes API is unavailable. Try again later."}
+        )
+        self.headers = {"Retry-After": str(self.retry_after)}
+
+
+class CircuitBreaker:
+    """
+    Fail fast after `failure_threshold` consecutive failures.
+
+    Parameters
+    ----------
+    failure_threshold : consecutive failures that open the circuit.
+    reset_seconds : how long the circuit stays open before a trial call.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Raise `CircuitOpenError` if the call shouldn't be attempted."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self._trial:
+                metrics.KUBERNETES_CIRCUIT_REJECTIONS.inc()
+                raise CircuitOpenError(max(remaining, 1))
+            # half-open: let a single call through
+            self._trial = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Kubernetes API circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+            metrics.KUBERNETES_CIRCUIT_OPEN.set(0)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                if self.opened_at is None:
+                    logger.warning(
+                        "Kubernetes API circuit opened after %d failures",
+                        self.failures,
+                    )
+                self.opened_at = time.monotonic()
+                self._trial = False
+                metrics.KUBERNETES_CIRCUIT_OPEN.set(1)
+
+
+config = RetryConfig()
+breaker = CircuitBreaker(config.failure_threshold, config.reset_seconds)
+
+
+def configure(**kwargs) -> None:
+    """Update the module's `RetryConfig`, resetting the circuit breaker."""
+    global config, breaker
+    config = RetryConfig(**kwargs)
+    breaker = CircuitBreaker(config.failure_threshold, config.reset_seconds)
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _transient_reason(e: Exception) -> Optional[str]:
+    """Why `e` is worth retrying, or None if it isn't."""
+    if isinstance(e, CircuitOpenError):
+        return None
+    if isinstance(e, kubernetes.client.ApiException):
+        return str(e.status) if e.status in RETRY_STATUSES else None
+    if isinstance(e, (urllib3.exceptions.HTTPError, ConnectionError)):
+        return "connection"
+    return None
+
+
+def call(name: str, f, *args, **kwargs) -> Any:
+    """
+    Call the Kubernetes API method `name`, retrying transient errors.
+
+    This sleeps while backing off, so call it from a thread, never on the
+    event loop.
+    """
+    idempotent = name.startswith(IDEMPOTENT_PREFIXES)
+    breaker.before_call()
+    attempt = 0
+    while True:
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            reason = _transient_reason(e)
+            if (
+                reason is None
+                or attempt >= config.max_retries
+                or not (idempotent or reason == "429")
+            ):
+                if reason is None or reason == "429":
+                    # the API server answered, e.g. a 404 or shedding load
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = config.base_delay_seconds * 2**attempt
+                # full jitter, so retrying workers don't synchronize
+                delay = random.uniform(0, delay)
+            delay = min(delay, config.max_delay_seconds)
+            attempt += 1
+            metrics.KUBERNETES_RETRIES.labels(name, reason).inc()
+            logger.info(
+                "Retrying %s in %.2fs after %s (attempt %d)",
+                name,
+                delay,
+                reason,
+                attempt,
+            )
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+class RetryingApi:
+    """Wrap a Kubernetes API object, retrying its calls with `call`."""
+
+    def __init__(self, api: Any):
+        self._api = api
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._api, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        # wraps preserves the docstring, which kubernetes.watch inspects
+        @functools.wraps(attr)
+        def retrying(*args, **kwargs):
+            return call(name, attr, *args, **kwargs)
+
+        return retrying
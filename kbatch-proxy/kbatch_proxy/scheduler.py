@@ -0,0 +1,233 @@
+"""
+Fair-share queueing of submitted Jobs.
+
+With ``kbatch_queue_enabled``, Jobs are created suspended (``spec.suspend``)
+and labelled as queued, so the queue is persisted in Kubernetes itself rather
+than in kbatch-proxy. A background task periodically lists all kbatch Jobs and
+releases (un-suspends) queued ones while the limits in the `QueuePolicy` allow.
+
+Jobs with a higher priority (see ``kbatch_priority_classes``) are released
+first. Otherwise Jobs are released in weighted fair-share order: the next Job
+comes from the user with the fewest running Jobs relative to their weight, and
+each user's Jobs are released oldest first.
+"""
+
+import asyncio
+import datetime
+import fcntl
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import IO, Callable, Deque, Dict, List, Optional, Tuple
+
+import kubernetes.client
+from kubernetes.client.models import V1Job
+
+from . import utils
+from .patch import PRIORITY_LABEL, PROFILE_LABEL, QUEUED_LABEL, USERNAME_LABEL
+
+logger = logging.getLogger(__name__)
+
+# Reported on queued Jobs in /jobs/ responses
+QUEUE_POSITION_ANNOTATION = "kbatch.jupyter.org/queue-position"
+
+
+@dataclass
+class QueuePolicy:
+    """
+    Limits on the number of concurrently running Jobs.
+
+    Parameters
+    ----------
+    max_running_per_user : running Jobs allowed per user. None is unlimited.
+    max_running_per_profile : running Jobs allowed per user with a given profile.
+    max_running_total : running Jobs allowed across all users. None is unlimited.
+    user_weights : fair-share weight of each user, default 1. A user with weight 2
+        gets twice as many running Jobs as a user with weight 1, when contended.
+    priorities : the rank of each PriorityClass, default 0. Queued Jobs with a
+        higher ranked PriorityClass are released first, regardless of fair share.
+    """
+
+    max_running_per_user: Optional[int] = None
+    max_running_per_profile: Dict[str, int] = field(default_factory=dict)
+    max_running_total: Optional[int] = None
+    user_weights: Dict[str, float] = field(default_factory=dict)
+    priorities: Dict[str, int] = field(default_factory=dict)
+
+
+def _user(job: V1Job) -> str:
+    return (job.metadata.annotations or {}).get(USERNAME_LABEL, "")
+
+
+def _profile(job: V1Job) -> Optional[str]:
+    return (job.metadata.labels or {}).get(PROFILE_LABEL)
+
+
+def _priority_class(job: V1Job) -> Optional[str]:
+    return (job.metadata.labels or {}).get(PRIORITY_LABEL)
+
+
+def is_queued(job: V1Job) -> bool:
+    """Whether `job` is waiting in the queue."""
+    labels = job.metadata.labels or {}
+    return bool(job.spec and job.spec.suspend) and labels.get(QUEUED_LABEL) == "true"
+
+
+def is_running(job: V1Job) -> bool:
+    """Whether `job` counts against the limits: released and not finished."""
+    return utils.job_status(job) in ("running", "pending")
+
+
+def fair_share_order(
+    jobs: List[V1Job], policy: QueuePolicy, enforce_limits: bool = True
+) -> List[V1Job]:
+    """
+    The queued Jobs among `jobs`, in the order they should be released.
+
+    With `enforce_limits`, only the Jobs that can be released now are returned.
+    """
+    running: Counter = Counter()
+    running_profile: Counter = Counter()
+    # queued jobs by user, then (profile, priority class), oldest first
+    queued: Dict[str, Dict[Tuple[Optional[str], Optional[str]], Deque[V1Job]]] = {}
+
+    for job in sorted(jobs, key=lambda job: job.metadata.creation_timestamp):
+        user, profile = _user(job), _profile(job)
+        if is_queued(job):
+            group = (profile, _priority_class(job))
+            queued.setdefault(user, {}).setdefault(group, deque()).append(job)
+        elif is_running(job):
+            running[user] += 1
+            running_profile[user, profile] += 1
+
+    def admissible(user: str, profile: Optional[str]) -> bool:
+        if not enforce_limits:
+            return True
+        if (
+            policy.max_running_per_user is not None
+            and running[user] >= policy.max_running_per_user
+        ):
+            return False
+        limit = policy.max_running_per_profile.get(profile) if profile else None
+        return limit is None or running_profile[user, profile] < limit
+
+    order = []
+    total = sum(running.values())
+    while queued:
+        if enforce_limits and policy.max_running_total is not None:
+            if total >= policy.max_running_total:
+                break
+
+        best_key: Optional[Tuple[float, float, datetime.datetime]] = None
+        best: Optional[Tuple[str, Tuple[Optional[str], Optional[str]]]] = None
+        for user, groups in queued.items():
+            share = running[user] / policy.user_weights.get(user, 1)
+            for group, user_jobs in groups.items():
+                profile, priority_class = group
+                if not admissible(user, profile):
+                    continue
+                # higher priority first, then fair share, then oldest
+                key = (
+                    -policy.priorities.get(priority_class or "", 0),
+                    share,
+                    user_jobs[0].metadata.creation_timestamp,
+                )
+                if best_key is None or key < best_key:
+                    best_key, best = key, (user, group)
+        if best is None:
+            break
+
+        user, group = best
+        job = queued[user][group].popleft()
+        if not queued[user][group]:
+            del queued[user][group]
+            if not queued[user]:
+                del queued[user]
+        order.append(job)
+        running[user] += 1
+        running_profile[user, group[0]] += 1
+        total += 1
+
+    return order
+
+
+def queue_positions(
+    jobs: List[V1Job], policy: QueuePolicy
+) -> Dict[Tuple[str, str], int]:
+    """The 1-based queue position of each queued Job, by (namespace, name)."""
+    return {
+        (job.metadata.namespace, job.metadata.name): position
+        for position, job in enumerate(
+            fair_share_order(jobs, policy, enforce_limits=False), 1
+        )
+    }
+
+
+def release(
+    batch_api: kubernetes.client.BatchV1Api, policy: QueuePolicy
+) -> List[Tuple[str, str]]:
+    """
+    Release every queued Job the policy allows to run now.
+
+    Returns
+    -------
+    The ``(namespace, name)`` of each released Job.
+    """
+    jobs = batch_api.list_job_for_all_namespaces(label_selector=USERNAME_LABEL).items
+    released = []
+    for job in fair_share_order(jobs, policy):
+        name, namespace = job.metadata.name, job.metadata.namespace
+        body = {
+            "metadata": {"labels": {QUEUED_LABEL: None}},
+            "spec": {"suspend": False},
+        }
+        try:
+            batch_api.patch_namespaced_job(name, namespace, body)
+        except kubernetes.client.ApiException as e:
+            if e.status == 404:
+                # deleted while queued
+                continue
+            raise
+        logger.info("Released queued job %s/%s", namespace, name)
+        released.append((namespace, name))
+    return released
+
+
+def _try_lock(path: str) -> Optional[IO]:
+    """Take an exclusive lock on `path`, so only one worker releases jobs."""
+    f = open(path, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+async def release_forever(
+    get_batch_api: Callable[[], kubernetes.client.BatchV1Api],
+    interval_seconds: float,
+    policy: QueuePolicy,
+    lock_path: str,
+) -> None:
+    """
+    Run `release` every `interval_seconds`, until cancelled.
+
+    Only the worker process holding the lock at `lock_path` releases jobs.
+    The others wait, to take over if it exits. The lock is local to the pod,
+    so the queue needs a single kbatch-proxy replica.
+    """
+    lock = None
+    try:
+        while True:
+            if lock is None:
+                lock = _try_lock(lock_path)
+            if lock is not None:
+                try:
+                    await asyncio.to_thread(release, get_batch_api(), policy)
+                except Exception:
+                    logger.exception("Error releasing queued jobs")
+            await asyncio.sleep(interval_seconds)
+    finally:
+        if lock is not None:
+            lock.close()
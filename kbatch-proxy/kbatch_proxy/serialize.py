@@ -0,0 +1,122 @@
+"""
+Fast JSON serialization of Kubernetes API results.
+
+Endpoints return Kubernetes objects as ``to_dict()`` renders them, with
+snake_case keys. Deserializing a response into the Kubernetes models, walking
+them with ``to_dict()`` and encoding that with FastAPI's ``jsonable_encoder``
+takes seconds for thousands of Jobs. Instead:
+
+* `from_response` converts the raw JSON of a response requested with
+  ``_preload_content=False`` straight to the same data, renaming keys by the
+  models' schemas, without building the models.
+* `to_jsonable` converts models we already have in a single pass.
+* `dumps` and `json_response` render the result with orjson, bypassing
+  ``jsonable_encoder``.
+"""
+
+import datetime
+import re
+from typing import Any, Dict, Tuple
+
+import dateutil.parser
+import kubernetes.client.models
+import orjson
+from fastapi import Response
+
+_list_xpr = re.compile(r"^list\[(.*)\]$")
+_dict_xpr = re.compile(r"^dict\(([^,]*), (.*)\)$")
+_primitives = (str, int, float, bool, type(None))
+# Kubernetes timestamps, e.g. 2024-01-01T00:00:00Z
+_timestamp_xpr = re.compile(r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$")
+
+# model name -> JSON key -> (attribute, type)
+_schemas: Dict[str, Dict[str, Tuple[str, str]]] = {}
+
+
+def _schema(model_name: str) -> Dict[str, Tuple[str, str]]:
+    schema = _schemas.get(model_name)
+    if schema is None:
+        model = getattr(kubernetes.client.models, model_name)
+        schema = {
+            model.attribute_map[attr]: (attr, type_)
+            for attr, type_ in model.openapi_types.items()
+        }
+        _schemas[model_name] = schema
+    return schema
+
+
+def _isoformat(value: str) -> str:
+    """A timestamp as the models would render it, e.g. with +00:00 for Z."""
+    if _timestamp_xpr.match(value):
+        return value[:-1] + "+00:00"
+    # what the Kubernetes client deserializes with
+    return dateutil.parser.parse(value).isoformat()
+
+
+def _convert(data: Any, type_: str) -> Any:
+    if data is None or type_ in ("str", "int", "bool", "object", "date"):
+        return data
+    elif type_ == "float":
+        return float(data)
+    elif type_ == "datetime":
+        return _isoformat(data)
+
+    m = _list_xpr.match(type_)
+    if m:
+        item_type = m.group(1)
+        return [_convert(item, item_type) for item in data]
+    m = _dict_xpr.match(type_)
+    if m:
+        value_type = m.group(2)
+        return {k: _convert(v, value_type) for k, v in data.items()}
+
+    schema = _schema(type_)
+    # like to_dict(), every attribute is included, unknown keys are dropped
+    result: Dict[str, Any] = {attr: None for attr, _ in schema.values()}
+    for key, value in data.items():
+        field = schema.get(key)
+        if field is not None:
+            result[field[0]] = _convert(value, field[1])
+    return result
+
+
+def from_response(response: Any, model_name: str) -> Any:
+    """
+    The JSON-ready data of a Kubernetes API response for `model_name`.
+
+    Parameters
+    ----------
+    response : the result of a Kubernetes API call with ``_preload_content=False``.
+        A model, e.g. from a mocked API, is converted with `to_jsonable`.
+    model_name : the model the response would be deserialized to, e.g. "V1JobList".
+    """
+    if isinstance(response, getattr(kubernetes.client.models, model_name)):
+        return to_jsonable(response)
+    return _convert(orjson.loads(response.data), model_name)
+
+
+def to_jsonable(obj: Any) -> Any:
+    """
+    A Kubernetes model as JSON-ready data.
+
+    The same as ``jsonable_encoder(obj.to_dict())``, in a single pass.
+    """
+    if isinstance(obj, _primitives):
+        return obj
+    elif isinstance(obj, list):
+        return [to_jsonable(item) for item in obj]
+    elif isinstance(obj, dict):
+        return {k: to_jsonable(v) for k, v in obj.items()}
+    elif isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return {attr: to_jsonable(getattr(obj, attr)) for attr in obj.openapi_types}
+
+
+def dumps(data: Any) -> bytes:
+    """Render JSON-ready `data` with orjson."""
+    return orjson.dumps(data)
+
+
+def json_response(data: Any, **kwargs) -> Response:
+    """A response with JSON-ready `data`, rendered with orjson."""
+    return Response(dumps(data), media_type="application/json", **kwargs)
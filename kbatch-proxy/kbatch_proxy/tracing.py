@@ -0,0 +1,173 @@
+"""
+Lightweight request tracing for kbatch-proxy.
+
+Spans follow the OpenTelemetry data model (trace and span IDs, parent span,
+start and end times in nanoseconds, attributes and status) and are exported
+as JSON lines to ``kbatch_tracing_file``. Point that at a file tailed by
+your collector, or read it directly.
+
+Every request gets a request ID, taken from the ``X-Kbatch-Request-Id``
+header if the client sent one and generated otherwise. It is echoed back in
+the response and attached to every span, so a slow ``kbatch`` invocation can
+be matched with the proxy's traces.
+"""
+
+import contextvars
+import json
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import IO, Any, Dict, Iterator, Optional
+
+REQUEST_ID_HEADER = "X-Kbatch-Request-Id"
+_request_id_header = REQUEST_ID_HEADER.lower().encode("latin-1")
+# don't trust arbitrary client input into logs and traces
+_valid_request_id = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "kbatch_request_id", default=None
+)
+_trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "kbatch_trace_id", default=None
+)
+_span_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "kbatch_span_id", default=None
+)
+
+
+class FileExporter:
+    """Append finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+
+    def export(self, span: Dict[str, Any]) -> None:
+        line = json.dumps(span, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_exporter: Optional[FileExporter] = None
+
+
+def configure(path: Optional[str]) -> None:
+    """Export spans to `path`. Tracing is disabled if `path` is None."""
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = FileExporter(path) if path else None
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Record the enclosed block as a span named `name`.
+
+    Spans opened inside the block are its children. Yields the attributes,
+    which may be updated before the block exits. A no-op when tracing is
+    disabled.
+    """
+    if _exporter is None:
+        yield attributes
+        return
+
+    trace_id = _trace_id_var.get()
+    trace_token = None
+    if trace_id is None:
+        trace_id = uuid.uuid4().hex
+        trace_token = _trace_id_var.set(trace_id)
+    parent_id = _span_id_var.get()
+    span_id = uuid.uuid4().hex[:16]
+    span_token = _span_id_var.set(span_id)
+
+    status = "OK"
+    start = time.time_ns()
+    try:
+        yield attributes
+    except BaseException as e:
+        status = "ERROR"
+        attributes["exception.type"] = type(e).__name__
+        raise
+    finally:
+        end = time.time_ns()
+        _span_id_var.reset(span_token)
+        if trace_token is not None:
+            _trace_id_var.reset(trace_token)
+        _exporter.export(
+            {
+                "name": name,
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "parent_span_id": parent_id,
+                "request_id": request_id_var.get(),
+                "start_time_unix_nano": start,
+                "end_time_unix_nano": end,
+                "attributes": attributes,
+                "status": status,
+            }
+        )
+
+
+def _get_request_id(scope) -> str:
+    for key, value in scope["headers"]:
+        if key == _request_id_header:
+            request_id = value.decode("latin-1")
+            if _valid_request_id.match(request_id):
+                return request_id
+            break
+    return uuid.uuid4().hex
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware assigning each request an ID and tracing it.
+
+    The request ID is echoed in the ``X-Kbatch-Request-Id`` response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = _get_request_id(scope)
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (_request_id_header, request_id.encode("latin-1"))
+                ]
+                attributes["http.status_code"] = message["status"]
+            await send(message)
+
+        try:
+            with span(
+                f"{scope['method']} {scope['path']}", **{"http.method": scope["method"]}
+            ) as attributes:
+                await self.app(scope, receive, send_wrapper)
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    attributes["http.route"] = route
+        finally:
+            request_id_var.reset(token)
@@ -1,4 +1,9 @@
+import datetime
+import hashlib
+import json
 import re
+from collections import Counter
+from typing import Dict, Iterable, Optional
 
 import kubernetes.client.models
 
@@ -94,3 +99,199 @@ def remove_nulls(d):
             remove_nulls(v)
     for k in remove:
         del d[k]
+
+
+JOB_STATUSES = ["failed", "running", "pending", "done", "queued"]
+
+
+def job_status(job: kubernetes.client.models.V1Job) -> str:
+    """
+    The status of a Job: "failed", "running", "pending", "done" or "queued".
+
+    Follows the same rules as ``kbatch._core.job_status``. A Job
+    the controller hasn't reported any pods for yet is "pending", and a
+    suspended Job (see `scheduler`) is "queued".
+    """
+    status = job.status or kubernetes.client.models.V1JobStatus()
+    # these vales may be None, treat as 0
+    if job.spec is not None and job.spec.suspend:
+        if not (status.failed or status.succeeded):
+            return "queued"
+    if status.failed:
+        return "failed"
+    elif status.ready:
+        return "running"
+    elif status.active:
+        return "pending"
+    elif status.succeeded:
+        # succeeded last because in multi-pod cases
+        # only report success when they _all_ succeed
+        return "done"
+    else:
+        return "pending"
+
+
+def job_end_time(job: kubernetes.client.models.V1Job) -> Optional[datetime.datetime]:
+    """When a Job finished, or None if it is still running."""
+    status = job.status
+    if status.succeeded:
+        return status.completion_time
+    elif status.failed:
+        for condition in status.conditions or []:
+            if condition.type == "Failed":
+                return condition.last_transition_time
+    return None
+
+
+def job_runtime(
+    job: kubernetes.client.models.V1Job, now: datetime.datetime
+) -> Optional[float]:
+    """
+    The number of seconds a Job has been running for, or None if it hasn't started.
+
+    Mirrors ``kbatch._core.duration``.
+    """
+    status = job.status
+    if status is None or status.start_time is None:
+        return None
+    if status.succeeded or status.failed:
+        end_time = job_end_time(job)
+        if end_time is None:
+            return None
+    else:
+        end_time = now
+    return (end_time - status.start_time).total_seconds()
+
+
+def summarize_jobs(
+    jobs: Iterable[kubernetes.client.models.V1Job],
+    now: Optional[datetime.datetime] = None,
+    max_recent_failures: int = 10,
+) -> Dict:
+    """
+    Aggregate statistics for a collection of Jobs.
+
+    Returns a dict with
+
+    * ``counts``: the number of Jobs with each status (see `job_status`)
+    * ``total``: the total number of Jobs
+    * ``total_runtime_seconds``: the summed runtime of all the Jobs
+    * ``recent_failures``: the most recently failed Jobs, newest first
+    """
+    now = now or datetime.datetime.now(tz=datetime.timezone.utc)
+    counts: Counter = Counter({status: 0 for status in JOB_STATUSES})
+    total_runtime = 0.0
+    failures = []
+
+    for job in jobs:
+        status = job_status(job)
+        counts[status] += 1
+        runtime = job_runtime(job, now)
+        if runtime is not None:
+            total_runtime += runtime
+        if status == "failed":
+            failures.append(
+                {
+                    "name": job.metadata.name,
+                    "namespace": job.metadata.namespace,
+                    "failed_at": job_end_time(job),
+                }
+            )
+
+    failures.sort(
+        key=lambda f: f["failed_at"]
+        or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+        reverse=True,
+    )
+    return {
+        "counts": dict(counts),
+        "total": sum(counts.values()),
+        "total_runtime_seconds": total_runtime,
+        "recent_failures": failures[:max_recent_failures],
+    }
+
+
+def get_field(d, key: str):
+    """
+    The field `key` of the submitted JSON object `d`, or None.
+
+    Submissions may use the snake_case attribute names of the Kubernetes
+    models, or the camelCase names of the API.
+    """
+    if not isinstance(d, dict):
+        return None
+    if key in d:
+        return d[key]
+    first, *rest = key.split("_")
+    return d.get(first + "".join(word.title() for word in rest))
+
+
+_label_value_xpr = re.compile(r"^(([A-Za-z0-9][-A-Za-z0-9_.]*)?[A-Za-z0-9])?$")
+
+
+def is_label_value(value: str) -> bool:
+    """Whether `value` can be the value of a Kubernetes label."""
+    return len(value) <= 63 and _label_value_xpr.match(value) is not None
+
+
+_duration_units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+_duration_xpr = re.compile(r"^(\d+)([smhd]?)$")
+
+
+def parse_duration(value: str) -> int:
+    """
+    Parse a duration like ``"90"``, ``"30m"``, ``"12h"`` or ``"7d"`` into seconds.
+    """
+    m = _duration_xpr.match(value.strip())
+    if not m:
+        raise ValueError(
+            f"Invalid duration {value!r}. Expected an integer number of seconds "
+            "optionally followed by one of 's', 'm', 'h' or 'd'."
+        )
+    number, unit = m.groups()
+    return int(number) * _duration_units[unit or "s"]
+
+
+def etag(data) -> str:
+    """
+    A strong ETag for the JSON-serializable `data`.
+    """
+    body = json.dumps(data, sort_keys=True, default=str).encode()
+    return '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+
+def resource_etag(data: dict) -> str:
+    """
+    A weak ETag for a Kubernetes object, or list of objects, as served.
+
+    It's derived from the objects' resourceVersions rather than the list's,
+    which changes whenever anything in the cluster does. Annotations are
+    included for those kbatch-proxy adds, like queue positions.
+    """
+    items = data.get("items")
+    if items is None:
+        items = [data]
+    versions = []
+    for item in items:
+        metadata = item.get("metadata") or {}
+        versions.append(
+            (
+                metadata.get("uid"),
+                metadata.get("resource_version"),
+                metadata.get("annotations"),
+            )
+        )
+    return "W/" + etag(versions)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether an ``If-None-Match`` header matches `etag`.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, as If-None-Match requires
+    candidates = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag.removeprefix("W/") in candidates
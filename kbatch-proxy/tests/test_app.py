@@ -1,10 +1,27 @@
+import asyncio
+import base64
+import concurrent.futures
+import datetime
+import gzip
+import json
 import os
 import pathlib
 import subprocess
 import sys
+import threading
+import time
+from unittest import mock
 
+import httpx
+import kbatch_proxy.main
+import kbatch_proxy.profiles
+import kbatch_proxy.retry
+import kubernetes.client
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from kbatch_proxy.admission import AdmissionMiddleware, RateLimiter, route_class
+from kbatch_proxy.cache import SingleFlight, TTLCache
 from kbatch_proxy.main import app
 
 client = TestClient(app)
@@ -27,6 +44,13 @@ def mock_hub_auth(mocker):
                 "groups": [],
                 "scopes": ["access:servers!user=testuser2"],
             }
+        elif token == "admin":
+            return {
+                "name": "testadmin",
+                "groups": [],
+                "scopes": ["access:services"],
+                "admin": True,
+            }
         else:
             return None
 
@@ -58,7 +82,797 @@ def test_authorized(mock_hub_auth):
 
 def test_loads_profile():
     profile = str(HERE / "profile_template.yaml")
-    code = "import asyncio; from kbatch_proxy.main import profiles; assert asyncio.run(profiles())"
+    code = "import kbatch_proxy.main; assert kbatch_proxy.profiles.current.profiles"
     subprocess.check_output(
         f"KBATCH_PROFILE_FILE={profile} {sys.executable} -c '{code}'", shell=True
     )
+
+
+def test_profiles_etag(mocker):
+    config = kbatch_proxy.profiles.Config({"gpu": {"image": "gpu"}})
+    mocker.patch.object(kbatch_proxy.profiles, "current", config)
+    etag = config.profiles_etag
+
+    response = client.get("/profiles/")
+    assert response.status_code == 200
+    assert response.json() == {"gpu": {"image": "gpu"}}
+    assert response.headers["ETag"] == etag
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    response = client.get("/profiles/", headers={"If-None-Match": f"W/{etag}"})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    response = client.get("/profiles/", headers={"If-None-Match": '"v0", "v2"'})
+    assert response.status_code == 200
+
+
+def make_job(name, age=0, **status):
+    created = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+        seconds=age
+    )
+    return kubernetes.client.V1Job(
+        metadata=kubernetes.client.V1ObjectMeta(name=name, creation_timestamp=created),
+        status=kubernetes.client.V1JobStatus(**status),
+    )
+
+
+@pytest.fixture
+def batch_api(mocker):
+    batch_api = mock.Mock()
+    batch_api.list_namespaced_job.return_value = kubernetes.client.V1JobList(
+        items=[
+            make_job("failed-old", age=7200, failed=1),
+            make_job("failed-new", failed=1),
+            make_job("running", ready=1, active=1),
+            make_job("done", age=7200, succeeded=1),
+        ]
+    )
+    mocker.patch("kbatch_proxy.main.get_k8s_api", return_value=(mock.Mock(), batch_api))
+    return batch_api
+
+
+def test_delete_jobs_requires_filter(batch_api):
+    headers = {"Authorization": "token abc"}
+    response = client.delete("/jobs/", headers=headers)
+    assert response.status_code == 400
+
+    response = client.delete("/jobs/?status=bogus", headers=headers)
+    assert response.status_code == 400
+
+    response = client.delete("/jobs/?older_than=soon", headers=headers)
+    assert response.status_code == 400
+    batch_api.list_namespaced_job.assert_not_called()
+
+
+def test_delete_jobs_selector(batch_api):
+    # what the API server deleted, e.g. including a Job created since listing
+    deleted = {
+        "kind": "JobList",
+        "items": [{"metadata": {"name": "running"}}, {"metadata": {"name": "new"}}],
+    }
+    batch_api.delete_collection_namespaced_job.return_value = mock.Mock(
+        data=json.dumps(deleted).encode()
+    )
+    response = client.delete(
+        "/jobs/?selector=sweep=1", headers={"Authorization": "token abc"}
+    )
+    assert response.status_code == 200
+    assert response.json()["deleted"] == ["running", "new"]
+    batch_api.list_namespaced_job.assert_not_called()
+    batch_api.delete_collection_namespaced_job.assert_called_once_with(
+        "kbatch-testuser",
+        propagation_policy="Foreground",
+        _preload_content=False,
+        label_selector="sweep=1",
+    )
+    batch_api.delete_namespaced_job.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("status=failed", ["failed-old", "failed-new"]),
+        ("older_than=1h", ["failed-old", "done"]),
+        ("status=failed&older_than=1h", ["failed-old"]),
+    ],
+)
+def test_delete_jobs_filtered(batch_api, query, expected):
+    response = client.delete(f"/jobs/?{query}", headers={"Authorization": "token abc"})
+    assert response.status_code == 200
+    assert response.json()["deleted"] == expected
+    batch_api.delete_collection_namespaced_job.assert_not_called()
+    assert batch_api.delete_namespaced_job.call_args_list == [
+        mock.call(name, "kbatch-testuser", propagation_policy="Foreground")
+        for name in expected
+    ]
+
+
+def test_jobs_summary(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    response = client.get("/jobs/summary", headers={"Authorization": "token abc"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["counts"] == {
+        "failed": 2,
+        "running": 1,
+        "pending": 0,
+        "done": 1,
+        "queued": 0,
+    }
+    assert result["total"] == 4
+    assert [f["name"] for f in result["recent_failures"]] == [
+        "failed-old",
+        "failed-new",
+    ]
+
+    # served from the cache
+    client.get("/jobs/summary", headers={"Authorization": "token abc"})
+    batch_api.list_namespaced_job.assert_called_once_with("kbatch-testuser")
+
+
+def test_jobs_summary_all(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    jobs = batch_api.list_namespaced_job.return_value.items
+    for i, job in enumerate(jobs):
+        job.metadata.namespace = f"kbatch-user{i % 2}"
+    jobs.append(make_job("not-kbatch"))
+    jobs[-1].metadata.namespace = "default"
+    batch_api.list_job_for_all_namespaces.return_value = kubernetes.client.V1JobList(
+        items=jobs
+    )
+
+    response = client.get("/jobs/summary/all", headers={"Authorization": "token abc"})
+    assert response.status_code == 403
+
+    response = client.get("/jobs/summary/all", headers={"Authorization": "token admin"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["total"] == 4
+    assert result["namespaces"] == {
+        "kbatch-user0": {
+            "failed": 1,
+            "running": 1,
+            "pending": 0,
+            "done": 0,
+            "queued": 0,
+        },
+        "kbatch-user1": {
+            "failed": 1,
+            "running": 0,
+            "pending": 0,
+            "done": 1,
+            "queued": 0,
+        },
+    }
+
+
+def test_read_jobs_queue_position(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    mocker.patch.object(kbatch_proxy.main.settings, "kbatch_queue_enabled", True)
+    jobs = batch_api.list_namespaced_job.return_value.items
+
+    # nothing queued, so the other namespaces aren't listed
+    response = client.get("/jobs/", headers={"Authorization": "token abc"})
+    assert response.status_code == 200
+    batch_api.list_job_for_all_namespaces.assert_not_called()
+
+    queued = make_job("queued", age=60)
+    queued.spec = kubernetes.client.V1JobSpec(
+        template=kubernetes.client.V1PodTemplateSpec(), suspend=True
+    )
+    queued.metadata.labels = {"kbatch.jupyter.org/queued": "true"}
+    jobs.append(queued)
+    for job in jobs:
+        job.metadata.namespace = "kbatch-testuser"
+        job.metadata.annotations = {"kbatch.jupyter.org/username": "testuser"}
+    batch_api.list_job_for_all_namespaces.return_value = kubernetes.client.V1JobList(
+        items=jobs
+    )
+
+    response = client.get("/jobs/", headers={"Authorization": "token abc"})
+    assert response.status_code == 200
+    positions = {
+        item["metadata"]["name"]: item["metadata"]["annotations"].get(
+            "kbatch.jupyter.org/queue-position"
+        )
+        for item in response.json()["items"]
+    }
+    assert positions["queued"] == "1"
+    assert positions["running"] is None
+
+
+def test_list_cache(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "list_flight", SingleFlight(ttl=60))
+    coalesced = kbatch_proxy.metrics.COALESCED_REQUESTS.labels("jobs")
+    before = coalesced._value.get()
+    headers = {"Authorization": "token abc"}
+
+    first = client.get("/jobs/", headers=headers)
+    second = client.get("/jobs/", headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert batch_api.list_namespaced_job.call_count == 1
+    assert coalesced._value.get() == before + 1
+
+    # another user's jobs aren't shared
+    client.get("/jobs/", headers={"Authorization": "token admin"})
+    assert batch_api.list_namespaced_job.call_count == 2
+
+
+def test_conditional_get(batch_api, mocker):
+    headers = {"Authorization": "token abc"}
+    response = client.get("/jobs/", headers=headers)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    response = client.get("/jobs/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    batch_api.list_namespaced_job.return_value.items[0].metadata.resource_version = "2"
+    response = client.get("/jobs/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    job = make_job("job")
+    batch_api.read_namespaced_job.return_value = job
+    response = client.get("/jobs/job", headers=headers)
+    assert response.json()["metadata"]["name"] == "job"
+    etag = response.headers["ETag"]
+    response = client.get("/jobs/job", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_kubernetes_calls_off_event_loop(batch_api):
+    def slow_read(*args, **kwargs):
+        # e.g. backing off before a retry
+        time.sleep(0.3)
+        return make_job("job")
+
+    batch_api.read_namespaced_job.side_effect = slow_read
+    headers = {"Authorization": "token abc"}
+
+    async def read_jobs():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://kbatch"
+        ) as async_client:
+            return await asyncio.gather(
+                *(async_client.get("/jobs/job", headers=headers) for _ in range(4))
+            )
+
+    start = time.monotonic()
+    responses = asyncio.run(read_jobs())
+    assert [r.status_code for r in responses] == [200] * 4
+    # concurrent, rather than one after another on the event loop
+    assert time.monotonic() - start < 0.9
+
+
+def test_kubernetes_unavailable(batch_api):
+    batch_api.list_namespaced_job.side_effect = kbatch_proxy.retry.CircuitOpenError(
+        retry_after=12
+    )
+    response = client.get("/jobs/", headers={"Authorization": "token abc"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "12"
+    assert "unavailable" in response.json()["detail"]
+    # the proxy may have done some of the work
+    assert "X-Kbatch-Unprocessed" not in response.headers
+
+
+def test_create_job_owner_patch_fails(k8s_apis):
+    api, batch_api = k8s_apis
+    api.patch_namespaced_secret.side_effect = kbatch_proxy.retry.CircuitOpenError(
+        retry_after=12
+    )
+    response = client.post(
+        "/jobs/", json=submission(), headers={"Authorization": "token abc"}
+    )
+    # the job was created, so retrying the submission would duplicate it
+    assert response.status_code == 200
+    assert "Retry-After" not in response.headers
+    assert response.json()["metadata"]["name"] == "job"
+    batch_api.create_namespaced_job.assert_called_once()
+
+
+def test_metrics(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    client.get("/jobs/summary", headers={"Authorization": "token abc"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert (
+        'kbatch_proxy_request_duration_seconds_count{method="GET",'
+        'route="/jobs/summary",status="200"}'
+    ) in response.text
+
+
+def test_metrics_submissions(mocker):
+    mocker.patch.object(
+        kbatch_proxy.profiles, "current", kbatch_proxy.profiles.Config({"gpu": {}})
+    )
+    mocker.patch("kbatch_proxy.main._create_job", return_value={"mock": "job"})
+
+    def count(profile, outcome):
+        return kbatch_proxy.metrics.SUBMISSIONS.labels(
+            "job", profile, outcome
+        )._value.get()
+
+    before = count("gpu", "success")
+    response = client.post(
+        "/jobs/",
+        json={"job": {}, "profile": "gpu"},
+        headers={"Authorization": "token abc"},
+    )
+    assert response.status_code == 200
+    assert count("gpu", "success") == before + 1
+
+    before = count("unknown", "error")
+    kbatch_proxy.main._create_job.side_effect = ValueError
+    with pytest.raises(ValueError):
+        client.post(
+            "/jobs/",
+            json={"job": {}, "profile": "not-a-profile"},
+            headers={"Authorization": "token abc"},
+        )
+    assert count("unknown", "error") == before + 1
+
+
+def test_compressed_requests(mocker):
+    create_job = mocker.patch(
+        "kbatch_proxy.main._create_job", return_value={"mock": "job"}
+    )
+    headers = {"Authorization": "token abc", "Content-Type": "application/json"}
+    data = {"job": {}, "code": "x" * 10_000}
+
+    response = client.post(
+        "/jobs/",
+        content=gzip.compress(json.dumps(data).encode()),
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert create_job.call_args[0][0] == data
+    assert "gzip" in response.headers["Accept-Encoding"]
+
+    response = client.post(
+        "/jobs/",
+        content=b"not gzip",
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/jobs/",
+        content=gzip.compress(b"[1"),
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/jobs/", content=b"{}", headers={**headers, "Content-Encoding": "br"}
+    )
+    assert response.status_code == 415
+    assert "gzip" in response.headers["Accept-Encoding"]
+
+    mocker.patch.object(kbatch_proxy.main.settings, "kbatch_max_request_bytes", 1000)
+    response = client.post(
+        "/jobs/",
+        content=gzip.compress(json.dumps(data).encode()),
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 413
+
+
+def test_invalid_submission(mocker):
+    create_job = mocker.patch(
+        "kbatch_proxy.main._create_job", return_value={"mock": "job"}
+    )
+    headers = {"Authorization": "token abc"}
+
+    for data in [[], {"job": {}, "profile": {"name": "default"}}]:
+        response = client.post("/jobs/", json=data, headers=headers)
+        assert response.status_code == 400
+        response = client.post("/cronjobs/", json=data, headers=headers)
+        assert response.status_code == 400
+    assert not create_job.called
+
+
+@pytest.fixture
+def k8s_apis(mocker):
+    """Kubernetes APIs creating the objects they're given."""
+    api, batch_api = mock.Mock(), mock.Mock()
+    api.create_namespaced_secret.side_effect = lambda namespace, body: body
+    batch_api.create_namespaced_job.side_effect = lambda namespace, body: body
+    batch_api.create_namespaced_cron_job.side_effect = lambda namespace, body: body
+    mocker.patch("kbatch_proxy.main.get_k8s_api", return_value=(api, batch_api))
+    return api, batch_api
+
+
+def submission(kind="Job", profile=None, **pod_spec):
+    """A submission, as sent by the kbatch client."""
+    pod_spec.setdefault("containers", [{"name": "job", "image": "python"}])
+    template = {
+        "metadata": {"annotations": {}, "labels": {}},
+        "spec": {
+            "template": {
+                "metadata": {"annotations": {}, "labels": {}},
+                "spec": pod_spec,
+            }
+        },
+    }
+    if kind == "Job":
+        spec = template["spec"]
+    else:
+        spec = {"schedule": "0 * * * *", "job_template": template}
+    job = {
+        "api_version": "batch/v1",
+        "kind": kind,
+        "metadata": {"name": "job", "uid": "1", "annotations": {}, "labels": {}},
+        "spec": spec,
+    }
+    data = {"job": job}
+    if profile is not None:
+        data["profile"] = profile
+    return data
+
+
+@pytest.mark.parametrize(
+    "profile, labelled",
+    [("gpu", True), ("Python (default)", False), ("x" * 64, False)],
+)
+def test_profile_label(mocker, k8s_apis, profile, labelled):
+    config = kbatch_proxy.profiles.Config({profile: {}})
+    mocker.patch.object(kbatch_proxy.profiles, "current", config)
+
+    response = client.post(
+        "/jobs/",
+        json=submission(profile=profile),
+        headers={"Authorization": "token abc"},
+    )
+    assert response.status_code == 200
+    labels = response.json()["metadata"]["labels"]
+    assert (kbatch_proxy.patch.PROFILE_LABEL in labels) == labelled
+
+
+def test_profile_verified(mocker, k8s_apis):
+    config = kbatch_proxy.profiles.Config(
+        {"gpu": {"resources": {"limits": {"nvidia.com/gpu": 1}}}}
+    )
+    mocker.patch.object(kbatch_proxy.profiles, "current", config)
+    headers = {"Authorization": "token abc"}
+    gpu_containers = [
+        {
+            "name": "job",
+            "image": "python",
+            "resources": {"limits": {"nvidia.com/gpu": "1"}},
+        }
+    ]
+
+    # naming the profile without its resources
+    response = client.post("/jobs/", json=submission(profile="gpu"), headers=headers)
+    assert response.status_code == 400
+    assert "doesn't match the profile 'gpu'" in response.json()["detail"]
+
+    # the profile's resources without naming it
+    response = client.post(
+        "/jobs/", json=submission(containers=gpu_containers), headers=headers
+    )
+    assert response.status_code == 200
+    labels = response.json()["metadata"]["labels"]
+    assert labels[kbatch_proxy.patch.PROFILE_LABEL] == "gpu"
+
+
+def test_priority_claim_verified(mocker, k8s_apis):
+    urgent = {
+        "resources": {"limits": {"cpu": 1}},
+        "priority_class_name": "interactive",
+    }
+    config = kbatch_proxy.profiles.Config({"urgent": urgent, "cpu": {}})
+    mocker.patch.object(kbatch_proxy.profiles, "current", config)
+    _, batch_api = k8s_apis
+    headers = {"Authorization": "token abc"}
+
+    def containers(cpu):
+        resources = {"limits": {"cpu": cpu}}
+        return [{"name": "job", "image": "python", "resources": resources}]
+
+    # claiming the urgent profile for a larger job
+    data = submission(
+        profile="urgent", containers=containers("64"), priority_class_name="interactive"
+    )
+    response = client.post("/jobs/", json=data, headers=headers)
+    assert response.status_code == 400
+    batch_api.create_namespaced_job.assert_not_called()
+
+    data = submission(
+        profile="urgent", containers=containers("1"), priority_class_name="interactive"
+    )
+    response = client.post("/jobs/", json=data, headers=headers)
+    assert response.status_code == 200
+    job = response.json()
+    assert job["spec"]["template"]["spec"]["priority_class_name"] == "interactive"
+    assert job["metadata"]["labels"][kbatch_proxy.patch.PRIORITY_LABEL] == "interactive"
+
+
+def test_cronjob_queued(mocker, k8s_apis):
+    mocker.patch.object(kbatch_proxy.main.settings, "kbatch_queue_enabled", True)
+    response = client.post(
+        "/cronjobs/",
+        json=submission("CronJob"),
+        headers={"Authorization": "token abc"},
+    )
+    assert response.status_code == 200
+    # each Job the CronJob creates waits in the queue
+    job_template = response.json()["spec"]["job_template"]
+    assert job_template["spec"]["suspend"]
+    assert job_template["metadata"]["labels"][kbatch_proxy.patch.QUEUED_LABEL] == "true"
+
+
+def test_multipart_submission(mocker):
+    create_job = mocker.patch(
+        "kbatch_proxy.main._create_job", return_value={"mock": "job"}
+    )
+    headers = {"Authorization": "token abc"}
+    config_map = {"kind": "ConfigMap", "metadata": {"generate_name": "job-"}}
+    data = {"job": {}, "code": config_map}
+    code = bytes(range(256))
+
+    response = client.post(
+        "/jobs/",
+        data={"data": json.dumps(data)},
+        files={"code": ("code.zip", code, "application/zip")},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.headers["Accept-Post"] == "application/json, multipart/form-data"
+    submitted = create_job.call_args[0][0]
+    assert submitted["code"]["metadata"] == config_map["metadata"]
+    assert base64.b64decode(submitted["code"]["binary_data"]["code"]) == code
+
+    # without code
+    response = client.post(
+        "/cronjobs/",
+        data={"data": json.dumps({"job": {}})},
+        files={"unused": ("unused", b"", "application/octet-stream")},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert create_job.call_args[0][0] == {"job": {}}
+
+    response = client.post(
+        "/jobs/",
+        data={"data": json.dumps({"job": {}})},
+        files={"code": ("code.zip", code, "application/zip")},
+        headers=headers,
+    )
+    assert response.status_code == 400
+
+    for invalid in ["[1", "[1]", "null"]:
+        response = client.post(
+            "/jobs/",
+            data={"data": invalid},
+            files={"code": ("code.zip", code, "application/zip")},
+            headers=headers,
+        )
+        assert response.status_code == 400
+
+    mocker.patch.object(kbatch_proxy.main.settings, "kbatch_max_request_bytes", 100)
+    response = client.post(
+        "/jobs/",
+        data={"data": json.dumps(data)},
+        files={"code": ("code.zip", code, "application/zip")},
+        headers=headers,
+    )
+    assert response.status_code == 413
+
+
+def test_compressed_responses(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    batch_api.list_namespaced_job.return_value = kubernetes.client.V1JobList(
+        items=[make_job(f"job-{i}", succeeded=1) for i in range(50)]
+    )
+    response = client.get(
+        "/jobs/",
+        headers={"Authorization": "token abc", "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()["items"]) == 50
+
+    # small responses aren't worth compressing
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+@pytest.fixture
+def traces(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    kbatch_proxy.tracing.configure(str(path))
+    yield path
+    kbatch_proxy.tracing.configure(None)
+
+
+def test_tracing(traces, batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    # wrap the mocked API, like get_k8s_api does
+    mocker.patch(
+        "kbatch_proxy.main.get_k8s_api",
+        return_value=(None, kbatch_proxy.metrics.InstrumentedApi(batch_api)),
+    )
+    response = client.get(
+        "/jobs/summary",
+        headers={"Authorization": "token abc", "X-Kbatch-Request-Id": "my-request"},
+    )
+    assert response.headers["X-Kbatch-Request-Id"] == "my-request"
+
+    spans = {
+        span["name"]: span for span in map(json.loads, traces.read_text().splitlines())
+    }
+    assert set(spans) == {
+        "GET /jobs/summary",
+        "get_current_user",
+        "kubernetes.list_namespaced_job",
+    }
+    root = spans["GET /jobs/summary"]
+    assert root["parent_span_id"] is None
+    assert root["attributes"]["http.route"] == "/jobs/summary"
+    assert root["attributes"]["http.status_code"] == 200
+    for name in ["get_current_user", "kubernetes.list_namespaced_job"]:
+        assert spans[name]["parent_span_id"] == root["span_id"]
+        assert spans[name]["trace_id"] == root["trace_id"]
+    assert {span["request_id"] for span in spans.values()} == {"my-request"}
+
+
+def test_request_id_generated():
+    response = client.get("/", headers={"X-Kbatch-Request-Id": "bad id\n"})
+    request_id = response.headers["X-Kbatch-Request-Id"]
+    assert request_id != "bad id\n"
+    assert len(request_id) == 32
+
+
+@pytest.fixture
+def slow_batch_api(batch_api):
+    jobs = batch_api.list_namespaced_job.return_value
+
+    def slow_list(*args, **kwargs):
+        time.sleep(0.05)
+        return jobs
+
+    batch_api.list_namespaced_job.side_effect = slow_list
+    return batch_api
+
+
+@pytest.fixture
+def profiling_dir(tmp_path):
+    kbatch_proxy.profiling.configure(directory=str(tmp_path), interval_seconds=0.001)
+    yield tmp_path
+    kbatch_proxy.profiling.configure()
+
+
+def test_profile_requires_admin(slow_batch_api, profiling_dir):
+    response = client.get(
+        "/jobs/?kbatch_profile=inline", headers={"Authorization": "token abc"}
+    )
+    assert response.status_code == 403
+
+    response = client.get(
+        "/jobs/?kbatch_profile=bogus", headers={"Authorization": "token admin"}
+    )
+    assert response.status_code == 400
+
+    # public routes aren't authenticated, so can't be profiled on request
+    response = client.get("/profiles/?kbatch_profile=inline")
+    assert response.status_code == 200
+    assert "X-Kbatch-Profile" not in response.headers
+
+
+def test_profile_inline(slow_batch_api, profiling_dir):
+    response = client.get(
+        "/jobs/?kbatch_profile=inline", headers={"Authorization": "token admin"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "_perform_action (main.py" in response.text
+    assert not list(profiling_dir.iterdir())
+
+
+def test_profile_file(slow_batch_api, profiling_dir):
+    response = client.get(
+        "/jobs/?kbatch_profile=file",
+        headers={"Authorization": "token admin", "X-Kbatch-Request-Id": "req"},
+    )
+    assert response.status_code == 200
+    assert response.json()["items"]
+    (filename,) = response.headers["X-Kbatch-Profile"].split(",")
+    assert filename.endswith("-list_jobs-req.folded")
+    assert "_perform_action" in (profiling_dir / filename).read_text()
+
+
+def test_profile_sampled(slow_batch_api, profiling_dir, mocker):
+    kbatch_proxy.profiling.configure(
+        directory=str(profiling_dir), sample_rate=1, min_interval_seconds=3600
+    )
+    mocker.patch.object(kbatch_proxy.profiling, "_last_sampled", float("-inf"))
+    headers = {"Authorization": "token abc"}
+    assert "X-Kbatch-Profile" in client.get("/jobs/", headers=headers).headers
+    # rate limited
+    assert "X-Kbatch-Profile" not in client.get("/jobs/", headers=headers).headers
+    assert len(list(profiling_dir.iterdir())) == 1
+
+
+def test_user_rate_limit(batch_api, mocker):
+    mocker.patch.object(kbatch_proxy.main, "job_list_cache", TTLCache(ttl=60))
+    mocker.patch.object(
+        kbatch_proxy.main, "rate_limiter", RateLimiter({"list": 0.01}, burst=2)
+    )
+    for token in ["abc", "abc", "admin"]:
+        response = client.get(
+            "/jobs/summary", headers={"Authorization": f"token {token}"}
+        )
+        assert response.status_code == 200
+
+    response = client.get("/jobs/summary", headers={"Authorization": "token abc"})
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 100
+    assert response.headers["X-Kbatch-Unprocessed"] == "true"
+
+    # other route classes are unaffected
+    response = client.get("/authorized", headers={"Authorization": "token abc"})
+    assert response.status_code == 200
+
+
+def test_max_in_flight():
+    started = threading.Event()
+    release = threading.Event()
+    shed_app = FastAPI()
+
+    @shed_app.get("/jobs/")
+    def slow():
+        started.set()
+        release.wait(5)
+        return {}
+
+    @shed_app.get("/jobs/{job_name}")
+    def fast(job_name: str):
+        return {}
+
+    shed_app.add_middleware(
+        AdmissionMiddleware, limits={"list": 1}, retry_after=3, prefix=""
+    )
+    shed_client = TestClient(shed_app)
+
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        first = pool.submit(shed_client.get, "/jobs/")
+        assert started.wait(5)
+        response = shed_client.get("/jobs/")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3"
+        assert response.headers["X-Kbatch-Unprocessed"] == "true"
+        # not limited
+        assert shed_client.get("/jobs/myjob").status_code == 200
+        release.set()
+        assert first.result().status_code == 200
+
+    assert shed_client.get("/jobs/").status_code == 200
+
+
+@pytest.mark.parametrize(
+    "method, path, expected",
+    [
+        ("POST", "/services/kbatch/jobs/", "submit"),
+        ("POST", "/services/kbatch/cronjobs/", "submit"),
+        ("GET", "/services/kbatch/jobs/", "list"),
+        ("GET", "/services/kbatch/pods/", "list"),
+        ("GET", "/services/kbatch/jobs/summary", "list"),
+        ("GET", "/services/kbatch/jobs/logs/myjob/", "logs"),
+        ("GET", "/services/kbatch/pods/logs/mypod/", "logs"),
+        ("GET", "/services/kbatch/jobs/myjob", None),
+        ("DELETE", "/services/kbatch/jobs/", None),
+    ],
+)
+def test_route_class(method, path, expected):
+    assert route_class(method, path, prefix="/services/kbatch") == expected
@@ -1,12 +1,33 @@
+import asyncio
+import atexit
 import base64
+import copy
+import datetime
+import json
+import logging
 import pathlib
+import threading
+from functools import partial
+from unittest import mock
 
+import kbatch_proxy.cache
+import kbatch_proxy.logs
 import kbatch_proxy.main
+import kbatch_proxy.metrics
 import kbatch_proxy.patch
+import kbatch_proxy.profiles
+import kbatch_proxy.reconcile
+import kbatch_proxy.retry
+import kbatch_proxy.scheduler
+import kbatch_proxy.serialize
+import kbatch_proxy.tracing
 import kbatch_proxy.utils
 import kubernetes.client
+import orjson
 import pytest
+import urllib3.exceptions
 import yaml
+from fastapi.encoders import jsonable_encoder
 
 HERE = pathlib.Path(__file__).parent
 
@@ -130,6 +151,12 @@ def test_namespace_configmap():
     assert cm.metadata.namespace == "my-namespace"
 
 
+def test_patch_labels_configmap(job):
+    cm = kubernetes.client.V1ConfigMap(metadata=kubernetes.client.V1ObjectMeta())
+    kbatch_proxy.patch.patch(job, cm, username="myuser")
+    assert cm.metadata.labels == {kbatch_proxy.patch.USERNAME_LABEL: "myuser"}
+
+
 @pytest.mark.parametrize("has_init_containers", [True, False])
 @pytest.mark.parametrize("has_volumes", [True, False])
 def test_add_unzip_init_container(job, has_init_containers: bool, has_volumes: bool):
@@ -248,3 +275,682 @@ def test_add_node_affinity(job):
     assert terms.values == ["user"]
     assert job_data["spec"]["backoff_limit"] == 4  # overridden by template
     assert result.spec.backoff_limit == 0  # overridden by template
+
+
+def _reconcile_obj(name, age, owned=False):
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    owner_references = None
+    if owned:
+        owner_references = [
+            kubernetes.client.V1OwnerReference(
+                api_version="batch/v1", kind="Job", name="job", uid="uid"
+            )
+        ]
+    return kubernetes.client.V1Secret(
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=name,
+            namespace="kbatch-myuser",
+            creation_timestamp=now - datetime.timedelta(seconds=age),
+            owner_references=owner_references,
+        )
+    )
+
+
+def test_reconcile():
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    pages = [
+        kubernetes.client.V1SecretList(
+            items=[_reconcile_obj("old", 1000), _reconcile_obj("new", 10)],
+            metadata=kubernetes.client.V1ListMeta(_continue="token"),
+        ),
+        kubernetes.client.V1SecretList(
+            items=[
+                _reconcile_obj("owned", 1000, owned=True),
+                _reconcile_obj("gone", 1000),
+            ],
+            metadata=kubernetes.client.V1ListMeta(),
+        ),
+    ]
+    api = mock.Mock()
+    api.list_secret_for_all_namespaces.side_effect = pages
+
+    def delete(name, namespace):
+        if name == "gone":
+            raise kubernetes.client.ApiException(status=404)
+
+    api.delete_namespaced_secret.side_effect = delete
+
+    result = kbatch_proxy.reconcile.reconcile(
+        api, "secret", grace_period_seconds=600, batch_size=2, now=now
+    )
+    assert result == [("kbatch-myuser", "old")]
+    assert api.list_secret_for_all_namespaces.call_args_list == [
+        mock.call(label_selector=kbatch_proxy.patch.USERNAME_LABEL, limit=2),
+        mock.call(
+            label_selector=kbatch_proxy.patch.USERNAME_LABEL, limit=2, _continue="token"
+        ),
+    ]
+    assert api.delete_namespaced_secret.call_count == 2
+
+    with pytest.raises(ValueError, match="Unknown `kind`"):
+        kbatch_proxy.reconcile.reconcile(api, "job")
+
+
+def test_summarize_jobs():
+    now = datetime.datetime(2024, 1, 1, 1, tzinfo=datetime.timezone.utc)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    failed_at = start + datetime.timedelta(minutes=10)
+    jobs = [
+        kubernetes.client.V1Job(
+            metadata=kubernetes.client.V1ObjectMeta(name="running"),
+            status=kubernetes.client.V1JobStatus(start_time=start, ready=1, active=1),
+        ),
+        kubernetes.client.V1Job(
+            metadata=kubernetes.client.V1ObjectMeta(name="failed"),
+            status=kubernetes.client.V1JobStatus(
+                start_time=start,
+                failed=1,
+                conditions=[
+                    kubernetes.client.V1JobCondition(
+                        type="Failed", status="True", last_transition_time=failed_at
+                    )
+                ],
+            ),
+        ),
+        kubernetes.client.V1Job(
+            metadata=kubernetes.client.V1ObjectMeta(name="new"),
+            status=kubernetes.client.V1JobStatus(),
+        ),
+    ]
+    result = kbatch_proxy.utils.summarize_jobs(jobs, now=now)
+    assert result["counts"] == {
+        "failed": 1,
+        "running": 1,
+        "pending": 1,
+        "done": 0,
+        "queued": 0,
+    }
+    assert result["total"] == 3
+    assert result["total_runtime_seconds"] == 60 * 60 + 10 * 60
+    assert result["recent_failures"] == [
+        {"name": "failed", "namespace": None, "failed_at": failed_at}
+    ]
+
+
+def test_ttl_cache(mocker):
+    clock = mocker.patch("kbatch_proxy.cache.time.monotonic", return_value=0)
+    c = kbatch_proxy.cache.TTLCache(ttl=10, maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.set("c", 3)
+    assert c.get("a") is None
+    assert c.get("b") == 2
+    assert c.get_or_set("c", lambda: 4) == 3
+
+    clock.return_value = 11
+    assert c.get("b") is None
+    assert c.get_or_set("c", lambda: 4) == 4
+    assert len(c) == 1
+
+
+@pytest.mark.parametrize("ttl", [0, 60])
+def test_single_flight(ttl):
+    flight = kbatch_proxy.cache.SingleFlight(ttl=ttl)
+    calls = []
+    release = threading.Event()
+
+    def call(key):
+        calls.append(key)
+        release.wait(5)
+        if key == "bad":
+            raise ValueError(key)
+        return [key]
+
+    async def main():
+        tasks = [
+            asyncio.ensure_future(flight.run(key, partial(call, key)))
+            for key in ["a", "a", "b", "a", "bad", "bad"]
+        ]
+        await asyncio.sleep(0.05)
+        assert "a" in flight and len(flight) == 3
+        # cancelling the caller that started a call doesn't cancel the others
+        tasks[0].cancel()
+        release.set()
+        results = await asyncio.gather(*tasks[1:], return_exceptions=True)
+        assert results[:3] == [["a"], ["b"], ["a"]]
+        assert results[0] is results[2]
+        assert all(isinstance(r, ValueError) for r in results[3:])
+        assert sorted(calls) == ["a", "b", "bad"]
+
+        await flight.run("a", partial(call, "a"))
+        return "a" in flight
+
+    cached = asyncio.run(main())
+    assert cached == bool(ttl)
+    assert len(calls) == (3 if ttl else 4)
+
+
+def test_instrumented_api():
+    api = mock.Mock()
+    api.read_namespaced_pod_log.__doc__ = "read log\n:param bool follow:"
+    instrumented = kbatch_proxy.metrics.InstrumentedApi(api)
+    histogram = kbatch_proxy.metrics.KUBERNETES_REQUEST_DURATION.labels(
+        "read_namespaced_pod_log"
+    )
+    before = histogram._sum.get()
+
+    instrumented.read_namespaced_pod_log(name="pod", namespace="ns")
+    api.read_namespaced_pod_log.assert_called_once_with(name="pod", namespace="ns")
+    assert histogram._sum.get() > before
+    # kubernetes.watch relies on the docstring
+    assert "follow" in instrumented.read_namespaced_pod_log.__doc__
+
+
+def test_json_logging(capsys):
+    logger = logging.getLogger("kbatch_proxy.test_json_logging")
+    listener = kbatch_proxy.logs.setup_logging(
+        logger, "json", level="DEBUG", debug_sample_rate=0
+    )
+    token = kbatch_proxy.tracing.request_id_var.set("my-request")
+    try:
+        logger.debug("dropped by sampling")
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("failed %s", "job", extra={"job": "my-job"})
+    finally:
+        kbatch_proxy.tracing.request_id_var.reset(token)
+        listener.stop()
+        atexit.unregister(listener.stop)
+        logger.handlers.clear()
+
+    (line,) = capsys.readouterr().err.splitlines()
+    record = json.loads(line)
+    assert record["message"] == "failed job"
+    assert record["level"] == "ERROR"
+    assert record["request_id"] == "my-request"
+    assert record["job"] == "my-job"
+    assert "ZeroDivisionError" in record["exc_info"]
+    assert "user" not in record
+
+
+def _scheduled_job(
+    name, user, age, queued=True, profile=None, priority_class=None, **status
+):
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    labels = {kbatch_proxy.patch.QUEUED_LABEL: "true"} if queued else {}
+    if profile:
+        labels[kbatch_proxy.patch.PROFILE_LABEL] = profile
+    if priority_class:
+        labels[kbatch_proxy.patch.PRIORITY_LABEL] = priority_class
+    return kubernetes.client.V1Job(
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=name,
+            namespace=f"kbatch-{user}",
+            annotations={kbatch_proxy.patch.USERNAME_LABEL: user},
+            labels=labels,
+            creation_timestamp=now - datetime.timedelta(seconds=age),
+        ),
+        spec=kubernetes.client.V1JobSpec(
+            template=kubernetes.client.V1PodTemplateSpec(), suspend=queued
+        ),
+        status=kubernetes.client.V1JobStatus(**status),
+    )
+
+
+def test_add_queued(job):
+    # a Job, or the job template of a CronJob
+    labels = job.metadata.labels
+    kbatch_proxy.patch.add_queued(job)
+    assert job.spec.suspend
+    assert job.metadata.labels[kbatch_proxy.patch.QUEUED_LABEL] == "true"
+    assert kbatch_proxy.patch.QUEUED_LABEL not in labels
+    if isinstance(job, kubernetes.client.V1Job):
+        assert kbatch_proxy.utils.job_status(job) == "queued"
+
+
+def test_fair_share_order():
+    jobs = [
+        _scheduled_job("a-running", "a", 100, queued=False, ready=1),
+        _scheduled_job("a-1", "a", 90),
+        _scheduled_job("a-2", "a", 80),
+        _scheduled_job("b-1", "b", 10),
+        _scheduled_job("b-2", "b", 5),
+        _scheduled_job("c-1", "c", 50, profile="gpu"),
+        _scheduled_job("c-2", "c", 40, profile="gpu"),
+        _scheduled_job("c-done", "c", 200, queued=False, succeeded=1),
+    ]
+    policy = kbatch_proxy.scheduler.QueuePolicy()
+
+    order = kbatch_proxy.scheduler.fair_share_order(jobs, policy)
+    # users without running jobs first, then round-robin
+    assert [job.metadata.name for job in order] == [
+        "c-1",
+        "b-1",
+        "a-1",
+        "c-2",
+        "b-2",
+        "a-2",
+    ]
+
+    policy = kbatch_proxy.scheduler.QueuePolicy(
+        max_running_per_user=2,
+        max_running_per_profile={"gpu": 1},
+        user_weights={"b": 2},
+    )
+    order = kbatch_proxy.scheduler.fair_share_order(jobs, policy)
+    # b's weight gets it a second job before a, c is at its gpu limit
+    assert [job.metadata.name for job in order] == ["c-1", "b-1", "b-2", "a-1"]
+
+    policy = kbatch_proxy.scheduler.QueuePolicy(max_running_total=3)
+    order = kbatch_proxy.scheduler.fair_share_order(jobs, policy)
+    assert [job.metadata.name for job in order] == ["c-1", "b-1"]
+
+    positions = kbatch_proxy.scheduler.queue_positions(jobs, policy)
+    assert positions[("kbatch-a", "a-2")] == 6
+    assert ("kbatch-a", "a-running") not in positions
+
+
+def test_fair_share_order_priority():
+    jobs = [
+        _scheduled_job("batch-1", "a", 90, priority_class="batch"),
+        _scheduled_job("batch-2", "b", 80, priority_class="batch"),
+        _scheduled_job("default", "c", 70),
+        _scheduled_job("interactive-1", "a", 10, priority_class="interactive"),
+        _scheduled_job("interactive-2", "a", 5, priority_class="interactive"),
+    ]
+    policy = kbatch_proxy.scheduler.QueuePolicy(
+        priorities={"interactive": 100, "batch": -10}
+    )
+    order = kbatch_proxy.scheduler.fair_share_order(jobs, policy)
+    assert [job.metadata.name for job in order] == [
+        "interactive-1",
+        "interactive-2",
+        "default",
+        "batch-2",
+        "batch-1",
+    ]
+
+
+def test_add_priority_class(job):
+    job_to_patch = job
+    if isinstance(job, kubernetes.client.V1CronJob):
+        job_to_patch = job.spec.job_template
+    kbatch_proxy.patch.add_priority_class(job_to_patch, "interactive")
+    assert job_to_patch.spec.template.spec.priority_class_name == "interactive"
+    assert (
+        job_to_patch.metadata.labels[kbatch_proxy.patch.PRIORITY_LABEL] == "interactive"
+    )
+
+
+def test_priority_class_name(mocker):
+    config = kbatch_proxy.profiles.Config(
+        {"urgent": {"priority_class_name": "interactive"}, "cpu": {}}
+    )
+    job = k8s_job()
+    assert kbatch_proxy.main._priority_class_name("urgent", job, config) == (
+        "interactive"
+    )
+    assert kbatch_proxy.main._priority_class_name("cpu", job, config) is None
+
+    job.spec.template.spec.priority_class_name = "interactive"
+    # unrestricted until kbatch_priority_classes is set
+    assert kbatch_proxy.main._priority_class_name("cpu", job, config) is None
+    mocker.patch.object(
+        kbatch_proxy.main.settings, "kbatch_priority_classes", {"interactive": 100}
+    )
+    with pytest.raises(kbatch_proxy.main.HTTPException):
+        kbatch_proxy.main._priority_class_name("cpu", job, config)
+    assert kbatch_proxy.main._priority_class_name("urgent", job, config) == (
+        "interactive"
+    )
+
+
+def test_code_digest():
+    digest = "0123456789abcdef" * 2 + "01234567"
+    assert kbatch_proxy.main._code_digest({"code_digest": digest}) == digest
+    assert kbatch_proxy.main._code_digest({}) is None
+    for bad in ["../etc", digest.upper(), 1]:
+        with pytest.raises(kbatch_proxy.main.HTTPException) as e:
+            kbatch_proxy.main._code_digest({"code_digest": bad})
+        assert e.value.status_code == 400
+
+
+def test_reuse_code():
+    digest = "a" * 40
+    api = mock.Mock()
+    api.list_namespaced_config_map.return_value.items = []
+    with pytest.raises(kbatch_proxy.main.HTTPException) as e:
+        kbatch_proxy.main._reuse_code(api, "user", digest)
+    assert e.value.status_code == 409
+    api.list_namespaced_config_map.assert_called_once_with(
+        namespace="user",
+        label_selector=f"{kbatch_proxy.patch.CODE_DIGEST_LABEL}={digest}",
+        limit=1,
+    )
+
+    api.list_namespaced_config_map.return_value.items = [
+        kubernetes.client.V1ConfigMap(
+            binary_data={"code": "UEsFBg=="},
+            metadata=kubernetes.client.V1ObjectMeta(
+                name="job-abcde",
+                generate_name="job-",
+                labels={kbatch_proxy.patch.CODE_DIGEST_LABEL: digest},
+                owner_references=[
+                    kubernetes.client.V1OwnerReference(
+                        api_version="batch/v1", kind="Job", name="job", uid="1"
+                    )
+                ],
+            ),
+        )
+    ]
+    config_map = kbatch_proxy.main._reuse_code(api, "user", digest)
+    assert config_map.binary_data == {"code": "UEsFBg=="}
+    # a new ConfigMap, owned by the new job once it's patched
+    assert config_map.metadata.name is None
+    assert config_map.metadata.generate_name == "job-"
+    assert config_map.metadata.owner_references is None
+
+    kbatch_proxy.patch.add_code_digest(config_map, digest)
+    assert config_map.metadata.labels == {kbatch_proxy.patch.CODE_DIGEST_LABEL: digest}
+
+
+def test_serialize():
+    job = k8s_job()
+    job.metadata.creation_timestamp = datetime.datetime(
+        2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc
+    )
+    job.metadata.labels["app.kubernetes.io/name"] = "kbatch"
+    job.spec.template.spec.containers[0].resources = (
+        kubernetes.client.V1ResourceRequirements(requests={"cpu": "1"})
+    )
+    job_list = kubernetes.client.V1JobList(
+        items=[job], metadata=kubernetes.client.V1ListMeta()
+    )
+    expected = jsonable_encoder(job_list.to_dict())
+
+    assert kbatch_proxy.serialize.to_jsonable(job_list) == expected
+
+    # the raw response, as the API server sends it
+    raw = kubernetes.client.ApiClient().sanitize_for_serialization(job_list)
+    assert raw["items"][0]["spec"]["template"]["spec"]["restartPolicy"]
+    raw["items"][0]["metadata"]["creationTimestamp"] = "2024-01-02T03:04:05Z"
+    raw["items"][0]["unknownField"] = 1
+    response = mock.Mock(data=json.dumps(raw).encode())
+    assert kbatch_proxy.serialize.from_response(response, "V1JobList") == expected
+
+    assert kbatch_proxy.serialize.json_response(expected).body == orjson.dumps(expected)
+
+
+def test_release():
+    batch_api = mock.Mock()
+    batch_api.list_job_for_all_namespaces.return_value.items = [
+        _scheduled_job("a-running", "a", 100, queued=False, ready=1),
+        _scheduled_job("a-1", "a", 90),
+        _scheduled_job("b-1", "b", 10),
+    ]
+    batch_api.patch_namespaced_job.side_effect = [
+        kubernetes.client.ApiException(status=404),
+        None,
+    ]
+    policy = kbatch_proxy.scheduler.QueuePolicy(max_running_per_user=1)
+
+    released = kbatch_proxy.scheduler.release(batch_api, policy)
+    # b-1 was deleted while queued, a is at its limit
+    assert released == []
+    name, namespace, body = batch_api.patch_namespaced_job.call_args.args
+    assert (name, namespace) == ("b-1", "kbatch-b")
+    assert body["spec"] == {"suspend": False}
+
+
+@pytest.fixture
+def retry_config(mocker):
+    mocker.patch("kbatch_proxy.retry.time.sleep")
+    kbatch_proxy.retry.configure(
+        max_retries=2, base_delay_seconds=0.1, failure_threshold=3, reset_seconds=30
+    )
+    yield
+    kbatch_proxy.retry.configure()
+
+
+def test_retry_idempotent(retry_config):
+    api = mock.Mock()
+    api.list_namespaced_job.side_effect = [
+        kubernetes.client.ApiException(status=500),
+        urllib3.exceptions.ProtocolError("Connection reset"),
+        "jobs",
+    ]
+    api.create_namespaced_job.side_effect = kubernetes.client.ApiException(status=500)
+    retrying = kbatch_proxy.retry.RetryingApi(api)
+    retries = kbatch_proxy.metrics.KUBERNETES_RETRIES.labels(
+        "list_namespaced_job", "connection"
+    )
+    before = retries._value.get()
+
+    assert retrying.list_namespaced_job("ns") == "jobs"
+    assert api.list_namespaced_job.call_count == 3
+    assert retries._value.get() == before + 1
+
+    # not idempotent
+    with pytest.raises(kubernetes.client.ApiException):
+        retrying.create_namespaced_job("ns", body={})
+    assert api.create_namespaced_job.call_count == 1
+
+    # not transient
+    api.read_namespaced_job.side_effect = kubernetes.client.ApiException(status=404)
+    with pytest.raises(kubernetes.client.ApiException):
+        retrying.read_namespaced_job("name", "ns")
+    assert api.read_namespaced_job.call_count == 1
+
+
+def test_retry_after(retry_config):
+    throttled = kubernetes.client.ApiException(status=429)
+    throttled.headers = {"Retry-After": "1"}
+    api = mock.Mock()
+    api.create_namespaced_job.side_effect = [throttled, "job"]
+
+    # rejected by API priority and fairness, so safe to retry
+    result = kbatch_proxy.retry.RetryingApi(api).create_namespaced_job("ns", body={})
+    assert result == "job"
+    kbatch_proxy.retry.time.sleep.assert_called_once_with(1)
+
+
+def test_circuit_breaker(retry_config, mocker):
+    clock = mocker.patch("kbatch_proxy.retry.time.monotonic", return_value=0)
+    api = mock.Mock()
+    api.list_namespaced_job.side_effect = kubernetes.client.ApiException(status=503)
+    retrying = kbatch_proxy.retry.RetryingApi(api)
+
+    # one failure per call, however many times it was retried
+    for _ in range(3):
+        with pytest.raises(kubernetes.client.ApiException):
+            retrying.list_namespaced_job("ns")
+    assert api.list_namespaced_job.call_count == 9
+
+    # the circuit is open, so fail without calling the API
+    with pytest.raises(kbatch_proxy.retry.CircuitOpenError) as e:
+        retrying.list_namespaced_job("ns")
+    assert api.list_namespaced_job.call_count == 9
+    assert e.value.status == 503
+    assert e.value.headers == {"Retry-After": "30"}
+
+    # a failed trial call opens it again
+    clock.return_value = 31
+    with pytest.raises(kubernetes.client.ApiException):
+        retrying.list_namespaced_job("ns")
+    assert api.list_namespaced_job.call_count == 12
+    with pytest.raises(kbatch_proxy.retry.CircuitOpenError):
+        retrying.list_namespaced_job("ns")
+
+    # and a successful one closes it
+    clock.return_value = 62
+    api.list_namespaced_job.side_effect = None
+    api.list_namespaced_job.return_value = "jobs"
+    assert retrying.list_namespaced_job("ns") == "jobs"
+    assert retrying.list_namespaced_job("ns") == "jobs"
+
+
+def test_circuit_breaker_throttled(retry_config):
+    api = mock.Mock()
+    api.list_namespaced_job.side_effect = kubernetes.client.ApiException(status=429)
+    retrying = kbatch_proxy.retry.RetryingApi(api)
+
+    # the API server shedding load isn't failing, so the circuit stays closed
+    for _ in range(5):
+        with pytest.raises(kubernetes.client.ApiException) as e:
+            retrying.list_namespaced_job("ns")
+        assert e.value.status == 429
+    assert api.list_namespaced_job.call_count == 15
+    assert kbatch_proxy.retry.breaker.opened_at is None
+    assert kbatch_proxy.retry.breaker.failures == 0
+
+
+def test_etag():
+    etag = kbatch_proxy.utils.etag({"a": 1, "b": [1, 2]})
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == kbatch_proxy.utils.etag({"b": [1, 2], "a": 1})
+    assert etag != kbatch_proxy.utils.etag({"a": 2, "b": [1, 2]})
+
+    assert kbatch_proxy.utils.etag_matches(etag, etag)
+    assert kbatch_proxy.utils.etag_matches(f'"other", W/{etag}', etag)
+    assert kbatch_proxy.utils.etag_matches("*", etag)
+    assert not kbatch_proxy.utils.etag_matches(None, etag)
+    assert not kbatch_proxy.utils.etag_matches('"other"', etag)
+
+
+def test_resource_etag():
+    def job(uid, version, annotations=None):
+        metadata = {"uid": uid, "resource_version": version}
+        return {"metadata": {**metadata, "annotations": annotations}, "spec": {}}
+
+    jobs = {"metadata": {"resource_version": "100"}, "items": [job("a", "1")]}
+    etag = kbatch_proxy.utils.resource_etag(jobs)
+    assert etag.startswith('W/"')
+    # not the list's resourceVersion, which changes with the whole cluster
+    jobs["metadata"]["resource_version"] = "200"
+    assert kbatch_proxy.utils.resource_etag(jobs) == etag
+
+    for changed in [
+        [job("a", "2")],
+        [job("a", "1"), job("b", "1")],
+        [job("a", "1", {kbatch_proxy.scheduler.QUEUE_POSITION_ANNOTATION: "1"})],
+    ]:
+        assert kbatch_proxy.utils.resource_etag({"items": changed}) != etag
+
+    assert kbatch_proxy.utils.resource_etag(job("a", "1")) == etag
+
+
+def test_is_label_value():
+    for value in ["", "gpu", "gpu-pytorch_2.1", "a" * 63]:
+        assert kbatch_proxy.utils.is_label_value(value)
+    for value in ["Python (default)", "-gpu", "gpu.", "a" * 64]:
+        assert not kbatch_proxy.utils.is_label_value(value)
+
+
+def test_profile_matches():
+    gpu = {
+        "resources": {
+            "requests": {"cpu": "3.0", "nvidia.com/gpu": 1},
+            "limits": {"cpu": 4, "nvidia.com/gpu": "1"},
+        },
+        "tolerations": [
+            {"key": "nvidia.com/gpu", "operator": "Equal", "value": "present"},
+        ],
+        "node_affinity_required": [
+            {"matchExpressions": [{"key": "kind", "operator": "In", "values": ["gpu"]}]}
+        ],
+        "priority_class_name": "interactive",
+    }
+    config = kbatch_proxy.profiles.Config({"cpu": {}, "gpu": gpu})
+    profile = config.profiles["gpu"]
+    # as the client makes it
+    pod_spec = {
+        "containers": [
+            {
+                "name": "job",
+                "resources": {
+                    "requests": {"cpu": "3", "nvidia.com/gpu": "1"},
+                    "limits": {"cpu": "4", "nvidia.com/gpu": "1"},
+                },
+            }
+        ],
+        "tolerations": [
+            {"key": "nvidia.com/gpu", "operator": "Equal", "value": "present"}
+        ],
+        "affinity": {
+            "node_affinity": {
+                "required_during_scheduling_ignored_during_execution": {
+                    "node_selector_terms": [
+                        {
+                            "match_expressions": [
+                                {"key": "kind", "operator": "In", "values": ["gpu"]}
+                            ],
+                            "match_fields": [],
+                        }
+                    ]
+                }
+            }
+        },
+        "priority_class_name": "interactive",
+    }
+    assert kbatch_proxy.profiles.matches(profile, pod_spec)
+    assert config.match(pod_spec) == "gpu"
+    assert config.match({"containers": [{"name": "job"}]}) == "cpu"
+
+    more = copy.deepcopy(pod_spec)
+    more["containers"][0]["resources"]["limits"]["nvidia.com/gpu"] = "4"
+    untolerated = copy.deepcopy(pod_spec)
+    del untolerated["tolerations"]
+    unprioritized = copy.deepcopy(pod_spec)
+    del unprioritized["priority_class_name"]
+    sidecar = copy.deepcopy(pod_spec)
+    sidecar["init_containers"] = [
+        {"name": "init", "resources": {"limits": {"nvidia.com/gpu": "8"}}}
+    ]
+    invalid = copy.deepcopy(pod_spec)
+    invalid["containers"][0]["resources"]["limits"]["cpu"] = "lots"
+    for spec in [more, untolerated, unprioritized, sidecar, invalid]:
+        assert not kbatch_proxy.profiles.matches(profile, spec)
+        assert config.match(spec) is None
+
+
+def test_validate_profiles():
+    data = yaml.safe_load((HERE / "profile_template.yaml").read_text())
+    profiles = kbatch_proxy.profiles.validate_profiles(data)
+    assert profiles["gpu-pytorch"].tolerations[0].key == "nvidia.com/gpu"
+    assert profiles["gpu-pytorch"].node_affinity_required[0].match_expressions
+
+    with pytest.raises(ValueError, match="'typo'") as e:
+        kbatch_proxy.profiles.validate_profiles({"typo": {"imgae": "python"}})
+    assert "imgae" in str(e.value)
+    with pytest.raises(ValueError, match="invalid quantity"):
+        kbatch_proxy.profiles.validate_profiles(
+            {"python": {"resources": {"limits": {"memory": "32 GB"}}}}
+        )
+    with pytest.raises(ValueError, match="priority_class_name"):
+        kbatch_proxy.profiles.validate_profiles(
+            {"urgent": {"priority_class_name": "interactive-" + "x" * 60}}
+        )
+
+
+def test_reload_profiles(tmp_path, mocker):
+    for name in ["current", "_files", "_signatures"]:
+        mocker.patch.object(kbatch_proxy.profiles, name)
+    path = tmp_path / "profiles.yaml"
+    path.write_text(yaml.safe_dump({"python": {"image": "python:3.11"}}))
+    kbatch_proxy.profiles.configure(profile_file=str(path))
+    config = kbatch_proxy.profiles.current
+    assert config.profiles["python"].image == "python:3.11"
+    assert not kbatch_proxy.profiles.reload()
+
+    path.write_text(yaml.safe_dump({"python": {"image": "python:3.12-slim"}}))
+    assert kbatch_proxy.profiles.reload()
+    profile = kbatch_proxy.profiles.current.profiles["python"]
+    assert profile.image == "python:3.12-slim"
+    assert kbatch_proxy.profiles.current.profiles_etag != config.profiles_etag
+
+    # invalid profiles are ignored, keeping the previous ones
+    config = kbatch_proxy.profiles.current
+    path.write_text(yaml.safe_dump({"python": {"imgae": "python:3.13"}}))
+    assert not kbatch_proxy.profiles.reload()
+    assert kbatch_proxy.profiles.current is config
@@ -2,10 +2,13 @@
 kbatch
 """
 
-from ._backend import make_cronjob, make_job
+from typing import TYPE_CHECKING
+
+from ._archive import archive
 from ._core import (
     configure,
     delete_job,
+    delete_jobs,
     format_jobs,
     job_logs,
     job_logs_streaming,
@@ -16,16 +19,25 @@ from ._core import (
     show_job,
     submit_job,
 )
+from ._retry import RetryPolicy, set_retry_policy
+from ._session import AsyncKbatchClient, KbatchClient
 from ._types import CronJob, Job
 
+if TYPE_CHECKING:
+    from ._backend import make_cronjob, make_job
+
 __version__ = "0.5.0a1"
 
 __all__ = [
     "__version__",
+    "archive",
+    "AsyncKbatchClient",
     "configure",
     "CronJob",
     "Job",
+    "KbatchClient",
     "delete_job",
+    "delete_jobs",
     "format_jobs",
     "job_logs",
     "job_logs_streaming",
@@ -35,6 +47,17 @@ __all__ = [
     "make_job",
     "pod_logs",
     "pod_logs_streaming",
+    "RetryPolicy",
+    "set_retry_policy",
     "show_job",
     "submit_job",
 ]
+
+
+def __getattr__(name):
+    # _backend imports kubernetes, which is slow, so it's only imported when used
+    if name in {"make_cronjob", "make_job"}:
+        from . import _backend
+
+        return getattr(_backend, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,251 @@
+"""
+Zip code to submit with a job.
+
+Directories are archived in memory, skipping files matched by ``.gitignore``
+and ``.kbatchignore`` files (in the directory or any subdirectory), along with
+version control directories, caches and virtual environments.
+
+Patterns follow the ``.gitignore`` format: ``#`` comments, ``!`` negation,
+a trailing ``/`` to only match directories, a ``/`` elsewhere to match relative
+to the ignore file, and ``*``, ``?``, ``[...]`` and ``**`` wildcards.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import re
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+IGNORE_FILES = (".gitignore", ".kbatchignore")
+DEFAULT_IGNORE = [
+    ".git/",
+    ".hg/",
+    ".svn/",
+    "__pycache__/",
+    "*.py[cod]",
+    ".ipynb_checkpoints/",
+    ".mypy_cache/",
+    ".pytest_cache/",
+    ".DS_Store",
+]
+# The most a ConfigMap, which holds the code, can store
+MAX_SIZE = 1024 * 1024
+
+
+class _Pattern:
+    """A line of an ignore file, relative to the directory `base`."""
+
+    def __init__(self, pattern: str, base: str = ""):
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # a slash other than at the end anchors the pattern to `base`
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        prefix = re.escape(base)
+        if not anchored:
+            prefix += "(?:.*/)?"
+        self.regex = re.compile(f"^{prefix}{_translate(pattern)}$")
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        return self.regex.match(path) is not None
+
+
+def _translate(pattern: str) -> str:
+    """Translate a glob from an ignore file into a regular expression."""
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == n:
+            parts.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1 : end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append(f"[{chars}]")
+            i = end + 1
+        else:
+            if pattern[i] == "\\" and i + 1 < n:
+                i += 1
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts)
+
+
+def _parse_ignore(text: str, base: str = "") -> list[_Pattern]:
+    patterns = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        patterns.append(_Pattern(line, base))
+    return patterns
+
+
+def _ignored(patterns: list[_Pattern], path: str, is_dir: bool) -> bool:
+    ignored = False
+    # the last matching pattern wins
+    for pattern in patterns:
+        if pattern.matches(path, is_dir):
+            ignored = not pattern.negate
+    return ignored
+
+
+def list_files(root: str | pathlib.Path) -> list[tuple[pathlib.Path, str, bool]]:
+    """
+    The paths to archive under `root`, honoring the ignore files.
+
+    Returns ``(path, name, is_dir)`` tuples, with `name` relative to `root`,
+    sorted so archives of unchanged directories are identical.
+    """
+    root = pathlib.Path(root)
+    result: list[tuple[pathlib.Path, str, bool]] = []
+
+    def walk(directory: pathlib.Path, rel: str, patterns: list[_Pattern]) -> None:
+        for ignore_file in IGNORE_FILES:
+            try:
+                text = (directory / ignore_file).read_text()
+            except OSError:
+                continue
+            patterns = patterns + _parse_ignore(text, rel)
+
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            name = rel + entry.name
+            path = pathlib.Path(entry.path)
+            is_dir = entry.is_dir()
+            if _ignored(patterns, name, is_dir):
+                continue
+            if not is_dir:
+                result.append((path, name, False))
+            elif entry.is_symlink():
+                logger.debug("Not following the symlink %s", path)
+            elif (path / "pyvenv.cfg").exists():
+                logger.debug("Skipping the virtual environment %s", path)
+            else:
+                result.append((path, name + "/", True))
+                walk(path, name + "/", patterns)
+
+    walk(root, "", _parse_ignore("\n".join(DEFAULT_IGNORE)))
+    return result
+
+
+def code_files(code: str | pathlib.Path) -> list[tuple[pathlib.Path, str, bool]]:
+    """
+    The files `archive` includes for `code`, as returned by `list_files`.
+    """
+    code = pathlib.Path(code)
+    if code.is_dir():
+        return list_files(code)
+    return [(code, code.name, False)]
+
+
+def signature(files: list[tuple[pathlib.Path, str, bool]]) -> str:
+    """
+    A hash of the names, sizes and modification times of `files`.
+
+    This changes whenever their contents likely do, without reading them.
+    """
+    h = hashlib.sha256()
+    for path, name, is_dir in files:
+        if is_dir:
+            h.update(f"{name}\0".encode())
+        else:
+            st = path.stat()
+            h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    return h.hexdigest()
+
+
+def digest(files: list[tuple[pathlib.Path, str, bool]]) -> str:
+    """
+    A hash of the names and contents of `files`.
+
+    40 hexadecimal characters, short enough for a Kubernetes label value.
+    """
+    h = hashlib.sha256()
+    for path, name, is_dir in files:
+        h.update(f"{name}\0".encode())
+        if is_dir:
+            continue
+        h.update(f"{path.stat().st_size}\0".encode())
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+    return h.hexdigest()[:40]
+
+
+def _format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} kB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def archive(code: str | pathlib.Path, compresslevel: int | None = None) -> bytes:
+    """
+    Zip the file or directory `code` in memory.
+
+    Parameters
+    ----------
+    code : a file, or a directory whose ignore files are honored.
+    compresslevel : 0 stores files uncompressed, 1 (fastest) to 9 (smallest)
+        deflates them. By default directories are deflated at zlib's default
+        level and a single file is stored.
+    """
+    code = pathlib.Path(code)
+    files = code_files(code)
+    if not code.is_dir() and compresslevel is None:
+        compresslevel = 0
+
+    if compresslevel == 0:
+        compression = zipfile.ZIP_STORED
+        compresslevel = None
+    else:
+        compression = zipfile.ZIP_DEFLATED
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(
+        buf, mode="w", compression=compression, compresslevel=compresslevel
+    ) as zf:
+        for path, name, _ in files:
+            # streams the file in chunks
+            zf.write(path, name)
+    data = buf.getvalue()
+
+    n_files = sum(not is_dir for _, _, is_dir in files)
+    logger.info(
+        "Archived %d files from %s (%s)", n_files, code, _format_size(len(data))
+    )
+    if len(data) > MAX_SIZE:
+        logger.warning(
+            "The code archive is larger than the %s kbatch-proxy can store. "
+            "Exclude files with a .kbatchignore file.",
+            _format_size(MAX_SIZE),
+        )
+    return data
@@ -7,10 +7,7 @@ This is used only by the kbatch backend. kbatch users do not have access to the
 from __future__ import annotations
 
 import pathlib
-import shutil
 import string
-import tempfile
-import zipfile
 
 from kubernetes.client.models import (
     V1Affinity,
@@ -33,6 +30,8 @@ from kubernetes.client.models import (
     V1Toleration,
 )
 
+from ._archive import archive
+from ._spec import _make_job_name
 from ._types import CronJob, Job
 
 SAFE_CHARS = set(string.ascii_lowercase + string.digits)
@@ -157,6 +156,7 @@ def _make_job_spec(
             # volumes=[file_volume],
             tolerations=tolerations,
             affinity=affinity,
+            priority_class_name=profile.get("priority_class_name"),
         ),
         metadata=pod_metadata,
     )
@@ -164,15 +164,6 @@ def _make_job_spec(
     return V1JobSpec(template=template, backoff_limit=0, ttl_seconds_after_finished=300)
 
 
-def _make_job_name(name: str, schedule: str | None = None):
-    generate_name = name
-    if not name.endswith("-"):
-        generate_name = name + "-"
-    if schedule:
-        generate_name += "cron-"
-    return generate_name
-
-
 def make_cronjob(
     cronjob: CronJob,
     profile: dict | None = None,
@@ -256,20 +247,7 @@ def make_job(
 
 
 def make_configmap(code: str | pathlib.Path, generate_name) -> V1ConfigMap:
-    code = pathlib.Path(code)
-
-    with tempfile.TemporaryDirectory() as d:
-        p = pathlib.Path(d) / "code"
-        zp = p.with_suffix(".zip")
-
-        if code.is_dir():
-            shutil.make_archive(str(p), "zip", str(code))
-        else:
-            with zipfile.ZipFile(zp, mode="w") as zf:
-                zf.write(str(code), code.name)
-
-        data = zp.read_bytes()
-
+    data = archive(code)
     metadata = V1ObjectMeta(generate_name=generate_name)
     cm = V1ConfigMap(
         api_version="v1",
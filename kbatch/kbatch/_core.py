@@ -1,19 +1,27 @@
 from __future__ import annotations
 
-import base64
 import datetime
 import json
 import logging
 import os
+import threading
 import urllib.parse
+import uuid
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import httpx
 import rich.table
 import yaml
-from kubernetes.client.models import V1CronJob, V1Job
 
-from ._backend import make_configmap
+from . import _archive, _retry
+from ._types import CronJob, Job
+
+if TYPE_CHECKING:
+    # not imported at runtime, since importing kubernetes is slow
+    from kubernetes.client.models import V1CronJob, V1Job
+
+    from ._session import KbatchClient
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +35,100 @@ def config_path() -> Path:
     return Path(config_home) / "kbatch/config.json"
 
 
+def profiles_cache_path() -> Path:
+    """Where the profiles of each kbatch-proxy are cached, next to the config."""
+    return config_path().parent / "profiles.json"
+
+
+def code_cache_path() -> Path:
+    """Where the digests of code submitted with jobs are cached, next to the config."""
+    return config_path().parent / "code.json"
+
+
+def _read_cache(p: Path) -> dict:
+    try:
+        with open(p) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_cache(p: Path, cache: dict) -> None:
+    try:
+        p.parent.mkdir(exist_ok=True, parents=True)
+        # write and rename, so concurrent submissions never read a partial file
+        tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(cache))
+        os.replace(tmp, p)
+    except OSError as e:
+        logger.debug("Not caching in %s: %s", p, e)
+
+
+def _load_cached_profiles(kbatch_url: str) -> tuple[str | None, dict | None]:
+    """
+    The ETag and profiles cached for `kbatch_url`, or ``(None, None)``.
+    """
+    try:
+        cached = _read_cache(profiles_cache_path())[kbatch_url]
+        return cached["etag"], cached["profiles"]
+    except (KeyError, TypeError):
+        return None, None
+
+
+def _save_cached_profiles(kbatch_url: str, etag: str, profiles: dict) -> None:
+    p = profiles_cache_path()
+    cache = _read_cache(p)
+    cache[kbatch_url] = {"etag": etag, "profiles": profiles}
+    _write_cache(p, cache)
+
+
+# The most digests of code to remember
+MAX_CACHED_CODE = 256
+
+
+def _code_digest(code: Path | str) -> str:
+    """
+    The digest of the contents of `code`, a file or directory.
+
+    Hashing reads every file, so digests are cached by the names, sizes and
+    modification times of the files, which are much cheaper to check.
+    """
+    files = _archive.code_files(code)
+    signature = _archive.signature(files)
+    p = code_cache_path()
+    cache = _read_cache(p)
+    digests = cache.get("digests")
+    if not isinstance(digests, dict):
+        digests = cache["digests"] = {}
+    digest = digests.pop(signature, None)
+    if not isinstance(digest, str):
+        digest = _archive.digest(files)
+    # most recently used last
+    digests[signature] = digest
+    while len(digests) > MAX_CACHED_CODE:
+        del digests[next(iter(digests))]
+    _write_cache(p, cache)
+    return digest
+
+
+def _code_uploaded(kbatch_url: str, digest: str) -> bool:
+    """Whether code with `digest` has been uploaded to `kbatch_url` before."""
+    uploaded = _read_cache(code_cache_path()).get("uploaded") or {}
+    return isinstance(uploaded, dict) and digest in (uploaded.get(kbatch_url) or [])
+
+
+def _record_code_upload(kbatch_url: str, digest: str) -> None:
+    p = code_cache_path()
+    cache = _read_cache(p)
+    uploaded = cache.get("uploaded")
+    if not isinstance(uploaded, dict):
+        uploaded = cache["uploaded"] = {}
+    digests = [d for d in uploaded.get(kbatch_url) or [] if d != digest]
+    uploaded[kbatch_url] = (digests + [digest])[-MAX_CACHED_CODE:]
+    _write_cache(p, cache)
+
+
 def load_config() -> dict[str, str | None]:
     """Load the configuration
 
@@ -90,116 +192,158 @@ def configure(kbatch_url=None, token=None) -> Path:
 
     configpath.parent.mkdir(exist_ok=True, parents=True)
     configpath.write_text(json.dumps(config))
+    # the default clients hold the old configuration
+    _reset_default_clients()
     return configpath
 
 
+_RESOURCES = {
+    "V1Job": "jobs",
+    "Job": "jobs",
+    "V1CronJob": "cronjobs",
+    "CronJob": "cronjobs",
+}
+
+
+def _resource(model: type) -> str:
+    """
+    The kbatch-proxy resource for `model`, "jobs" or "cronjobs".
+
+    `model` is `Job`, `CronJob` or their Kubernetes counterparts. They're
+    matched by name, so the Kubernetes models are never imported just to tell.
+    """
+    for cls in getattr(model, "__mro__", ()):
+        if cls.__name__ in _RESOURCES:
+            return _RESOURCES[cls.__name__]
+    raise ValueError(
+        f"Unknown resource specified: {model}. "
+        + "Please select from one of the following: `V1Job` or `V1CronJob`."
+    )
+
+
+REQUEST_ID_HEADER = "X-Kbatch-Request-Id"
+# Set by kbatch-proxy on queued jobs in job listings
+QUEUE_POSITION_ANNOTATION = "kbatch.jupyter.org/queue-position"
+
+
+def _add_request_id(request: httpx.Request) -> None:
+    """Tag each request with an ID, to find it in kbatch-proxy's logs and traces"""
+    if REQUEST_ID_HEADER not in request.headers:
+        request.headers[REQUEST_ID_HEADER] = uuid.uuid4().hex
+
+
 def _client(**kwargs):
     kwargs.setdefault("follow_redirects", True)
+    kwargs.setdefault("event_hooks", {"request": [_add_request_id]})
+    kwargs.setdefault("transport", _retry.RetryTransport())
     return httpx.Client(**kwargs)
 
 
+_default_clients: dict[tuple[str | None, str | None], KbatchClient] = {}
+
+
+def _default_client(kbatch_url: str | None, token: str | None) -> KbatchClient:
+    """
+    The shared `KbatchClient` the module-level functions delegate to.
+
+    There is one per `kbatch_url` and `token`, so the configuration is only
+    loaded once and connections are reused. `configure` resets them.
+    """
+    from ._session import KbatchClient
+
+    key = (kbatch_url, token)
+    client = _default_clients.get(key)
+    if client is None:
+        client = _default_clients[key] = KbatchClient(kbatch_url, token)
+    return client
+
+
+def _reset_default_clients() -> None:
+    for client in _default_clients.values():
+        client.close()
+    _default_clients.clear()
+
+
 def _request_action(
     kbatch_url: str | None,
     token: str | None,
     method: str,
-    model: V1Job | V1CronJob,
+    model: type[V1Job | V1CronJob | Job | CronJob],
     resource_name: str | None = None,
     json_data: dict | None = None,
+    params: dict | None = None,
 ):
-    client = _client()
-    config = load_config()
-
-    token = token or config["token"]
-    kbatch_url = handle_url(kbatch_url, config)
-
-    headers = {
-        "Authorization": f"token {token}",
-    }
-
-    http_methods = ["GET", "DELETE", "POST"]
-    if method not in http_methods:
-        raise ValueError(
-            f"Unknown method specified: {method}. "
-            + "Please select from one of the following: {http_methods}."
-        )
-
-    endpoint = "jobs/" if issubclass(model, V1Job) else "cronjobs/"
-
-    if resource_name:
-        endpoint += resource_name
-
-    r = client.request(
-        method,
-        urllib.parse.urljoin(kbatch_url, endpoint),
-        headers=headers,
-        json=json_data,
+    return _default_client(kbatch_url, token)._request_action(
+        method, model, resource_name, json_data=json_data, params=params
     )
-    r.raise_for_status()
-
-    return r.json()
 
 
 def show_job(
     resource_name: str,
     kbatch_url: str | None = None,
     token: str | None = None,
-    model: V1Job | V1CronJob = V1Job,
+    model: type[V1Job | V1CronJob | Job | CronJob] = Job,
 ):
-    return _request_action(kbatch_url, token, "GET", model, resource_name)
+    return _default_client(kbatch_url, token).show_job(resource_name, model)
 
 
 def delete_job(
     resource_name: str,
     kbatch_url: str | None = None,
     token: str | None = None,
-    model: V1Job | V1CronJob = V1Job,
+    model: type[V1Job | V1CronJob | Job | CronJob] = Job,
 ):
-    return _request_action(kbatch_url, token, "DELETE", model, resource_name)
+    return _default_client(kbatch_url, token).delete_job(resource_name, model)
+
+
+def delete_jobs(
+    kbatch_url: str | None = None,
+    token: str | None = None,
+    selector: str | None = None,
+    status: str | None = None,
+    older_than: str | None = None,
+    all: bool = False,
+):
+    """
+    Delete many jobs in a single request.
+
+    Parameters
+    ----------
+    selector : Kubernetes label selector the jobs must match.
+    status : only delete jobs with this status,
+        one of "failed", "running", "pending", "done" or "queued".
+    older_than : only delete jobs older than this, e.g. "3600", "30m", "12h", "7d".
+    all : delete every job. Required if no other filter is given.
+
+    Returns
+    -------
+    A dict with the names of the deleted jobs under "deleted".
+    """
+    return _default_client(kbatch_url, token).delete_jobs(
+        selector=selector, status=status, older_than=older_than, all=all
+    )
 
 
 def list_jobs(
     kbatch_url: str | None = None,
     token: str | None = None,
-    model: V1Job | V1CronJob = V1Job,
+    model: type[V1Job | V1CronJob | Job | CronJob] = Job,
 ):
-    return _request_action(kbatch_url, token, "GET", model)
+    return _default_client(kbatch_url, token).list_jobs(model)
 
 
 def submit_job(
     job,
     kbatch_url: str | None = None,
     token: str | None = None,
-    model: V1Job | V1CronJob = V1Job,
+    model: type[V1Job | V1CronJob | Job | CronJob] = Job,
     code: Path | str | None = None,
     profile: str | dict | None = None,
+    compresslevel: int | None = None,
 ):
-    from ._backend import make_cronjob, make_job
-
-    if isinstance(profile, str):
-        profile = load_profile(profile, kbatch_url=kbatch_url)
-
-    profile = profile or {}
-
-    if issubclass(model, V1Job):
-        data = make_job(job, profile=profile).to_dict()
-    elif issubclass(model, V1CronJob):
-        data = make_cronjob(job, profile=profile).to_dict()
-    else:
-        raise ValueError(
-            f"Unknown resource specified: {model}. "
-            + "Please select from one of the following: `V1Job` or `V1CronJob`."
-        )
-
-    data = {"job": data}
-
-    if code:
-        cm = make_configmap(code, generate_name=job.name).to_dict()
-        cm["binary_data"]["code"] = base64.b64encode(cm["binary_data"]["code"]).decode(
-            "ascii"
-        )
-        data["code"] = cm
-
-    return _request_action(kbatch_url, token, "POST", model, json_data=data)
+    return _default_client(kbatch_url, token).submit_job(
+        job, model, code=code, profile=profile, compresslevel=compresslevel
+    )
 
 
 def list_pods(
@@ -207,24 +351,7 @@ def list_pods(
     kbatch_url: str | None = None,
     token: str | None = None,
 ):
-    client = _client()
-    config = load_config()
-
-    token = token or config["token"]
-    kbatch_url = handle_url(kbatch_url, config)
-
-    headers = {
-        "Authorization": f"token {token}",
-    }
-
-    r = client.get(
-        urllib.parse.urljoin(kbatch_url, "pods/"),
-        headers=headers,
-        params=dict(job_name=job_name),
-    )
-    r.raise_for_status()
-
-    return r.json()
+    return _default_client(kbatch_url, token).list_pods(job_name)
 
 
 def job_logs(
@@ -233,11 +360,7 @@ def job_logs(
     token: str | None = None,
     read_timeout: int = 60,
 ):
-    gen = _logs(
-        job_name, kbatch_url, token, stream=False, read_timeout=read_timeout, kind="job"
-    )
-    result = next(gen)
-    return result
+    return _default_client(kbatch_url, token).job_logs(job_name, read_timeout)
 
 
 def job_logs_streaming(
@@ -246,9 +369,7 @@ def job_logs_streaming(
     token: str | None = None,
     read_timeout: int = 60,
 ):
-    return _logs(
-        job_name, kbatch_url, token, stream=True, read_timeout=read_timeout, kind="job"
-    )
+    return _default_client(kbatch_url, token).job_logs_streaming(job_name, read_timeout)
 
 
 def pod_logs(
@@ -257,9 +378,7 @@ def pod_logs(
     token: str | None = None,
     read_timeout: int = 60,
 ):
-    gen = _logs(pod_name, kbatch_url, token, stream=False, read_timeout=read_timeout)
-    result = next(gen)
-    return result
+    return _default_client(kbatch_url, token).pod_logs(pod_name, read_timeout)
 
 
 def pod_logs_streaming(
@@ -268,43 +387,7 @@ def pod_logs_streaming(
     token: str | None = None,
     read_timeout: int = 60,
 ):
-    return _logs(pod_name, kbatch_url, token, stream=True, read_timeout=read_timeout)
-
-
-def _logs(
-    name,
-    kbatch_url,
-    token,
-    stream: bool | None = False,
-    read_timeout: int = 60,
-    kind: str = "pod",
-):
-    config = load_config()
-    client = _client(timeout=httpx.Timeout(5, read=read_timeout))
-    token = token or config["token"]
-    kbatch_url = handle_url(kbatch_url, config)
-
-    headers = {
-        "Authorization": f"token {token}",
-    }
-
-    if stream:
-        with client.stream(
-            "GET",
-            urllib.parse.urljoin(kbatch_url, f"{kind}s/logs/{name}/"),
-            headers=headers,
-            params=dict(stream=stream),
-        ) as r:
-            yield from r.iter_text()
-
-    else:
-        r = client.get(
-            urllib.parse.urljoin(kbatch_url, f"{kind}s/logs/{name}/"),
-            headers=headers,
-        )
-        r.raise_for_status()
-
-        yield r.text
+    return _default_client(kbatch_url, token).pod_logs_streaming(pod_name, read_timeout)
 
 
 def job_status(job):
@@ -315,6 +398,9 @@ def job_status(job):
     failed = status["failed"] or 0
     ready = status["ready"] or 0
     active = status["active"] or 0
+    suspended = (job.get("spec") or {}).get("suspend")
+    if suspended and not (failed or succeeded):
+        return "[yellow]queued[/yellow]"
     if failed:
         return "[red]failed[/red]"
     elif ready:
@@ -334,6 +420,9 @@ def pod_status(row):
 
 
 def duration(job) -> str:
+    if not job["status"].get("start_time"):
+        # not started yet, e.g. queued
+        return "-"
     start_time = datetime.datetime.fromisoformat(job["status"]["start_time"])
     end_time: datetime.datetime | None = None
 
@@ -359,6 +448,12 @@ def duration(job) -> str:
         return "-"
 
 
+def queue_position(job) -> str | None:
+    """A queued job's position in the kbatch-proxy submission queue."""
+    annotations = job["metadata"].get("annotations") or {}
+    return annotations.get(QUEUE_POSITION_ANNOTATION)
+
+
 def format_jobs(data):
     table = rich.table.Table(title="Jobs")
 
@@ -366,16 +461,23 @@ def format_jobs(data):
     table.add_column("submitted")
     table.add_column("status")
     table.add_column("duration")
+    # only shown when the proxy is queueing jobs
+    queued = any(queue_position(job) for job in data["items"])
+    if queued:
+        table.add_column("queue position")
 
     for job in sorted(
         data["items"], key=lambda job: job["metadata"]["creation_timestamp"]
     ):
-        table.add_row(
+        row = [
             job["metadata"]["name"],
             job["metadata"]["creation_timestamp"],
             job_status(job),
             duration(job),
-        )
+        ]
+        if queued:
+            row.append(queue_position(job) or "")
+        table.add_row(*row)
 
     return table
 
@@ -417,22 +519,11 @@ def format_pods(data):
 
 
 def show_profiles(kbatch_url: str | None = None):
-    client = _client()
-    config = load_config()
-
-    kbatch_url = handle_url(kbatch_url, config)
-
-    url = urllib.parse.urljoin(kbatch_url, "profiles/")
-    r = client.get(url)
-    r.raise_for_status()
-
-    return r.json()
+    return _default_client(kbatch_url, None).show_profiles()
 
 
 def load_profile(profile_name: str, kbatch_url: str | None = None) -> dict:
-    profiles = show_profiles(kbatch_url)
-    profile = profiles[profile_name]
-    return profile
+    return _default_client(kbatch_url, None).load_profile(profile_name)
 
 
 def _prep_job_data(
@@ -474,7 +565,5 @@ def _prep_job_data(
         env = json.loads(env)
         data["env"] = env
 
-    if profile:
-        profile = load_profile(profile, kbatch_url)
-
+    # profile names are resolved by submit_job
     return data, profile
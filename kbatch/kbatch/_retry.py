@@ -0,0 +1,211 @@
+"""
+Retrying requests to kbatch-proxy.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import time
+from dataclasses import dataclass
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+UNPROCESSED_HEADER = "X-Kbatch-Unprocessed"
+
+
+@dataclass
+class RetryPolicy:
+    """
+    When and how to retry failed requests to kbatch-proxy.
+
+    Requests are retried after responses with one of `statuses` or a
+    connection error, waiting ``backoff_factor * 2 ** retry`` seconds (with
+    jitter, at most `max_backoff`) or as long as the ``Retry-After`` header asks.
+
+    Only requests with one of `methods` are retried by default, since a
+    submission might have been created before the error. Other requests are
+    retried only if the server didn't process them: a connection that couldn't
+    be established, or a response kbatch-proxy marked with the
+    ``X-Kbatch-Unprocessed`` header when shedding load or rate limiting.
+
+    Parameters
+    ----------
+    max_retries : the number of retries. 0 disables retries.
+    backoff_factor : the base of the exponential backoff, in seconds.
+    max_backoff : the longest to wait between retries, in seconds.
+    statuses : the response statuses to retry.
+    methods : the HTTP methods that are safe to retry.
+    """
+
+    max_retries: int = 3
+    backoff_factor: float = 0.5
+    max_backoff: float = 30
+    statuses: frozenset[int] = frozenset({429, 502, 503, 504})
+    methods: frozenset[str] = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def backoff(self, retry: int, response: httpx.Response | None = None) -> float:
+        """Seconds to wait before `retry` (counting from 0)."""
+        if response is not None:
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        delay = min(self.backoff_factor * 2**retry, self.max_backoff)
+        # full jitter, so many clients retrying don't synchronize
+        return random.uniform(0, delay)
+
+    def should_retry_response(self, request: httpx.Request, response: httpx.Response):
+        if response.status_code not in self.statuses:
+            return False
+        if request.method in self.methods:
+            return True
+        # the server declined the request without processing it
+        return response.headers.get(UNPROCESSED_HEADER) == "true"
+
+    def should_retry_error(self, request: httpx.Request, error: Exception):
+        if not isinstance(error, httpx.TransportError):
+            return False
+        if request.method in self.methods:
+            return True
+        # the request was never sent
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+def _retry_delay(
+    policy: RetryPolicy,
+    request: httpx.Request,
+    retry: int,
+    response: httpx.Response | None = None,
+    error: Exception | None = None,
+) -> float | None:
+    """Seconds to wait before retrying `request`, or None to give up."""
+    if retry >= policy.max_retries:
+        return None
+    if error is not None:
+        if not policy.should_retry_error(request, error):
+            return None
+        delay = policy.backoff(retry)
+        reason = type(error).__name__
+    else:
+        assert response is not None
+        if not policy.should_retry_response(request, response):
+            return None
+        delay = policy.backoff(retry, response)
+        reason = str(response.status_code)
+    logger.info(
+        "Retrying %s %s in %.1fs after %s (retry %d of %d)",
+        request.method,
+        request.url,
+        delay,
+        reason,
+        retry + 1,
+        policy.max_retries,
+    )
+    return delay
+
+
+class RetryTransport(httpx.BaseTransport):
+    """An httpx transport retrying requests according to a `RetryPolicy`."""
+
+    def __init__(
+        self,
+        policy: RetryPolicy | None = None,
+        transport: httpx.BaseTransport | None = None,
+    ):
+        self._policy = policy
+        self.transport = transport or httpx.HTTPTransport()
+
+    @property
+    def policy(self) -> RetryPolicy:
+        # without a policy, follow set_retry_policy
+        return self._policy or default_policy
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        retry = 0
+        while True:
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError as e:
+                delay = _retry_delay(self.policy, request, retry, error=e)
+                if delay is None:
+                    raise
+            else:
+                delay = _retry_delay(self.policy, request, retry, response=response)
+                if delay is None:
+                    return response
+                response.close()
+            retry += 1
+            time.sleep(delay)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """The asyncio counterpart of `RetryTransport`."""
+
+    def __init__(
+        self,
+        policy: RetryPolicy | None = None,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self._policy = policy
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    @property
+    def policy(self) -> RetryPolicy:
+        return self._policy or default_policy
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        retry = 0
+        while True:
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                delay = _retry_delay(self.policy, request, retry, error=e)
+                if delay is None:
+                    raise
+            else:
+                delay = _retry_delay(self.policy, request, retry, response=response)
+                if delay is None:
+                    return response
+                await response.aclose()
+            retry += 1
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+default_policy = RetryPolicy()
+
+
+def set_retry_policy(policy: RetryPolicy | None) -> None:
+    """
+    Set the `RetryPolicy` used for requests to kbatch-proxy.
+
+    Pass None to restore the default, or ``RetryPolicy(max_retries=0)`` to
+    disable retries.
+    """
+    global default_policy
+    default_policy = policy or RetryPolicy()
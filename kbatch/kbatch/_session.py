@@ -0,0 +1,837 @@
+"""
+A session with kbatch-proxy.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import time
+import urllib.parse
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
+
+import httpx
+
+from . import _retry
+from ._core import (
+    _add_request_id,
+    _code_digest,
+    _code_uploaded,
+    _load_cached_profiles,
+    _record_code_upload,
+    _resource,
+    _save_cached_profiles,
+    handle_url,
+    load_config,
+)
+from ._spec import make_configmap_data, make_cronjob_data, make_job_data
+from ._types import CronJob, Job
+
+if TYPE_CHECKING:
+    from kubernetes.client.models import V1CronJob, V1Job
+
+logger = logging.getLogger(__name__)
+
+# Set by kbatch-proxy on Jobs submitted with code it keeps for reuse
+CODE_DIGEST_ANNOTATION = "kbatch.jupyter.org/code-digest"
+
+
+# Request bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def _advertised(r: httpx.Response, header: str, values: set[str]) -> set[str]:
+    """
+    The values kbatch-proxy advertises in a `header` of its responses.
+
+    ``Accept-Encoding`` lists the encodings it accepts for request bodies, and
+    ``Accept-Post`` the formats it accepts for submissions. Older versions
+    don't send them, and accept only uncompressed JSON.
+    """
+    value = r.headers.get(header)
+    if value is None:
+        return values
+    return {v.split(";")[0].strip().lower() for v in value.split(",")}
+
+
+def _compress_json(kwargs: dict, encodings: set[str]) -> dict:
+    """Gzip the ``json`` of request `kwargs`, if it's large and accepted."""
+    if kwargs.get("json") is None or "gzip" not in encodings:
+        return kwargs
+    body = json.dumps(kwargs["json"], separators=(",", ":")).encode()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return kwargs
+    kwargs = dict(kwargs)
+    del kwargs["json"]
+    kwargs["content"] = gzip.compress(body, compresslevel=6)
+    kwargs["headers"] = {
+        **(kwargs.get("headers") or {}),
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip",
+    }
+    return kwargs
+
+
+def _submission(data: dict, formats: set[str]) -> dict:
+    """
+    The request kwargs submitting `data`, from `_job_data`.
+
+    The zipped code is sent as is in a multipart request if kbatch-proxy
+    accepts it, rather than base64 encoded in the JSON, a third larger.
+    """
+    code_data = data.get("code")
+    if not code_data:
+        return {"json": data}
+    code = code_data["binary_data"]["code"]
+    if "multipart/form-data" in formats:
+        code_data = {k: v for k, v in code_data.items() if k != "binary_data"}
+        return {
+            "data": {"data": json.dumps({**data, "code": code_data})},
+            "files": {"code": ("code.zip", code, "application/zip")},
+        }
+    code_data = {
+        **code_data,
+        "binary_data": {"code": base64.b64encode(code).decode("ascii")},
+    }
+    return {"json": {**data, "code": code_data}}
+
+
+async def _add_request_id_async(request: httpx.Request) -> None:
+    _add_request_id(request)
+
+
+def _endpoint(
+    method: str,
+    model: type[V1Job | V1CronJob | Job | CronJob],
+    resource_name: str | None = None,
+) -> str:
+    http_methods = ["GET", "DELETE", "POST"]
+    if method not in http_methods:
+        raise ValueError(
+            f"Unknown method specified: {method}. "
+            + "Please select from one of the following: {http_methods}."
+        )
+
+    endpoint = f"{_resource(model)}/"
+
+    if resource_name:
+        endpoint += resource_name
+    return endpoint
+
+
+def _delete_params(
+    selector: str | None = None,
+    status: str | None = None,
+    older_than: str | None = None,
+    all: bool = False,
+) -> dict[str, str]:
+    params: dict[str, str] = {}
+    if all:
+        params["all"] = "true"
+    if selector:
+        params["selector"] = selector
+    if status:
+        params["status"] = status
+    if older_than:
+        params["older_than"] = older_than
+    if not params:
+        raise ValueError("Specify 'all', 'selector', 'status' or 'older_than'.")
+    return params
+
+
+def _job_data(
+    job,
+    model,
+    code: Path | str | None = None,
+    profile: dict | None = None,
+    profile_name: str | None = None,
+    compresslevel: int | None = None,
+    code_digest: str | None = None,
+) -> dict:
+    """
+    The body of a request submitting `job`, with the zipped `code` as bytes.
+
+    See `_submission` for how it's sent. With a `code_digest` and no `code`,
+    kbatch-proxy reuses code with that digest uploaded before.
+    """
+    profile = profile or {}
+
+    if _resource(model) == "jobs":
+        data = make_job_data(job, profile=profile)
+    else:
+        data = make_cronjob_data(job, profile=profile)
+
+    data = {"job": data}
+    if profile_name:
+        # only informational, the profile has already been applied
+        data["profile"] = profile_name
+
+    if code:
+        data["code"] = make_configmap_data(
+            code, generate_name=job.name, compresslevel=compresslevel
+        )
+    if code_digest:
+        data["code_digest"] = code_digest
+    return data
+
+
+def _code_kept(result: dict, digest: str) -> bool:
+    """
+    Whether kbatch-proxy kept the code uploaded with the submission `result`.
+
+    It then annotates the Job (or a CronJob's job template) with the digest.
+    """
+    spec = result.get("spec") or {}
+    for metadata in [
+        result.get("metadata"),
+        (spec.get("job_template") or {}).get("metadata"),
+    ]:
+        annotations = (metadata or {}).get("annotations") or {}
+        if annotations.get(CODE_DIGEST_ANNOTATION) == digest:
+            return True
+    return False
+
+
+def _revalidate_headers(cached: tuple[str | None, dict | None]) -> dict:
+    etag, profiles = cached
+    return {"If-None-Match": etag} if etag and profiles is not None else {}
+
+
+def _revalidated_profiles(
+    kbatch_url: str, cached: tuple[str | None, dict | None], r: httpx.Response
+) -> tuple[str | None, dict]:
+    """The ETag and profiles after revalidating `cached` with the response `r`."""
+    etag, profiles = cached
+    if r.status_code == 304 and profiles is not None:
+        return etag, profiles
+    r.raise_for_status()
+    profiles = r.json()
+    etag = r.headers.get("ETag")
+    if etag:
+        _save_cached_profiles(kbatch_url, etag, profiles)
+    return etag, profiles
+
+
+# The most responses to keep for revalidation with If-None-Match
+MAX_CACHED_RESPONSES = 64
+
+
+def _response_key(path: str, params: dict | None) -> tuple:
+    return (path, tuple(sorted((params or {}).items())))
+
+
+def _conditional_headers(cached: tuple[str, bytes] | None) -> dict:
+    return {"If-None-Match": cached[0]} if cached else {}
+
+
+def _conditional_json(
+    responses: OrderedDict,
+    key: tuple,
+    cached: tuple[str, bytes] | None,
+    r: httpx.Response,
+):
+    """
+    The JSON of the response `r`, or of `cached` if `r` is a 304.
+
+    `cached` is the ETag and body the request was made with, since concurrent
+    requests may evict it from `responses` meanwhile. Responses with an ETag
+    are cached, least recently used evicted first.
+    """
+    if r.status_code == 304 and cached is not None:
+        etag, content = cached
+    else:
+        r.raise_for_status()
+        etag, content = r.headers.get("ETag"), r.content
+    if etag:
+        responses[key] = (etag, content)
+        responses.move_to_end(key)
+        while len(responses) > MAX_CACHED_RESPONSES:
+            responses.popitem(last=False)
+    # parsed again, so callers can't change the cached response
+    return json.loads(content)
+
+
+class _ResumableText:
+    """
+    Track the text received from a log stream, to resume it after reconnecting.
+
+    kbatch-proxy streams logs from the start, so on reconnecting,
+    what has already been received is skipped.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self._skip = 0
+
+    def reconnect(self) -> None:
+        self._skip = self.received
+
+    def feed(self, text: str) -> str:
+        """The part of `text` that hasn't been received before."""
+        if self._skip:
+            skipped, text = text[: self._skip], text[self._skip :]
+            self._skip -= len(skipped)
+        self.received += len(text)
+        return text
+
+
+class KbatchClient:
+    """
+    A session with kbatch-proxy.
+
+    The configuration is loaded once, and connections are reused across
+    requests. Use it as a context manager, or call `close` when done.
+
+    Parameters
+    ----------
+    kbatch_url : the URL of kbatch-proxy. Defaults to the configured URL.
+    token : a JupyterHub API token. Defaults to the configured token.
+    retry : the `RetryPolicy` for requests. Defaults to the policy set
+        with `kbatch.set_retry_policy`.
+    http2 : whether to use HTTP/2. Requires ``httpx[http2]``.
+    compress : whether to gzip large request bodies, once kbatch-proxy has
+        shown it accepts them. Responses are compressed regardless.
+    **kwargs : passed to `httpx.Client`.
+
+    Examples
+    --------
+    >>> with kbatch.KbatchClient() as client:
+    ...     for job in jobs:
+    ...         client.submit_job(job, profile="python")
+    """
+
+    def __init__(
+        self,
+        kbatch_url: str | None = None,
+        token: str | None = None,
+        *,
+        retry: _retry.RetryPolicy | None = None,
+        http2: bool = False,
+        compress: bool = True,
+        **kwargs,
+    ):
+        config = load_config()
+        self.kbatch_url = handle_url(kbatch_url, config)
+        self.token = token or config["token"]
+        self.retry = retry
+        self.compress = compress
+        self._encodings: set[str] = set()
+        self._formats: set[str] = set()
+        self._observed = False
+        self._profiles_cache: tuple[str | None, dict] | None = None
+        self._responses: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+
+        headers = kwargs.pop("headers", {})
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        kwargs.setdefault("follow_redirects", True)
+        kwargs.setdefault("event_hooks", {"request": [_add_request_id]})
+        kwargs.setdefault(
+            "transport",
+            _retry.RetryTransport(retry, httpx.HTTPTransport(http2=http2)),
+        )
+        self._client = httpx.Client(headers=headers, **kwargs)
+
+    def __enter__(self) -> KbatchClient:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the connections to kbatch-proxy."""
+        self._client.close()
+
+    def _url(self, path: str) -> str:
+        return urllib.parse.urljoin(self.kbatch_url, path)
+
+    def _observe(self, r: httpx.Response) -> None:
+        """Note what kbatch-proxy accepts in requests, from a response."""
+        self._encodings = _advertised(r, "Accept-Encoding", self._encodings)
+        self._formats = _advertised(r, "Accept-Post", self._formats)
+        self._observed = True
+
+    def _probe(self) -> None:
+        """
+        Learn what kbatch-proxy accepts, if no response showed it yet.
+
+        Done before uploading code, so even the first upload is sent as
+        compactly as kbatch-proxy allows.
+        """
+        if self._observed:
+            return
+        try:
+            self._observe(self._client.get(self._url("")))
+        except httpx.HTTPError as e:
+            logger.debug("Couldn't probe %s: %s", self.kbatch_url, e)
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        if self.compress:
+            kwargs = _compress_json(kwargs, self._encodings)
+        r = self._client.request(method, self._url(path), **kwargs)
+        self._observe(r)
+        r.raise_for_status()
+        return r
+
+    def _get_json(self, path: str, params: dict | None = None):
+        """
+        GET JSON, revalidating the last response to the same request.
+
+        kbatch-proxy answers 304 if it's unchanged, so polling doesn't download
+        the same job lists again.
+        """
+        key = _response_key(path, params)
+        cached = self._responses.get(key)
+        r = self._client.get(
+            self._url(path), params=params, headers=_conditional_headers(cached)
+        )
+        self._observe(r)
+        return _conditional_json(self._responses, key, cached, r)
+
+    def _request_action(
+        self,
+        method: str,
+        model: type[V1Job | V1CronJob | Job | CronJob],
+        resource_name: str | None = None,
+        json_data: dict | None = None,
+        params: dict | None = None,
+    ):
+        endpoint = _endpoint(method, model, resource_name)
+        return self._request(method, endpoint, json=json_data, params=params).json()
+
+    def show_job(self, resource_name: str, model=Job):
+        return self._get_json(_endpoint("GET", model, resource_name))
+
+    def delete_job(self, resource_name: str, model=Job):
+        return self._request_action("DELETE", model, resource_name)
+
+    def delete_jobs(
+        self,
+        selector: str | None = None,
+        status: str | None = None,
+        older_than: str | None = None,
+        all: bool = False,
+    ):
+        """
+        Delete many jobs in a single request.
+
+        Parameters
+        ----------
+        selector : Kubernetes label selector the jobs must match.
+        status : only delete jobs with this status,
+            one of "failed", "running", "pending", "done" or "queued".
+        older_than : only delete jobs older than this, e.g. "3600", "30m", "12h", "7d".
+        all : delete every job. Required if no other filter is given.
+
+        Returns
+        -------
+        A dict with the names of the deleted jobs under "deleted".
+        """
+        params = _delete_params(selector, status, older_than, all)
+        return self._request_action("DELETE", Job, params=params)
+
+    def list_jobs(self, model=Job):
+        return self._get_json(_endpoint("GET", model))
+
+    def submit_job(
+        self,
+        job,
+        model=Job,
+        code: Path | str | None = None,
+        profile: str | dict | None = None,
+        compresslevel: int | None = None,
+    ):
+        """
+        Submit a job.
+
+        `code` is a file or directory to make available to the job. See
+        `kbatch.archive` for the files included and `compresslevel`. If the
+        same code was submitted before, only its digest is sent, unless
+        kbatch-proxy no longer has it.
+        """
+        profile_name = None
+        if isinstance(profile, str):
+            profile_name = profile
+            profile = self.load_profile(profile)
+        if not code:
+            data = _job_data(job, model, None, profile, profile_name)
+            return self._request_action("POST", model, json_data=data)
+
+        digest = _code_digest(code)
+        if _code_uploaded(self.kbatch_url, digest):
+            data = _job_data(
+                job, model, None, profile, profile_name, code_digest=digest
+            )
+            try:
+                return self._request_action("POST", model, json_data=data)
+            except httpx.HTTPStatusError as e:
+                # kbatch-proxy no longer has the code, e.g. its jobs were deleted
+                if e.response.status_code != 409:
+                    raise
+                logger.info("Uploading code %s again", digest)
+
+        data = _job_data(
+            job, model, code, profile, profile_name, compresslevel, code_digest=digest
+        )
+        self._probe()
+        kwargs = _submission(data, self._formats)
+        result = self._request("POST", _endpoint("POST", model), **kwargs).json()
+        if _code_kept(result, digest):
+            _record_code_upload(self.kbatch_url, digest)
+        return result
+
+    def list_pods(self, job_name: str | None = None):
+        return self._get_json("pods/", params=dict(job_name=job_name))
+
+    def job_logs(self, job_name: str, read_timeout: int = 60) -> str:
+        return self._logs(job_name, read_timeout=read_timeout, kind="job")
+
+    def job_logs_streaming(
+        self, job_name: str, read_timeout: int = 60
+    ) -> Iterator[str]:
+        return self._logs_streaming(job_name, read_timeout=read_timeout, kind="job")
+
+    def pod_logs(self, pod_name: str, read_timeout: int = 60) -> str:
+        return self._logs(pod_name, read_timeout=read_timeout)
+
+    def pod_logs_streaming(
+        self, pod_name: str, read_timeout: int = 60
+    ) -> Iterator[str]:
+        return self._logs_streaming(pod_name, read_timeout=read_timeout)
+
+    def _logs(self, name: str, read_timeout: int = 60, kind: str = "pod") -> str:
+        return self._request(
+            "GET",
+            f"{kind}s/logs/{name}/",
+            timeout=httpx.Timeout(5, read=read_timeout),
+        ).text
+
+    def _logs_streaming(
+        self, name: str, read_timeout: int = 60, kind: str = "pod"
+    ) -> Iterator[str]:
+        policy = self.retry or _retry.default_policy
+        resumable = _ResumableText()
+        retry = 0
+        while True:
+            resumable.reconnect()
+            try:
+                with self._client.stream(
+                    "GET",
+                    self._url(f"{kind}s/logs/{name}/"),
+                    params=dict(stream=True),
+                    timeout=httpx.Timeout(5, read=read_timeout),
+                ) as r:
+                    r.raise_for_status()
+                    for text in r.iter_text():
+                        text = resumable.feed(text)
+                        if text:
+                            retry = 0
+                            yield text
+                return
+            except (httpx.ReadError, httpx.RemoteProtocolError):
+                if retry >= policy.max_retries:
+                    raise
+                logger.info(
+                    "Log stream interrupted, resuming at %d", resumable.received
+                )
+                time.sleep(policy.backoff(retry))
+                retry += 1
+
+    def show_profiles(self) -> dict:
+        """
+        The profiles offered by kbatch-proxy.
+
+        They're cached on disk next to the configuration, and revalidated with
+        ``If-None-Match``, so they're only downloaded again when they change.
+        """
+        cached = self._profiles_cache or _load_cached_profiles(self.kbatch_url)
+        r = self._client.get(
+            self._url("profiles/"), headers=_revalidate_headers(cached)
+        )
+        self._observe(r)
+        self._profiles_cache = _revalidated_profiles(self.kbatch_url, cached, r)
+        return self._profiles_cache[1]
+
+    def load_profile(self, profile_name: str) -> dict:
+        return self.show_profiles()[profile_name]
+
+
+class AsyncKbatchClient:
+    """
+    An asyncio session with kbatch-proxy.
+
+    Mirrors `KbatchClient`, for submitting and monitoring many jobs concurrently.
+    At most `max_concurrency` requests are in flight at once; further requests
+    wait for a slot. Log streams only hold a slot while connecting.
+
+    Parameters
+    ----------
+    kbatch_url : the URL of kbatch-proxy. Defaults to the configured URL.
+    token : a JupyterHub API token. Defaults to the configured token.
+    max_concurrency : the maximum number of requests in flight.
+    retry : the `RetryPolicy` for requests. Defaults to the policy set
+        with `kbatch.set_retry_policy`.
+    http2 : whether to use HTTP/2. Requires ``httpx[http2]``.
+    compress : whether to gzip large request bodies. See `KbatchClient`.
+    **kwargs : passed to `httpx.AsyncClient`.
+
+    Examples
+    --------
+    >>> async with kbatch.AsyncKbatchClient(max_concurrency=50) as client:
+    ...     results = await asyncio.gather(
+    ...         *(client.submit_job(job, profile="python") for job in jobs)
+    ...     )
+    """
+
+    def __init__(
+        self,
+        kbatch_url: str | None = None,
+        token: str | None = None,
+        *,
+        max_concurrency: int = 20,
+        retry: _retry.RetryPolicy | None = None,
+        http2: bool = False,
+        compress: bool = True,
+        **kwargs,
+    ):
+        config = load_config()
+        self.kbatch_url = handle_url(kbatch_url, config)
+        self.token = token or config["token"]
+        self.retry = retry
+        self.compress = compress
+        self._encodings: set[str] = set()
+        self._formats: set[str] = set()
+        self._observed = False
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._profiles_cache: tuple[str | None, dict] | None = None
+        self._responses: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+        self._profiles_lock = asyncio.Lock()
+        self._probe_lock = asyncio.Lock()
+        # counts completed revalidations of the profiles
+        self._profiles_generation = 0
+
+        headers = kwargs.pop("headers", {})
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        kwargs.setdefault("follow_redirects", True)
+        kwargs.setdefault("event_hooks", {"request": [_add_request_id_async]})
+        kwargs.setdefault(
+            "transport",
+            _retry.AsyncRetryTransport(retry, httpx.AsyncHTTPTransport(http2=http2)),
+        )
+        self._client = httpx.AsyncClient(headers=headers, **kwargs)
+
+    async def __aenter__(self) -> AsyncKbatchClient:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the connections to kbatch-proxy."""
+        await self._client.aclose()
+
+    def _url(self, path: str) -> str:
+        return urllib.parse.urljoin(self.kbatch_url, path)
+
+    def _observe(self, r: httpx.Response) -> None:
+        """Note what kbatch-proxy accepts in requests, from a response."""
+        self._encodings = _advertised(r, "Accept-Encoding", self._encodings)
+        self._formats = _advertised(r, "Accept-Post", self._formats)
+        self._observed = True
+
+    async def _probe(self) -> None:
+        """Learn what kbatch-proxy accepts, if no response showed it yet."""
+        # concurrent uploads share a single probe
+        async with self._probe_lock:
+            if self._observed:
+                return
+            try:
+                async with self._semaphore:
+                    r = await self._client.get(self._url(""))
+            except httpx.HTTPError as e:
+                logger.debug("Couldn't probe %s: %s", self.kbatch_url, e)
+            else:
+                self._observe(r)
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        if self.compress and kwargs.get("json") is not None:
+            # compressing code may take a while, so keep it off the event loop
+            kwargs = await asyncio.to_thread(_compress_json, kwargs, self._encodings)
+        async with self._semaphore:
+            r = await self._client.request(method, self._url(path), **kwargs)
+        self._observe(r)
+        r.raise_for_status()
+        return r
+
+    async def _get_json(self, path: str, params: dict | None = None):
+        """GET JSON, revalidating the last response to the same request."""
+        key = _response_key(path, params)
+        cached = self._responses.get(key)
+        async with self._semaphore:
+            r = await self._client.get(
+                self._url(path), params=params, headers=_conditional_headers(cached)
+            )
+        self._observe(r)
+        return _conditional_json(self._responses, key, cached, r)
+
+    async def _request_action(
+        self,
+        method: str,
+        model: type[V1Job | V1CronJob | Job | CronJob],
+        resource_name: str | None = None,
+        json_data: dict | None = None,
+        params: dict | None = None,
+    ):
+        endpoint = _endpoint(method, model, resource_name)
+        r = await self._request(method, endpoint, json=json_data, params=params)
+        return r.json()
+
+    async def show_job(self, resource_name: str, model=Job):
+        return await self._get_json(_endpoint("GET", model, resource_name))
+
+    async def delete_job(self, resource_name: str, model=Job):
+        return await self._request_action("DELETE", model, resource_name)
+
+    async def delete_jobs(
+        self,
+        selector: str | None = None,
+        status: str | None = None,
+        older_than: str | None = None,
+        all: bool = False,
+    ):
+        """Delete many jobs in a single request. See `KbatchClient.delete_jobs`."""
+        params = _delete_params(selector, status, older_than, all)
+        return await self._request_action("DELETE", Job, params=params)
+
+    async def list_jobs(self, model=Job):
+        return await self._get_json(_endpoint("GET", model))
+
+    async def submit_job(
+        self,
+        job,
+        model=Job,
+        code: Path | str | None = None,
+        profile: str | dict | None = None,
+        compresslevel: int | None = None,
+    ):
+        """
+        Submit a job.
+
+        `code` is a file or directory to make available to the job. See
+        `kbatch.archive` for the files included and `compresslevel`. If the
+        same code was submitted before, only its digest is sent, unless
+        kbatch-proxy no longer has it.
+        """
+        profile_name = None
+        if isinstance(profile, str):
+            profile_name = profile
+            profile = await self.load_profile(profile)
+        if not code:
+            data = _job_data(job, model, None, profile, profile_name)
+            return await self._request_action("POST", model, json_data=data)
+
+        # hashing and zipping the code may take a while, so keep it off the event loop
+        digest = await asyncio.to_thread(_code_digest, code)
+        if _code_uploaded(self.kbatch_url, digest):
+            data = _job_data(
+                job, model, None, profile, profile_name, code_digest=digest
+            )
+            try:
+                return await self._request_action("POST", model, json_data=data)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 409:
+                    raise
+                logger.info("Uploading code %s again", digest)
+
+        data = await asyncio.to_thread(
+            _job_data,
+            job,
+            model,
+            code,
+            profile,
+            profile_name,
+            compresslevel,
+            code_digest=digest,
+        )
+        await self._probe()
+        kwargs = await asyncio.to_thread(_submission, data, self._formats)
+        r = await self._request("POST", _endpoint("POST", model), **kwargs)
+        result = r.json()
+        if _code_kept(result, digest):
+            _record_code_upload(self.kbatch_url, digest)
+        return result
+
+    async def list_pods(self, job_name: str | None = None):
+        return await self._get_json("pods/", params=dict(job_name=job_name))
+
+    async def job_logs(self, job_name: str, read_timeout: int = 60) -> str:
+        r = await self._request(
+            "GET",
+            f"jobs/logs/{job_name}/",
+            timeout=httpx.Timeout(5, read=read_timeout),
+        )
+        return r.text
+
+    async def job_logs_streaming(
+        self, job_name: str, read_timeout: int = 60
+    ) -> AsyncIterator[str]:
+        policy = self.retry or _retry.default_policy
+        resumable = _ResumableText()
+        retry = 0
+        while True:
+            resumable.reconnect()
+            try:
+                async with AsyncExitStack() as stack:
+                    async with self._semaphore:
+                        r = await stack.enter_async_context(
+                            self._client.stream(
+                                "GET",
+                                self._url(f"jobs/logs/{job_name}/"),
+                                params=dict(stream=True),
+                                timeout=httpx.Timeout(5, read=read_timeout),
+                            )
+                        )
+                    r.raise_for_status()
+                    async for text in r.aiter_text():
+                        text = resumable.feed(text)
+                        if text:
+                            retry = 0
+                            yield text
+                return
+            except (httpx.ReadError, httpx.RemoteProtocolError):
+                if retry >= policy.max_retries:
+                    raise
+                logger.info(
+                    "Log stream interrupted, resuming at %d", resumable.received
+                )
+                await asyncio.sleep(policy.backoff(retry))
+                retry += 1
+
+    async def show_profiles(self) -> dict:
+        cached = self._profiles_cache or _load_cached_profiles(self.kbatch_url)
+        async with self._semaphore:
+            r = await self._client.get(
+                self._url("profiles/"), headers=_revalidate_headers(cached)
+            )
+        self._observe(r)
+        self._profiles_cache = _revalidated_profiles(self.kbatch_url, cached, r)
+        return self._profiles_cache[1]
+
+    async def load_profile(self, profile_name: str) -> dict:
+        # Revalidated before use, like KbatchClient. Concurrent submissions
+        # waiting on a revalidation in flight share its result.
+        generation = self._profiles_generation
+        async with self._profiles_lock:
+            if self._profiles_generation == generation or self._profiles_cache is None:
+                profiles = await self.show_profiles()
+                self._profiles_generation += 1
+            else:
+                profiles = self._profiles_cache[1]
+        return profiles[profile_name]
@@ -0,0 +1,168 @@
+"""
+Build the JSON submitted to kbatch-proxy for Jobs and CronJobs.
+
+This is the same data as ``make_job(...).to_dict()`` (see `_backend`), without
+the null fields, built without the Kubernetes models. Importing and building
+those is slow, and kbatch-proxy parses the submitted JSON into them anyway.
+"""
+
+from __future__ import annotations
+
+import pathlib
+
+from ._archive import archive
+from ._types import CronJob, Job
+
+
+def _make_job_spec(
+    job: Job | CronJob,
+    profile: dict | None = None,
+    labels: dict | None = None,
+    annotations: dict | None = None,
+) -> dict:
+    profile = profile or {}
+    image = job.image or profile.get("image", None)
+    if image is None:
+        raise TypeError(
+            "Must specify 'image', either with `--image` or from the profile."
+        )
+
+    resources = profile.get("resources", {})
+    container: dict = {
+        "image": image,
+        "name": "job",
+        "resources": {
+            "requests": dict(resources.get("requests", {})),
+            "limits": dict(resources.get("limits", {})),
+        },
+        "working_dir": "/code",
+    }
+    if job.args is not None:
+        container["args"] = job.args
+    if job.command is not None:
+        container["command"] = job.command
+    if job.env:
+        container["env"] = [
+            _without_nulls({"name": k, "value": v}) for k, v in job.env.items()
+        ]
+
+    pod_spec: dict = {"containers": [container], "restart_policy": "Never"}
+    if profile.get("tolerations", []):
+        pod_spec["tolerations"] = [_without_nulls(t) for t in profile["tolerations"]]
+    affinity = _make_affinity(profile.get("node_affinity_required", {}))
+    if affinity:
+        pod_spec["affinity"] = affinity
+    if profile.get("priority_class_name") is not None:
+        pod_spec["priority_class_name"] = profile["priority_class_name"]
+
+    pod_metadata: dict = {"name": f"{job.name}-pod"}
+    if labels is not None:
+        pod_metadata["labels"] = dict(labels)
+    if annotations is not None:
+        pod_metadata["annotations"] = dict(annotations)
+
+    return {
+        "template": {"spec": pod_spec, "metadata": pod_metadata},
+        "backoff_limit": 0,
+        "ttl_seconds_after_finished": 300,
+    }
+
+
+def _make_affinity(node_affinity_required: list) -> dict | None:
+    if not node_affinity_required:
+        return None
+    terms: dict[str, list] = {"match_expressions": [], "match_fields": []}
+    for d in node_affinity_required:
+        for k, affinities in d.items():
+            if k == "matchExpressions":
+                key = "match_expressions"
+            elif k == "matchFields":
+                key = "match_fields"
+            else:
+                raise ValueError(
+                    f"Key must be 'matchExpressions' or 'matchFields'. Got {k} instead."
+                )
+            for v in affinities:
+                terms[key].append(
+                    _without_nulls(
+                        {
+                            "key": v.get("key"),
+                            "operator": v.get("operator"),
+                            "values": v.get("values"),
+                        }
+                    )
+                )
+    selector = {"node_selector_terms": [terms]}
+    return {
+        "node_affinity": {
+            "required_during_scheduling_ignored_during_execution": selector
+        }
+    }
+
+
+def _without_nulls(d: dict) -> dict:
+    return {k: v for k, v in d.items() if v is not None}
+
+
+def _make_job_name(name: str, schedule: str | None = None):
+    generate_name = name
+    if not name.endswith("-"):
+        generate_name = name + "-"
+    if schedule:
+        generate_name += "cron-"
+    return generate_name
+
+
+def make_job_data(job: Job, profile: dict | None = None) -> dict:
+    """
+    The JSON of a Kubernetes Job for a user-submitted job.
+    """
+    job_spec = _make_job_spec(job, profile, labels={}, annotations={})
+    return {
+        "api_version": "batch/v1",
+        "kind": "Job",
+        "metadata": {
+            "generate_name": _make_job_name(job.name),
+            "annotations": {},
+            "labels": {},
+        },
+        "spec": job_spec,
+    }
+
+
+def make_cronjob_data(cronjob: CronJob, profile: dict | None = None) -> dict:
+    """
+    The JSON of a Kubernetes CronJob for a user-submitted cronjob.
+    """
+    job_spec = _make_job_spec(cronjob, profile, labels={}, annotations={})
+    generate_name = _make_job_name(cronjob.name, schedule=cronjob.schedule)
+
+    def metadata():
+        return {"generate_name": generate_name, "annotations": {}, "labels": {}}
+
+    return {
+        "api_version": "batch/v1",
+        "kind": "CronJob",
+        "metadata": metadata(),
+        "spec": {
+            "schedule": cronjob.schedule,
+            "job_template": {"metadata": metadata(), "spec": job_spec},
+            "starting_deadline_seconds": 300,
+        },
+    }
+
+
+def make_configmap_data(
+    code: str | pathlib.Path, generate_name: str, compresslevel: int | None = None
+) -> dict:
+    """
+    The JSON of the ConfigMap holding the zipped `code`, as bytes.
+
+    See `archive` for `compresslevel`.
+    """
+    return {
+        "api_version": "v1",
+        "binary_data": {"code": archive(code, compresslevel=compresslevel)},
+        "kind": "ConfigMap",
+        "metadata": {"generate_name": generate_name},
+    }
@@ -1,5 +1,6 @@
 import logging
 import sys
+import time
 from contextlib import contextmanager
 from typing import Iterator
 
@@ -7,7 +8,6 @@ import click
 import httpx
 import rich
 import rich.logging
-from kubernetes.client.models import V1CronJob, V1Job
 
 from . import __version__, _core
 from ._types import CronJob, Job
@@ -35,6 +35,9 @@ def _render_http_error() -> Iterator:
             msg = response_json["detail"]
         except (ValueError, KeyError):
             msg = response.text
+        request_id = e.request.headers.get(_core.REQUEST_ID_HEADER)
+        if request_id:
+            msg = f"{msg} (request id: {request_id})"
         sys.exit(f"kbatch-proxy error {response.status_code}: {msg}")
 
 
@@ -84,7 +87,7 @@ def cronjob():
 @click.argument("cronjob_name")
 def show_cronjob(cronjob_name, kbatch_url, token):
     """Show the details for a cronjob."""
-    result = _core.show_job(cronjob_name, kbatch_url, token, V1CronJob)
+    result = _core.show_job(cronjob_name, kbatch_url, token, CronJob)
     rich.print_json(data=result)
 
 
@@ -94,7 +97,7 @@ def show_cronjob(cronjob_name, kbatch_url, token):
 @click.argument("cronjob_name")
 def delete_cronjob(cronjob_name, kbatch_url, token):
     """Delete a cronjob, cancelling running jobs and pods."""
-    result = _core.delete_job(cronjob_name, kbatch_url, token, V1CronJob)
+    result = _core.delete_job(cronjob_name, kbatch_url, token, CronJob)
     rich.print_json(data=result)
 
 
@@ -110,7 +113,7 @@ def delete_cronjob(cronjob_name, kbatch_url, token):
 )
 def list_cronjobs(kbatch_url, token, output):
     """List all the cronjobs."""
-    results = _core.list_jobs(kbatch_url, token, V1CronJob)
+    results = _core.list_jobs(kbatch_url, token, CronJob)
 
     if output == "json":
         rich.print_json(data=results)
@@ -131,6 +134,11 @@ def list_cronjobs(kbatch_url, token, output):
     "--code",
     help="Local file or directory of source code to make available to the cronjob.",
 )
+@click.option(
+    "--compression-level",
+    type=click.IntRange(0, 9),
+    help="Compression of the code, from 0 (none) to 9 (smallest).",
+)
 @click.option("-p", "--profile", help="Profile name to use. See 'kbatch profiles'.")
 @click.option("-f", "--file", help="Configuration file.")
 @click.option("--kbatch-url", help="URL to the kbatch server.")
@@ -145,6 +153,7 @@ def list_cronjobs(kbatch_url, token, output):
 def submit_cronjob(
     file,
     code,
+    compression_level,
     name,
     description,
     image,
@@ -184,9 +193,10 @@ def submit_cronjob(
         job=cronjob,
         kbatch_url=kbatch_url,
         token=token,
-        model=V1CronJob,
+        model=CronJob,
         code=code,
         profile=profile,
+        compresslevel=compression_level,
     )
     if output == "json":
         rich.print_json(data=result)
@@ -207,17 +217,51 @@ def job():
 @click.argument("job_name")
 def show_job(job_name, kbatch_url, token):
     """Show the details for a job."""
-    result = _core.show_job(job_name, kbatch_url, token, V1Job)
+    result = _core.show_job(job_name, kbatch_url, token, Job)
     rich.print_json(data=result)
 
 
 @job.command(name="delete")
 @click.option("--kbatch-url", help="URL to the kbatch server.")
 @click.option("--token", help="kbatch auth token")
-@click.argument("job_name")
-def delete_job(job_name, kbatch_url, token):
-    """Delete a job, cancelling running pods."""
-    result = _core.delete_job(job_name, kbatch_url, token, V1Job)
+@click.option("--all", "all_", is_flag=True, help="Delete all jobs.")
+@click.option(
+    "--status",
+    help="Delete jobs with this status.",
+    type=click.Choice(["failed", "running", "pending", "done", "queued"]),
+)
+@click.option("--selector", help="Delete jobs matching this label selector.")
+@click.option(
+    "--older-than", help="Delete jobs older than this, e.g. '3600', '30m', '7d'."
+)
+@click.argument("job_name", required=False)
+def delete_job(job_name, kbatch_url, token, all_, status, selector, older_than):
+    """
+    Delete a job, cancelling running pods.
+
+    Pass --all, --status, --selector and/or --older-than instead of
+    JOB_NAME to delete many jobs in a single request.
+    """
+    bulk = all_ or status or selector or older_than
+    if job_name and bulk:
+        raise click.UsageError(
+            "JOB_NAME cannot be combined with --all, --status, --selector or --older-than."
+        )
+    if job_name:
+        result = _core.delete_job(job_name, kbatch_url, token, Job)
+    elif bulk:
+        result = _core.delete_jobs(
+            kbatch_url,
+            token,
+            selector=selector,
+            status=status,
+            older_than=older_than,
+            all=all_,
+        )
+    else:
+        raise click.UsageError(
+            "Specify JOB_NAME, or --all, --status, --selector or --older-than."
+        )
     rich.print_json(data=result)
 
 
@@ -231,14 +275,37 @@ def delete_job(job_name, kbatch_url, token):
     type=click.Choice(["json", "table"]),
     default="table",
 )
-def list_jobs(kbatch_url, token, output):
+@click.option(
+    "-w",
+    "--watch",
+    is_flag=True,
+    help="Keep listing the jobs, printing them again when they change.",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0.5),
+    default=5.0,
+    show_default=True,
+    help="Seconds between listings with --watch.",
+)
+def list_jobs(kbatch_url, token, output, watch, interval):
     """List all the jobs."""
-    results = _core.list_jobs(kbatch_url, token, V1Job)
-
-    if output == "json":
-        rich.print_json(data=results)
-    elif output == "table":
-        rich.print(_core.format_jobs(results))
+    previous = None
+    while True:
+        # unchanged listings are revalidated with the server, not downloaded
+        results = _core.list_jobs(kbatch_url, token, Job)
+        if results != previous:
+            if output == "json":
+                rich.print_json(data=results)
+            elif output == "table":
+                rich.print(_core.format_jobs(results))
+            previous = results
+        if not watch:
+            break
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            break
 
 
 @job.command(name="submit")
@@ -253,6 +320,11 @@ def list_jobs(kbatch_url, token, output):
     "--code",
     help="Local file or directory of source code to make available to the job.",
 )
+@click.option(
+    "--compression-level",
+    type=click.IntRange(0, 9),
+    help="Compression of the code, from 0 (none) to 9 (smallest).",
+)
 @click.option("-p", "--profile", help="Profile name to use. See 'kbatch profiles'.")
 @click.option("-f", "--file", help="Configuration file.")
 @click.option("--kbatch-url", help="URL to the kbatch server.")
@@ -267,6 +339,7 @@ def list_jobs(kbatch_url, token, output):
 def submit_job(
     file,
     code,
+    compression_level,
     name,
     description,
     image,
@@ -302,9 +375,10 @@ def submit_job(
         job,
         kbatch_url=kbatch_url,
         token=token,
-        model=V1Job,
+        model=Job,
         code=code,
         profile=profile,
+        compresslevel=compression_level,
     )
     if output == "json":
         rich.print_json(data=result)
@@ -1,5 +1,11 @@
-from kbatch._backend import make_job
-from kbatch._types import Job
+import io
+import zipfile
+
+import pytest
+
+from kbatch._backend import make_configmap, make_cronjob, make_job
+from kbatch._spec import make_configmap_data, make_cronjob_data, make_job_data
+from kbatch._types import CronJob, Job
 
 
 def test_profile_image():
@@ -61,3 +67,89 @@ def test_profile_sets_tolerations():
         a2 = a.to_dict()
         a2.pop("toleration_seconds")
         assert a2 == b
+
+
+def test_profile_sets_priority_class():
+    job = Job(name="test", image="alpine")
+    result = make_job(job, profile=dict(priority_class_name="interactive"))
+    assert result.spec.template.spec.priority_class_name == "interactive"
+
+    result = make_job(job, profile={})
+    assert result.spec.template.spec.priority_class_name is None
+
+
+def _remove_nulls(d):
+    if isinstance(d, dict):
+        return {k: _remove_nulls(v) for k, v in d.items() if v is not None}
+    elif isinstance(d, list):
+        return [_remove_nulls(v) for v in d]
+    return d
+
+
+PROFILES = [
+    {},
+    {"image": "alpine"},
+    {
+        "resources": {
+            "requests": {"cpu": "0.5", "memory": "0.5Gi"},
+            "limits": {"cpu": "1", "memory": "1Gi", "nvidia.com/gpu": "1"},
+        },
+        "tolerations": [
+            {"key": "nvidia.com/gpu", "operator": "Exists", "effect": "NoSchedule"},
+            {"key": "dedicated", "operator": "Equal", "value": "user"},
+        ],
+        "node_affinity_required": [
+            {
+                "matchExpressions": [
+                    {"key": "kind", "operator": "In", "values": ["gpu"]},
+                    {"key": "spot", "operator": "DoesNotExist"},
+                ]
+            },
+            {"matchFields": [{"key": "name", "operator": "In", "values": ["a"]}]},
+        ],
+        "priority_class_name": "interactive",
+    },
+]
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+@pytest.mark.parametrize(
+    "job",
+    [
+        Job(name="test", image="python"),
+        Job(
+            name="test-",
+            image="python",
+            command=["python", "main.py"],
+            args=["--n", "1"],
+            env={"KEY": "VALUE", "OTHER": "2"},
+        ),
+    ],
+)
+def test_make_job_data(job, profile):
+    expected = _remove_nulls(make_job(job, profile=profile).to_dict())
+    assert make_job_data(job, profile=profile) == expected
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+def test_make_cronjob_data(profile):
+    cronjob = CronJob(
+        name="test", schedule="0 22 * * 1-5", image="python", env={"KEY": "VALUE"}
+    )
+    expected = _remove_nulls(make_cronjob(cronjob, profile=profile).to_dict())
+    assert make_cronjob_data(cronjob, profile=profile) == expected
+
+
+def test_make_configmap_data(tmp_path):
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "main.py").write_text("print('hi')")
+    (tmp_path / "setup.py").write_text("")
+
+    data = make_configmap_data(tmp_path, generate_name="test")
+    expected = _remove_nulls(make_configmap(tmp_path, generate_name="test").to_dict())
+    code = data["binary_data"].pop("code")
+    assert expected["binary_data"].pop("code") == code
+    assert data == expected
+    with zipfile.ZipFile(io.BytesIO(code)) as zf:
+        assert sorted(zf.namelist()) == ["pkg/", "pkg/main.py", "setup.py"]
+        assert zf.read("pkg/main.py") == b"print('hi')"
@@ -1,4 +1,7 @@
+import json
 import pathlib
+import subprocess
+import sys
 
 import httpx
 from kubernetes.client.models import V1CronJob
@@ -6,6 +9,8 @@ from kubernetes.client.models import V1CronJob
 import kbatch
 
 HERE = pathlib.Path(__file__).parent
+# seconds to import the CLI, importing kubernetes alone takes longer
+STARTUP_BUDGET = 0.5
 
 
 def mock_upload(request):
@@ -112,3 +117,20 @@ def test_submit_script_cronjob(respx_mock):
 
     # not really testing much here :/
     assert result == expected
+
+
+def test_cli_startup():
+    code = (
+        "import sys, time, json; start = time.perf_counter(); import kbatch.cli; "
+        "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))"
+    )
+    # best of a few cold starts, to tolerate noisy machines
+    durations = []
+    for _ in range(3):
+        output = subprocess.check_output([sys.executable, "-c", code])
+        duration, modules = json.loads(output)
+        durations.append(duration)
+        # only submitting jobs needs kubernetes
+        assert "kubernetes" not in modules
+        assert "kbatch._backend" not in modules
+    assert min(durations) < STARTUP_BUDGET
@@ -1,4 +1,7 @@
+import asyncio
+import base64
 import contextlib
+import gzip
 import io
 import json
 import os
@@ -6,6 +9,7 @@ import pathlib
 import re
 import zipfile
 from types import GeneratorType
+from unittest import mock
 
 import httpx
 import kubernetes
@@ -103,6 +107,50 @@ def test_make_configmap(tmp_path: pathlib.Path, as_dir: bool):
         assert b"ls" in result.binary_data["code"]
 
 
+def test_archive_ignore(tmp_path: pathlib.Path):
+    files = [
+        "main.py",
+        "data/keep.csv",
+        "data/big.parquet",
+        "logs/run.log",
+        "pkg/__pycache__/mod.cpython-311.pyc",
+        "pkg/mod.py",
+        "pkg/scratch.txt",
+        "pkg/notes.txt",
+        ".git/HEAD",
+        ".venv/pyvenv.cfg",
+        ".venv/lib/site.py",
+    ]
+    for name in files:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(name)
+    (tmp_path / ".gitignore").write_text("# comment\n*.parquet\nlogs/\n")
+    (tmp_path / "pkg" / ".kbatchignore").write_text("*.txt\n!notes.txt\n/mod.py\n")
+
+    data = kbatch.archive(tmp_path)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        assert zf.read("pkg/notes.txt") == b"pkg/notes.txt"
+    assert names == [
+        ".gitignore",
+        "data/keep.csv",
+        "main.py",
+        "pkg/.kbatchignore",
+        "pkg/notes.txt",
+    ]
+
+
+@pytest.mark.parametrize("compresslevel", [0, 1, 9])
+def test_archive_compresslevel(tmp_path: pathlib.Path, compresslevel):
+    (tmp_path / "main.py").write_text("print('hello')\n" * 100)
+    data = kbatch.archive(tmp_path, compresslevel=compresslevel)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        info = zf.getinfo("main.py")
+        assert zf.read("main.py") == b"print('hello')\n" * 100
+    expected = zipfile.ZIP_STORED if compresslevel == 0 else zipfile.ZIP_DEFLATED
+    assert info.compress_type == expected
+
+
 @contextlib.contextmanager
 def tmp_env(key, value):
     original = os.environ.get(key, None)
@@ -116,6 +164,15 @@ def tmp_env(key, value):
             os.environ[key] = original
 
 
+def test_resource():
+    assert kbatch._core._resource(kbatch.Job) == "jobs"
+    assert kbatch._core._resource(kbatch.CronJob) == "cronjobs"
+    assert kbatch._core._resource(kubernetes.client.V1Job) == "jobs"
+    assert kbatch._core._resource(kubernetes.client.V1CronJob) == "cronjobs"
+    with pytest.raises(ValueError, match="Unknown resource"):
+        kbatch._core._resource(kubernetes.client.V1Pod)
+
+
 def test_handle_url():
     config = {"kbatch_url": "http://kbatch-config.com/"}
     result = kbatch._core.handle_url("http://kbatch.com/", config)
@@ -205,6 +262,19 @@ def test_show_job(respx_mock: respx.MockRouter):
     assert result == data
 
 
+def test_request_id(respx_mock: respx.MockRouter):
+    route = respx_mock.get("http://kbatch.com/jobs/myjob").mock(
+        return_value=httpx.Response(200, json={})
+    )
+    kbatch.show_job("myjob", "http://kbatch.com/", token="abc")
+    kbatch.show_job("myjob", "http://kbatch.com/", token="abc")
+    first, second = (
+        call.request.headers["X-Kbatch-Request-Id"] for call in route.calls
+    )
+    assert re.match("^[0-9a-f]{32}$", first)
+    assert first != second
+
+
 def test_list_jobs(respx_mock: respx.MockRouter):
     data = json.loads(HERE.joinpath("data", "list_jobs.json").read_text())
     respx_mock.get("http://kbatch.com/jobs/").mock(
@@ -215,6 +285,45 @@ def test_list_jobs(respx_mock: respx.MockRouter):
     assert result == data
 
 
+def test_format_jobs_queued():
+    data = json.loads(HERE.joinpath("data", "list_jobs.json").read_text())
+    running = data["items"][0]
+    running["status"]["ready"] = 1
+    queued = json.loads(json.dumps(running))
+    queued["metadata"]["name"] = "queued"
+    queued["metadata"]["annotations"]["kbatch.jupyter.org/queue-position"] = "3"
+    queued["spec"]["suspend"] = True
+    queued["status"] = dict.fromkeys(running["status"])
+
+    assert kbatch._core.job_status(queued) == "[yellow]queued[/yellow]"
+    assert kbatch._core.duration(queued) == "-"
+
+    table = kbatch._core.format_jobs({"items": [running]})
+    assert [column.header for column in table.columns][-1] == "duration"
+
+    table = kbatch._core.format_jobs({"items": [running, queued]})
+    assert table.columns[-1].header == "queue position"
+    assert list(table.columns[-1].cells) == ["", "3"]
+
+
+def test_delete_jobs(respx_mock: respx.MockRouter):
+    route = respx_mock.delete("http://kbatch.com/jobs/").mock(
+        return_value=httpx.Response(200, json={"deleted": ["a", "b"]})
+    )
+
+    result = kbatch.delete_jobs(
+        kbatch_url="http://kbatch.com/", token="abc", status="failed", older_than="1d"
+    )
+    assert result == {"deleted": ["a", "b"]}
+    assert dict(route.calls.last.request.url.params) == {
+        "status": "failed",
+        "older_than": "1d",
+    }
+
+    with pytest.raises(ValueError, match="Specify"):
+        kbatch.delete_jobs(kbatch_url="http://kbatch.com/", token="abc")
+
+
 def test_list_pods(respx_mock: respx.MockRouter):
     data = json.loads(HERE.joinpath("data", "list_pods.json").read_text())
     respx_mock.get("http://kbatch.com/pods/").mock(
@@ -225,6 +334,26 @@ def test_list_pods(respx_mock: respx.MockRouter):
     assert result == data
 
 
+def test_conditional_list(respx_mock: respx.MockRouter):
+    data = json.loads(HERE.joinpath("data", "list_jobs.json").read_text())
+    etag = 'W/"abc"'
+
+    def respond(request):
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, json=data, headers={"ETag": etag})
+
+    route = respx_mock.get("http://kbatch.com/jobs/").mock(side_effect=respond)
+
+    with kbatch.KbatchClient("http://kbatch.com/", "abc") as client:
+        assert client.list_jobs() == data
+        assert client.list_jobs() == data
+    first, second = route.calls
+    assert "If-None-Match" not in first.request.headers
+    assert second.request.headers["If-None-Match"] == etag
+    assert second.response.status_code == 304
+
+
 @pytest.mark.parametrize("kind", ["pod", "job"])
 @pytest.mark.parametrize("streaming", ["streaming", ""])
 def test_logs(respx_mock: respx.MockRouter, kind, streaming):
@@ -244,6 +373,368 @@ def test_logs(respx_mock: respx.MockRouter, kind, streaming):
     assert result == data
 
 
+@pytest.fixture
+def no_sleep(mocker):
+    return mocker.patch("kbatch._retry.time.sleep")
+
+
+def test_conditional_concurrent(respx_mock: respx.MockRouter):
+    async def respond(request):
+        await asyncio.sleep(0.01)
+        name = request.url.path.rsplit("/", 1)[-1]
+        etag = f'W/"{name}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, json={"name": name}, headers={"ETag": etag})
+
+    respx_mock.get(url__regex=r"http://kbatch.com/jobs/\w+").mock(side_effect=respond)
+    names = [f"job{i}" for i in range(100)]
+
+    async def main():
+        async with kbatch.AsyncKbatchClient("http://kbatch.com/", "abc") as client:
+            for name in names:
+                await client.show_job(name)
+            # cached responses revalidated while others evict them still work
+            return await asyncio.gather(*(client.show_job(name) for name in names))
+
+    assert asyncio.run(main()) == [{"name": name} for name in names]
+    assert len(respx_mock.calls) == 200
+    assert any(call.response.status_code == 304 for call in respx_mock.calls)
+
+
+def test_retry(respx_mock: respx.MockRouter, no_sleep):
+    route = respx_mock.get("http://kbatch.com/jobs/").mock(
+        side_effect=[
+            httpx.Response(502),
+            httpx.ConnectError("refused"),
+            httpx.Response(503, headers={"Retry-After": "7"}),
+            httpx.Response(200, json={"items": []}),
+        ]
+    )
+    result = kbatch.list_jobs(kbatch_url="http://kbatch.com/", token="abc")
+    assert result == {"items": []}
+    assert route.call_count == 4
+    assert no_sleep.call_args_list[-1] == mock.call(7)
+
+    respx_mock.get("http://kbatch.com/pods/").mock(return_value=httpx.Response(504))
+    with pytest.raises(httpx.HTTPStatusError):
+        kbatch.list_pods(kbatch_url="http://kbatch.com/", token="abc")
+
+
+def test_retry_not_idempotent(respx_mock: respx.MockRouter, no_sleep, model_job):
+    route = respx_mock.post("http://kbatch.com/jobs/").mock(
+        side_effect=[
+            # shed by kbatch-proxy, so not processed
+            httpx.Response(
+                503, headers={"Retry-After": "1", "X-Kbatch-Unprocessed": "true"}
+            ),
+            # relayed from Kubernetes, maybe after creating the job
+            httpx.Response(429, headers={"Retry-After": "1"}),
+        ]
+    )
+    with pytest.raises(httpx.HTTPStatusError):
+        kbatch.submit_job(model_job, kbatch_url="http://kbatch.com/", token="abc")
+    assert route.call_count == 2
+
+
+def test_retry_disabled(respx_mock: respx.MockRouter):
+    route = respx_mock.get("http://kbatch.com/jobs/").mock(
+        return_value=httpx.Response(503)
+    )
+    kbatch.set_retry_policy(kbatch.RetryPolicy(max_retries=0))
+    try:
+        with pytest.raises(httpx.HTTPStatusError):
+            kbatch.list_jobs(kbatch_url="http://kbatch.com/", token="abc")
+    finally:
+        kbatch.set_retry_policy(None)
+    assert route.call_count == 1
+
+
+def test_logs_streaming_resumes(respx_mock: respx.MockRouter, no_sleep):
+    def interrupted():
+        yield b"line 1\n"
+        raise httpx.ReadError("connection reset")
+
+    respx_mock.get("http://kbatch.com/pods/logs/mypod/").mock(
+        side_effect=[
+            httpx.Response(200, content=interrupted()),
+            httpx.Response(200, content=b"line 1\nline 2\n"),
+        ]
+    )
+    result = kbatch.pod_logs_streaming("mypod", "http://kbatch.com/", token="abc")
+    assert "".join(result) == "line 1\nline 2\n"
+
+
+def test_kbatch_client(respx_mock: respx.MockRouter, mocker):
+    load_config = mocker.patch(
+        "kbatch._session.load_config",
+        return_value={"kbatch_url": "http://kbatch.com", "token": "abc"},
+    )
+    jobs = respx_mock.get("http://kbatch.com/jobs/").mock(
+        return_value=httpx.Response(200, json={"items": []})
+    )
+    pods = respx_mock.get("http://kbatch.com/pods/").mock(
+        return_value=httpx.Response(200, json={"items": []})
+    )
+
+    with kbatch.KbatchClient() as client:
+        assert client.list_jobs() == {"items": []}
+        assert client.list_pods("myjob") == {"items": []}
+
+    load_config.assert_called_once()
+    assert jobs.calls.last.request.headers["Authorization"] == "token abc"
+    assert pods.calls.last.request.url.params["job_name"] == "myjob"
+
+
+def test_default_client_reused(respx_mock: respx.MockRouter):
+    respx_mock.get("http://reused.com/jobs/").mock(
+        return_value=httpx.Response(200, json={"items": []})
+    )
+    kbatch.list_jobs(kbatch_url="http://reused.com/", token="abc")
+    client = kbatch._core._default_clients["http://reused.com/", "abc"]
+    kbatch.list_jobs(kbatch_url="http://reused.com/", token="abc")
+    assert kbatch._core._default_clients["http://reused.com/", "abc"] is client
+
+
+def test_profiles_cache(respx_mock: respx.MockRouter, tmp_path):
+    etag = '"v1"'
+
+    def serve(request):
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(
+            200, json={"python": {"image": "py"}}, headers={"ETag": etag}
+        )
+
+    route = respx_mock.get("http://cached.com/profiles/").mock(side_effect=serve)
+
+    with tmp_env("XDG_CONFIG_HOME", str(tmp_path)):
+        with kbatch.KbatchClient("http://cached.com/", "abc") as client:
+            assert client.load_profile("python") == {"image": "py"}
+            assert client.load_profile("python") == {"image": "py"}
+        assert route.calls[0].response.status_code == 200
+        assert route.calls[1].response.status_code == 304
+
+        cache = json.loads(kbatch._core.profiles_cache_path().read_text())
+        assert cache["http://cached.com/"]["etag"] == etag
+
+        # a new session revalidates the profiles cached on disk
+        with kbatch.KbatchClient("http://cached.com/", "abc") as client:
+            assert client.show_profiles() == {"python": {"image": "py"}}
+        assert route.calls.last.response.status_code == 304
+
+        etag = '"v2"'
+        with kbatch.KbatchClient("http://cached.com/", "abc") as client:
+            assert client.show_profiles() == {"python": {"image": "py"}}
+        assert route.calls.last.response.status_code == 200
+        cache = json.loads(kbatch._core.profiles_cache_path().read_text())
+        assert cache["http://cached.com/"]["etag"] == '"v2"'
+
+
+def test_code_reused(respx_mock: respx.MockRouter, tmp_path, model_job):
+    code = tmp_path / "code"
+    code.mkdir()
+    (code / "script.py").write_text("print('hi')")
+    kept = set()
+
+    def submitted(request):
+        data = json.loads(request.content)
+        job = data["job"]
+        if "code" in data:
+            kept.add(data["code_digest"])
+        elif data["code_digest"] not in kept:
+            return httpx.Response(409, json={"detail": "No code"})
+        job["metadata"]["annotations"] = {
+            kbatch._session.CODE_DIGEST_ANNOTATION: data["code_digest"]
+        }
+        return httpx.Response(200, json=job)
+
+    route = respx_mock.post("http://code.com/jobs/").mock(side_effect=submitted)
+    respx_mock.get("http://code.com/").mock(return_value=httpx.Response(200, json={}))
+
+    with tmp_env("XDG_CONFIG_HOME", str(tmp_path / "config")):
+        with kbatch.KbatchClient("http://code.com/", "abc") as client:
+            client.submit_job(model_job, code=code)
+            client.submit_job(model_job, code=code)
+            sent = [json.loads(call.request.content) for call in route.calls]
+            assert "code" in sent[0]
+            assert "code" not in sent[1]
+            assert sent[0]["code_digest"] == sent[1]["code_digest"]
+
+            # changed code is uploaded
+            (code / "script.py").write_text("print('bye')")
+            client.submit_job(model_job, code=code)
+            changed = json.loads(route.calls.last.request.content)
+            assert "code" in changed
+            assert changed["code_digest"] != sent[0]["code_digest"]
+
+            # code the proxy no longer has is uploaded again
+            kept.clear()
+            client.submit_job(model_job, code=code)
+            assert route.calls[-1].response.status_code == 200
+            assert route.calls[-2].response.status_code == 409
+            assert "code" in json.loads(route.calls.last.request.content)
+
+
+def test_compressed_requests(respx_mock: respx.MockRouter, model_job):
+    def submitted(request):
+        body = request.content
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return httpx.Response(
+            200, json=json.loads(body)["job"], headers={"Accept-Encoding": "gzip"}
+        )
+
+    route = respx_mock.post("http://kbatch.com/jobs/").mock(side_effect=submitted)
+    model_job.env = {"BIG": "x" * 10_000}
+
+    with kbatch.KbatchClient("http://kbatch.com/", "abc") as client:
+        # not until kbatch-proxy shows it accepts compressed bodies
+        first = client.submit_job(model_job)
+        assert "Content-Encoding" not in route.calls.last.request.headers
+        assert client.submit_job(model_job) == first
+        request = route.calls.last.request
+        assert request.headers["Content-Encoding"] == "gzip"
+        assert len(request.content) < 1000
+
+    # loading a profile shows it too
+    respx_mock.get("http://kbatch.com/profiles/").mock(
+        return_value=httpx.Response(
+            200, json={"python": {}}, headers={"Accept-Encoding": "gzip"}
+        )
+    )
+    with kbatch.KbatchClient("http://kbatch.com/", "abc") as client:
+        client.submit_job(model_job, profile="python")
+        assert route.calls.last.request.headers["Content-Encoding"] == "gzip"
+
+    with kbatch.KbatchClient("http://kbatch.com/", "abc", compress=False) as client:
+        client.submit_job(model_job)
+        client.submit_job(model_job)
+        assert "Content-Encoding" not in route.calls.last.request.headers
+
+
+def test_multipart_upload(respx_mock: respx.MockRouter, tmp_path, model_job):
+    code = tmp_path / "script.py"
+    code.write_text("print('hi')")
+    headers = {"Accept-Post": "application/json, multipart/form-data"}
+    route = respx_mock.post("http://kbatch.com/jobs/").mock(
+        return_value=httpx.Response(200, json={}, headers=headers)
+    )
+    root = respx_mock.get("http://kbatch.com/").mock(
+        return_value=httpx.Response(200, json={}, headers=headers)
+    )
+
+    with tmp_env("XDG_CONFIG_HOME", str(tmp_path / "config")):
+        # an older kbatch-proxy, accepting only JSON
+        root.mock(return_value=httpx.Response(200, json={}))
+        with kbatch.KbatchClient("http://kbatch.com/", "abc") as client:
+            client.submit_job(model_job, code=code)
+            request = route.calls.last.request
+            assert request.headers["Content-Type"] == "application/json"
+            encoded = json.loads(request.content)["code"]["binary_data"]["code"]
+            zipped = base64.b64decode(encoded)
+
+        # the first upload probes what kbatch-proxy accepts
+        root.mock(return_value=httpx.Response(200, json={}, headers=headers))
+        with kbatch.KbatchClient("http://kbatch.com/", "abc") as client:
+            client.submit_job(model_job, code=code)
+            request = route.calls.last.request
+            assert request.headers["Content-Type"].startswith("multipart/form-data")
+            assert zipped in request.content
+            assert encoded.encode() not in request.content
+            client.submit_job(model_job, code=code)
+        assert root.call_count == 2
+
+        async def main():
+            async with kbatch.AsyncKbatchClient("http://kbatch.com/", "abc") as client:
+                await asyncio.gather(
+                    *(client.submit_job(model_job, code=code) for _ in range(3))
+                )
+
+        asyncio.run(main())
+        assert root.call_count == 3
+        request = route.calls.last.request
+        assert request.headers["Content-Type"].startswith("multipart/form-data")
+
+
+def test_async_kbatch_client(respx_mock: respx.MockRouter, model_job):
+    in_flight = max_in_flight = 0
+
+    async def submitted(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(in_flight, max_in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json=json.loads(request.content)["job"])
+
+    async def profile_data(request):
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"python": {"image": "python"}})
+
+    route = respx_mock.post("http://kbatch.com/jobs/").mock(side_effect=submitted)
+    profiles = respx_mock.get("http://kbatch.com/profiles/").mock(
+        side_effect=profile_data
+    )
+    logs = respx_mock.get("http://kbatch.com/jobs/logs/myjob/").mock(
+        return_value=httpx.Response(200, text="line 1\nline 2\n")
+    )
+
+    async def main():
+        async with kbatch.AsyncKbatchClient(
+            "http://kbatch.com/", token="abc", max_concurrency=3
+        ) as client:
+            results = await asyncio.gather(
+                *(client.submit_job(model_job, profile="python") for _ in range(10))
+            )
+            streamed = [text async for text in client.job_logs_streaming("myjob")]
+        return results, streamed
+
+    results, streamed = asyncio.run(main())
+    assert len(results) == route.call_count == 10
+    assert results[0]["spec"]["template"]["spec"]["containers"][0]["image"] == "alpine"
+    assert max_in_flight == 3
+    assert profiles.call_count == 1
+    assert "".join(streamed) == "line 1\nline 2\n"
+    assert logs.calls.last.request.url.params["stream"] == "true"
+
+
+def test_async_profiles_revalidated(respx_mock: respx.MockRouter, tmp_path):
+    image = "py"
+
+    async def serve(request):
+        await asyncio.sleep(0.01)
+        etag = f'"{image}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(
+            200, json={"python": {"image": image}}, headers={"ETag": etag}
+        )
+
+    route = respx_mock.get("http://cached.com/profiles/").mock(side_effect=serve)
+
+    async def main():
+        nonlocal image
+        async with kbatch.AsyncKbatchClient("http://cached.com/", "abc") as client:
+            loaded = await asyncio.gather(
+                *(client.load_profile("python") for _ in range(10))
+            )
+            assert loaded == [{"image": "py"}] * 10
+            # concurrent loads share a single request
+            assert route.call_count == 1
+
+            assert await client.load_profile("python") == {"image": "py"}
+            assert route.calls.last.response.status_code == 304
+
+            # changed on the server, e.g. reloaded by kbatch-proxy
+            image = "py2"
+            assert await client.load_profile("python") == {"image": "py2"}
+            assert route.call_count == 3
+
+    with tmp_env("XDG_CONFIG_HOME", str(tmp_path)):
+        asyncio.run(main())
+
+
 def test_submit_job(respx_mock: respx.MockRouter):
     respx_mock.post("http://kbatch.com/jobs/").mock(
         return_value=httpx.Response(200, json={"mock": "response"})